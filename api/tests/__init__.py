@@ -0,0 +1,4 @@
+import logging
+
+# the query counts of every request the tests make would drown the test output, budgets are checked by the tests
+logging.getLogger('coach.queries').setLevel(logging.WARNING)
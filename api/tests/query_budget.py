@@ -0,0 +1,33 @@
+from django.urls import resolve
+from coach.querybudget import QueryRecorder, get_query_budget
+
+
+class QueryBudgetMixin:
+    """
+    Fails a test when a view runs more queries than its `query_budget`, listing the statements that repeated.
+    """
+
+    def get_recorded(self, client, path, **extra):
+        recorder = QueryRecorder()
+        with recorder.record():
+            response = client.get(path, **extra)
+        self.assertEqual(response.status_code, 200)
+        return recorder
+
+    def assertWithinQueryBudget(self, client, path, grow=None, **extra):
+        """
+        With `grow`, the view runs again after `grow()` added rows to what it shows and fails when it ran more
+        queries the second time, as the budget is only a budget when it doesn't depend on the data.
+        """
+        budget = get_query_budget(resolve(path).func)
+        if budget is None:
+            self.fail(f"{path} has no query budget")
+        recorder = self.get_recorded(client, path, **extra)
+        if recorder.count > budget:
+            self.fail(f"GET {path} ran {recorder.count} queries, its budget is {budget}\n{recorder.summary()}")
+        if grow is not None:
+            grow()
+            grown = self.get_recorded(client, path, **extra)
+            if grown.count > recorder.count:
+                self.fail(f"GET {path} ran {grown.count} queries after the data grew, {recorder.count} before\n"
+                          f"{grown.summary()}")
@@ -0,0 +1,33 @@
+from tempfile import TemporaryDirectory
+from django.test import SimpleTestCase
+from common.benchmarks import percentile, summarize, write_results, load_results, compare
+
+
+class BenchmarkResultsTestCase(SimpleTestCase):
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertIsNone(percentile([], 0.5))
+
+        summary = summarize([0.010, 0.020, 0.030, 0.040], elapsed=2)
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['per_second'], 2.0)
+        self.assertEqual(summary['p50_ms'], 20.0)
+        self.assertEqual(summary['max_ms'], 40.0)
+
+    def test_results_round_trip_and_compare(self):
+        baseline = {'cases': {'new_posts': {'p50_ms': 100.0, 'p95_ms': 200.0, 'per_second': 10.0}}}
+        results = {'cases': {'new_posts': {'p50_ms': 50.0, 'p95_ms': 200.0, 'per_second': 20.0},
+                             'coaches': {'p50_ms': 10.0}}}
+        with TemporaryDirectory() as directory:
+            path = write_results('api', results, directory)
+            written = load_results(path)
+        self.assertEqual(written['benchmark'], 'api')
+        self.assertEqual(written['cases'], results['cases'])
+        self.assertEqual(compare(written, baseline), [
+            'new_posts p50_ms 100.0 -> 50.0 (-50%)',
+            'new_posts p95_ms 200.0 -> 200.0 (+0%)',
+            'new_posts per_second 10.0 -> 20.0 (+100%)',
+        ])
@@ -0,0 +1,71 @@
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from prometheus_client import REGISTRY
+from common.cache import get_or_build, cached, tag
+from instructor.models import Coach
+from projects.models import Team
+from subscribers.models import Subscriber
+from .test_v1 import create_user, create_mentor
+import threading
+import time
+
+
+def requests(namespace, result):
+    return REGISTRY.get_sample_value('cache_requests_total', {'namespace': namespace, 'result': result}) or 0
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class TaggedCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        c = Client()
+        create_user(c)
+        create_mentor(c)
+        self.coach = Coach.objects.get()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return self.builds
+
+    def test_cached_until_a_tag_changes(self):
+        hits = requests('test', 'hit')
+        tags = [tag(self.coach)]
+        self.assertEqual(get_or_build('test', 'key', self.build, tags), 1)
+        self.assertEqual(get_or_build('test', 'key', self.build, tags), 1)
+        self.assertEqual(requests('test', 'hit'), hits + 1)
+
+        # the coach's tiers are part of the coach
+        tier = self.coach.tiers.first()
+        tier.label = 'changed'
+        tier.save()
+        self.assertEqual(get_or_build('test', 'key', self.build, tags), 2)
+        self.assertEqual(get_or_build('test', 'key', self.build, [tag(Coach)]), 3)
+        # a new version of the value doesn't read the old one
+        self.assertEqual(get_or_build('test', 'key', self.build, tags, version=2), 4)
+
+    def test_members_changes_invalidate(self):
+        team = Team.objects.create(name='team')
+        members = cached('team_members', tags=lambda team_id: [tag(Team, team_id)])(
+            lambda team_id: list(Team.objects.get(pk=team_id).members.values_list('pk', flat=True)))
+        self.assertEqual(members(team.pk), [])
+        first, second = Subscriber.objects.order_by('pk')[:2]
+        team.members.add(first, second)
+        self.assertEqual(sorted(members(team.pk)), [first.pk, second.pk])
+        team.members.remove(second)
+        self.assertEqual(members(team.pk), [first.pk])
+
+    def test_concurrent_misses_build_once(self):
+        def slow_build():
+            time.sleep(0.2)
+            return self.build()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_build('test', 'slow', slow_build)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1, 1, 1, 1])
+        self.assertEqual(self.builds, 1)
@@ -0,0 +1,45 @@
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import Client, TransactionTestCase
+from coach.channelsmiddleware import get_user
+from .test_v1 import create_user, get_tokens
+import asyncio
+
+
+# database_sync_to_async closes the connection of a TestCase's transaction
+class JWTChannelMiddlewareTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        c = Client()
+        self.subscriber = create_user(c)
+        self.user = self.subscriber.user
+        self.token = get_tokens(c)['access']
+
+    def test_reconnect_reads_the_principal_from_the_cache(self):
+        user = async_to_sync(get_user)(self.token)
+        self.assertEqual(user.subscriber, self.subscriber)
+
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user)(self.token)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.surrogate, self.user.surrogate)
+            self.assertEqual(user.subscriber.surrogate, self.subscriber.surrogate)
+            self.assertEqual(user.subscriber.name, self.subscriber.name)
+
+    def test_invalid_token_is_anonymous(self):
+        self.assertIsInstance(async_to_sync(get_user)('not a token'), AnonymousUser)
+
+    def test_cache_is_used_off_the_event_loop(self):
+        def off_the_loop(*args):
+            # asyncio only has a running loop in the thread of the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+
+        with mock.patch('coach.channelsmiddleware.cache') as cache_mock:
+            cache_mock.get.side_effect = off_the_loop
+            cache_mock.set.side_effect = off_the_loop
+            self.assertEqual(async_to_sync(get_user)(self.token).pk, self.user.pk)
+        cache_mock.get.assert_called_once()
+        cache_mock.set.assert_called_once()
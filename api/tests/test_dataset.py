@@ -0,0 +1,48 @@
+from io import StringIO
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase
+from notifications.models import Notification
+from chat.models import Message
+from comments.models import Comment
+from instructor.models import Coach
+from posts.models import Post
+from reacts.models import React
+from subscribers.models import Subscriber, Subscription
+from tiers.models import Tier
+
+
+class GenerateDatasetTestCase(TestCase):
+    def generate(self, seed=0):
+        call_command('generate_dataset', seed=seed, coaches=3, subscribers=20, posts=30, comments=25, reacts=40,
+                     messages=15, notifications=35, stdout=StringIO())
+
+    def test_generates_the_requested_rows(self):
+        self.generate()
+        self.assertEqual(Coach.objects.count(), 3)
+        self.assertEqual(Tier.objects.count(), 6)
+        self.assertEqual(Subscriber.objects.count(), 23)
+        self.assertEqual(Post.objects.count(), 30)
+        self.assertEqual(Comment.objects.count(), 25)
+        self.assertEqual(React.objects.count(), 40)
+        self.assertEqual(Message.objects.count(), 15)
+        self.assertEqual(Notification.objects.count(), 35)
+        # subscribers are notified of the posts of the coaches they subscribed to
+        notification = Notification.objects.first()
+        self.assertTrue(Subscription.objects.filter(subscriber__user=notification.recipient,
+                                                    tier__coach=notification.action_object.coach).exists())
+        # the comment threads are valid trees
+        for comment in Comment.objects.filter(level=0):
+            self.assertEqual(list(comment.get_descendants()), list(comment.children.order_by('lft')))
+
+    def posts_of(self, seed):
+        # generated in a savepoint that is rolled back, so the next run starts from the same database
+        with transaction.atomic():
+            self.generate(seed)
+            posts = list(Post.objects.order_by('id').values_list('id', 'surrogate', 'text', 'tier_id', 'created'))
+            transaction.set_rollback(True)
+        return posts
+
+    def test_same_seed_same_dataset(self):
+        self.assertEqual(self.posts_of(1), self.posts_of(1))
+        self.assertNotEqual(self.posts_of(1), self.posts_of(2))
@@ -0,0 +1,58 @@
+from unittest import mock
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.test import Client, TransactionTestCase, override_settings
+from coach import dbrouter
+from .test_v1 import create_user, get_tokens
+import time
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   REPLICA_DATABASES=['replica1'], REPLICA_MAX_LAG_SECONDS=5, REPLICA_LAG_CHECK_INTERVAL=60)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    There's no replica here, the aliases reads are routed to are recorded and the reads run on the primary. Reads
+    inside a transaction always go to the primary, so the test can't run in one.
+    """
+
+    def setUp(self):
+        c = Client()
+        create_user(c)
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {get_tokens(c)['access']}")
+        cache.clear()
+        self.set_lag(0)
+        self.addCleanup(dbrouter._lag.clear)
+
+        self.routed = []
+        read_alias = dbrouter.RequestState.read_alias
+
+        def record(state):
+            self.routed.append(read_alias(state))
+            return DEFAULT_DB_ALIAS
+        patcher = mock.patch.object(dbrouter.RequestState, 'read_alias', autospec=True, side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_lag(self, lag):
+        dbrouter._lag['replica1'] = (time.monotonic(), lag)
+
+    def test_marked_view_reads_from_replica(self):
+        self.assertEqual(self.client.get('/api/v1/coaches/').status_code, 200)
+        self.assertIn('replica1', self.routed)
+
+    def test_unmarked_view_reads_from_primary(self):
+        self.client.get('/api/v1/my_coaches/')
+        self.assertNotIn('replica1', self.routed)
+
+    def test_user_sticks_to_primary_after_write(self):
+        self.client.post('/api/v1/mark_all_notifications_as_read/')
+        self.routed.clear()
+        self.client.get('/api/v1/unread_notifications_count/')
+        self.assertTrue(self.routed)
+        self.assertNotIn('replica1', self.routed)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.set_lag(60)
+        self.client.get('/api/v1/coaches/')
+        self.assertTrue(self.routed)
+        self.assertNotIn('replica1', self.routed)
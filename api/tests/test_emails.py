@@ -0,0 +1,50 @@
+from unittest import mock
+from django.core import mail
+from django.db import DatabaseError, transaction
+from django.test import TestCase, override_settings
+from emails.models import OutgoingEmail
+from emails.outbox import send_batch, send_pending
+
+
+@override_settings(EMAIL_BACKEND='emails.backends.OutboxBackend',
+                   EMAIL_DELIVERY_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class EmailOutboxTestCase(TestCase):
+    def test_emails_are_queued_and_sent_by_the_worker(self):
+        mail.send_mail('Subject', 'Body', 'beta@troosh.app', ['user@example.com'],
+                       html_message='<p>Body</p>')
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.status, OutgoingEmail.PENDING)
+
+        self.assertEqual(send_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user@example.com'])
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>Body</p>', 'text/html')])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.SENT)
+
+    def test_emails_of_a_rolled_back_transaction_are_not_queued(self):
+        try:
+            with transaction.atomic():
+                mail.mail_admins('Subject', 'Body')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_queueing_errors_are_raised_unless_failing_silently(self):
+        with mock.patch('emails.backends.queue_messages', side_effect=DatabaseError('connection refused')):
+            mail.mail_admins('Subject', 'Body', fail_silently=True)
+            with self.assertRaises(DatabaseError):
+                mail.send_mail('Subject', 'Body', 'beta@troosh.app', ['user@example.com'])
+
+    def test_failed_delivery_is_retried_later(self):
+        mail.send_mail('Subject', 'Body', 'beta@troosh.app', ['user@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=ConnectionError('Connection refused')):
+            self.assertEqual(send_batch(), 1)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.status, OutgoingEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        # not due yet
+        self.assertEqual(send_batch(), 0)
@@ -0,0 +1,124 @@
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.test import Client, TestCase
+from PIL import Image
+from common import derivatives, hashing
+from common.models import ImageVariant, ImageVariantJob
+from posts.models import Post, PostImage
+from instructor.models import Coach, CoachAvatar
+from subscribers.models import Subscriber, SubscriberAvatar
+from uploads.models import Upload
+from .test_v1 import create_mentor
+
+
+def png(width, height):
+    output = BytesIO()
+    Image.new('RGB', (width, height), (0, 128, 255)).save(output, 'PNG')
+    return output.getvalue()
+
+
+def use_local_storage(testcase, *models):
+    """
+    Stores the files of the models' images on disk instead of the bucket, returns the storage.
+    """
+    media = TemporaryDirectory()
+    testcase.addCleanup(media.cleanup)
+    storage = FileSystemStorage(location=media.name, base_url='/media/')
+    for model in models:
+        patcher = mock.patch.object(model._meta.get_field('image'), 'storage', storage)
+        patcher.start()
+        testcase.addCleanup(patcher.stop)
+    return storage
+
+
+class ImageVariantTestCase(TestCase):
+    def setUp(self):
+        create_mentor(Client())
+        coach = Coach.objects.get(user__email='mentor@example.com')
+        self.post = Post.objects.create(coach=coach, tier=coach.tiers.first(), text='pictures')
+        use_local_storage(self, PostImage, ImageVariant)
+
+    def test_variant_sizes_never_scale_up(self):
+        with mock.patch.object(derivatives, 'WIDTHS', [160, 480, 1080]):
+            self.assertEqual(derivatives.variant_sizes(600, 300), [(160, 80), (480, 240)])
+
+    def test_creating_an_image_queues_a_job(self):
+        image = PostImage(post=self.post, coach=self.post.coach, height=300, width=600)
+        image.image.save('picture.png', ContentFile(png(600, 300)))
+        job = ImageVariantJob.objects.get()
+        self.assertEqual(job.original, image)
+        self.assertEqual(job.status, ImageVariantJob.PENDING)
+
+    def test_variants_are_generated_once(self):
+        image = PostImage(post=self.post, coach=self.post.coach, height=300, width=600)
+        image.image.save('picture.png', ContentFile(png(600, 300)))
+        with mock.patch.object(derivatives, 'WIDTHS', [160, 480]), \
+                mock.patch.object(derivatives, 'FORMATS', [ImageVariant.WEBP]):
+            self.assertEqual(derivatives.process_pending_jobs(), 1)
+            self.assertEqual(derivatives.process_pending_jobs(), 0)
+            # running the generation again only renders what is missing
+            derivatives.generate_variants(image)
+
+        self.assertEqual(ImageVariantJob.objects.get().status, ImageVariantJob.DONE)
+        variants = ImageVariant.objects.order_by('width')
+        self.assertEqual([(v.format, v.width, v.height) for v in variants], [('webp', 160, 80), ('webp', 480, 240)])
+        with Image.open(variants[0].image) as rendered:
+            self.assertEqual(rendered.format, 'WEBP')
+            self.assertEqual(rendered.size, (160, 80))
+        self.assertEqual(set(derivatives.srcset(image)['webp']), {160, 480})
+
+
+class AvatarDedupeTestCase(TestCase):
+    def setUp(self):
+        self.storage = use_local_storage(self, SubscriberAvatar, CoachAvatar, ImageVariant)
+        self.subscriber = create_mentor(Client())
+
+    def set_avatar(self, content):
+        SubscriberAvatar.objects.create(subscriber=self.subscriber, image=ContentFile(content, 'avatar.png'))
+        self.subscriber.save()
+
+    def test_saving_the_profile_reuses_the_coach_avatar(self):
+        self.set_avatar(png(200, 200))
+        coach_avatar = Coach.objects.get(user=self.subscriber.user).avatar
+        self.assertEqual(coach_avatar.image.name, self.subscriber.avatar.image.name)
+
+        self.subscriber.save()
+        self.set_avatar(png(200, 200))
+        self.assertEqual(CoachAvatar.objects.count(), 1)
+        self.assertEqual(Coach.objects.get(user=self.subscriber.user).avatar, coach_avatar)
+        # the same content is stored once
+        self.assertEqual(len(self.storage.listdir('images/avatars')[1]), 1)
+
+    def test_dedupe_collapses_duplicates_and_deletes_orphaned_files(self):
+        self.set_avatar(png(200, 200))
+        coach = Coach.objects.get(user=self.subscriber.user)
+        kept = coach.avatar
+        # a copy made before avatars were hashed
+        copy = CoachAvatar.objects.create(image=kept.image.name, height=200, width=200)
+        Coach.objects.filter(pk=coach.pk).update(avatar=copy)
+        orphan = self.storage.save('images/avatars/orphan.png', ContentFile(png(10, 10)))
+
+        with mock.patch('common.management.commands.dedupe_avatars.default_storage', self.storage):
+            call_command('dedupe_avatars', stdout=StringIO())
+
+        self.assertEqual(list(CoachAvatar.objects.all()), [kept])
+        self.assertEqual(Coach.objects.get(pk=coach.pk).avatar, kept)
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertTrue(self.storage.exists(kept.image.name))
+
+    def test_dedupe_keeps_confirmed_uploads(self):
+        # confirmed and stored under its hash, the avatar isn't created until the upload is claimed
+        content = ContentFile(png(10, 10))
+        digest = hashing.content_hash(content)
+        name = self.storage.save(hashing.hashed_name(digest, 'avatar.png'), content)
+        Upload.objects.create(user=self.subscriber.user, kind=Upload.AVATAR, status=Upload.CONFIRMED,
+                              name='images/uploads/avatar.png', content_type='image/png', content_hash=digest)
+
+        with mock.patch('common.management.commands.dedupe_avatars.default_storage', self.storage):
+            call_command('dedupe_avatars', stdout=StringIO())
+
+        self.assertTrue(self.storage.exists(name))
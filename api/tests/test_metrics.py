@@ -0,0 +1,54 @@
+from django.test import Client, TestCase, SimpleTestCase, override_settings
+from prometheus_client import REGISTRY
+from coach.metrics import outbound_call
+from .test_v1 import create_user, get_tokens
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        c = Client()
+        create_user(c)
+        self.c = Client(HTTP_AUTHORIZATION=f"Bearer {get_tokens(c)['access']}")
+
+    def test_requests_are_labelled_with_view_and_action(self):
+        labels = {'view': 'CoachViewSet', 'action': 'list'}
+        before = sample('http_request_duration_seconds_count', method='GET', status='2xx', **labels)
+        queries_before = sample('http_request_db_queries_count', **labels)
+        self.c.get('/api/v1/coaches/')
+        self.assertEqual(sample('http_request_duration_seconds_count', method='GET', status='2xx', **labels),
+                         before + 1)
+        self.assertEqual(sample('http_request_db_queries_count', **labels), queries_before + 1)
+
+    def test_unknown_methods_share_a_label(self):
+        labels = {'view': 'CoachViewSet', 'action': 'other', 'method': 'other', 'status': '4xx'}
+        before = sample('http_request_duration_seconds_count', **labels)
+        self.c.generic('BREW', '/api/v1/coaches/')
+        self.assertEqual(sample('http_request_duration_seconds_count', **labels), before + 1)
+        self.assertEqual(sample('http_request_duration_seconds_count', view='CoachViewSet', action='brew',
+                                method='BREW', status='4xx'), 0)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_requires_the_token(self):
+        self.assertEqual(Client().get('/metrics').status_code, 401)
+        response = Client(HTTP_AUTHORIZATION='Bearer secret').get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http_request_duration_seconds', response.content)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_endpoint_hidden_without_token(self):
+        self.assertEqual(Client().get('/metrics').status_code, 404)
+
+
+class OutboundCallTestCase(SimpleTestCase):
+    def test_failed_calls_count_as_errors(self):
+        labels = {'service': 'zoom', 'operation': 'create_meeting'}
+        errors = sample('outbound_request_duration_seconds_count', outcome='error', **labels)
+        with self.assertRaises(ValueError):
+            with outbound_call('zoom', 'create_meeting'):
+                raise ValueError
+        self.assertEqual(sample('outbound_request_duration_seconds_count', outcome='error', **labels), errors + 1)
@@ -0,0 +1,339 @@
+from unittest import mock
+from django.core.cache import cache
+from django.test import Client, TestCase
+from django.contrib.contenttypes.models import ContentType
+from djmoney.money import Money
+from instructor.models import Coach
+from projects.models import Project
+from subscribers.models import Subscriber
+from subscribers.models import Subscription
+from tiers.models import Tier
+from payments.models import StripeOperation, PriceMigration, StripeEvent
+from payments.outbox import run_operation, run_pending_operations
+from payments import outbox
+from payments.price_migration import schedule, run_chunk
+from payments.signals import price_created
+from payments.webhooks import load_handlers, process_next_event, process_pending_events
+from payments import stripe_cache
+from payments.outbox import process_pending
+from payments.standin import StripeStandIn, make_server, sign_payload
+import threading
+from .test_v1 import create_user, create_mentor, get_mentor_tokens
+import json
+import stripe
+
+
+def get_operations(instance, kind=None):
+    operations = StripeOperation.objects.filter(content_type=ContentType.objects.get_for_model(instance),
+                                                object_id=instance.pk)
+    if kind:
+        operations = operations.filter(kind=kind)
+    return operations
+
+
+class StripeOutboxTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        create_mentor(self.c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+
+    def test_new_subscriber_records_a_customer_operation(self):
+        subscriber = create_user(self.c)
+        self.assertIsNone(subscriber.customer_id)
+        self.assertEqual(get_operations(subscriber, StripeOperation.CREATE_CUSTOMER).count(), 1)
+
+    def test_new_coach_records_an_account_operation(self):
+        self.assertEqual(get_operations(self.coach, StripeOperation.CREATE_ACCOUNT).count(), 1)
+
+    def test_new_project_records_product_and_price_operations(self):
+        project = Project.objects.create(coach=self.coach, name='Test project', credit=Money(10, 'EUR'))
+        self.assertEqual(get_operations(project, StripeOperation.CREATE_PRODUCT).count(), 1)
+        price_operation = get_operations(project, StripeOperation.CREATE_PRICE).get()
+        self.assertEqual(price_operation.payload['unit_amount'], 1000)
+        self.assertEqual(price_operation.payload['currency'], 'eur')
+
+    def test_saving_a_project_without_credit_change_records_no_new_price(self):
+        project = Project.objects.create(coach=self.coach, name='Test project', credit=Money(10, 'EUR'),
+                                         product_id='prod_test', price_id='price_test')
+        project.name = 'Renamed project'
+        project.save()
+        self.assertEqual(get_operations(project, StripeOperation.CREATE_PRICE).count(), 0)
+
+        project.credit = Money(12, 'EUR')
+        project.save()
+        price_operation = get_operations(project, StripeOperation.CREATE_PRICE).get()
+        self.assertEqual(price_operation.payload['unit_amount'], 1200)
+
+    def test_stale_price_operation_is_skipped(self):
+        project = Project.objects.create(coach=self.coach, name='Test project', credit=Money(10, 'EUR'),
+                                         product_id='prod_test', price_id='price_test')
+        project.credit = Money(12, 'EUR')
+        project.save()
+        project.credit = Money(15, 'EUR')
+        project.save()
+
+        stale_operation = get_operations(project, StripeOperation.CREATE_PRICE).first()
+        run_operation(stale_operation)
+        self.assertEqual(stale_operation.status, StripeOperation.SKIPPED)
+        project.refresh_from_db()
+        self.assertEqual(project.price_id, 'price_test')
+
+    def test_operations_of_deleted_objects_are_skipped(self):
+        subscriber = create_user(self.c)
+        operation = get_operations(subscriber, StripeOperation.CREATE_CUSTOMER).get()
+        Subscriber.objects.filter(pk=subscriber.pk).delete()
+        run_operation(operation)
+        self.assertEqual(operation.status, StripeOperation.SKIPPED)
+
+    @mock.patch('stripe.Customer.create', side_effect=stripe.error.APIConnectionError('stripe is down'))
+    def test_inline_runs_wait_for_the_retry(self, create):
+        subscriber = create_user(self.c)
+        for _ in range(outbox.MAX_ATTEMPTS + 1):
+            run_pending_operations(subscriber)
+        operation = get_operations(subscriber, StripeOperation.CREATE_CUSTOMER).get()
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(operation.attempts, 1)
+        self.assertEqual(operation.status, StripeOperation.PENDING)
+
+    def test_database_error_of_a_handler_is_retried_later(self):
+        subscriber = create_user(self.c)
+        operation = get_operations(subscriber, StripeOperation.CREATE_CUSTOMER).get()
+
+        def handler(operation, target):
+            # an integrity error marks the surrounding transaction for rollback
+            StripeOperation.objects.create(pk=operation.pk, content_type=operation.content_type,
+                                           object_id=operation.object_id, kind=operation.kind)
+
+        with mock.patch.dict(outbox.HANDLERS, {StripeOperation.CREATE_CUSTOMER: handler}):
+            run_operation(operation)
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, StripeOperation.PENDING)
+        self.assertEqual(operation.attempts, 1)
+        self.assertIn('UNIQUE', operation.last_error.upper())
+
+
+def modified_subscription(id, **params):
+    return stripe.stripe_object.StripeObject.construct_from({
+        'id': id,
+        'items': {'data': [{'id': params['items'][0]['id'], 'price': params['items'][0]['price']}]},
+    }, 'key')
+
+
+class PriceMigrationTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        create_mentor(self.c)
+        self.tier = Tier.objects.filter(coach__user__email='mentor@example.com', tier=Tier.TIER1).first()
+        Tier.objects.filter(pk=self.tier.pk).update(product_id='prod_test', price_id='price_old')
+        for i in range(5):
+            Subscription.objects.create(tier=self.tier, subscription_id=f'sub_{i}', price_id='price_old',
+                                        json_data=json.dumps({'items': {'data': [{'id': f'si_{i}'}]}}))
+
+    def test_new_price_schedules_a_migration(self):
+        price = stripe.stripe_object.StripeObject.construct_from({'id': 'price_new'}, 'key')
+        price_created.send(sender=Tier, instance=self.tier, price=price, previous_price_id='price_old')
+        migration = PriceMigration.objects.get(tier=self.tier)
+        self.assertEqual(migration.new_price_id, 'price_new')
+        self.assertEqual(migration.total, 5)
+
+    def test_migration_runs_in_chunks_and_checkpoints(self):
+        migration = schedule(self.tier, 'price_new')
+        with mock.patch('stripe.Subscription.modify', side_effect=modified_subscription) as modify:
+            run_chunk(migration, chunk_size=2, concurrency=2)
+            self.assertEqual(migration.status, PriceMigration.RUNNING)
+            self.assertEqual(migration.migrated, 2)
+            self.assertEqual(Subscription.objects.filter(price_id='price_new').count(), 2)
+
+            while migration.status == PriceMigration.RUNNING:
+                run_chunk(migration, chunk_size=2, concurrency=2)
+        self.assertEqual(modify.call_count, 5)
+        self.assertEqual(migration.status, PriceMigration.DONE)
+        self.assertEqual(migration.migrated, 5)
+        self.assertFalse(Subscription.objects.filter(price_id='price_old').exists())
+
+    def test_temporary_error_stops_the_chunk_at_the_failed_subscription(self):
+        migration = schedule(self.tier, 'price_new')
+
+        def flaky_modify(id, **params):
+            if id == 'sub_1':
+                raise stripe.error.APIError('Server error')
+            return modified_subscription(id, **params)
+
+        with mock.patch('stripe.Subscription.modify', side_effect=flaky_modify):
+            run_chunk(migration, chunk_size=5, concurrency=1)
+        self.assertEqual(migration.attempts, 1)
+        self.assertEqual(migration.migrated, 4)
+        self.assertEqual(migration.cursor, Subscription.objects.get(subscription_id='sub_0').id)
+        self.assertGreater(migration.next_attempt_at, migration.updated)
+
+        with mock.patch('stripe.Subscription.modify', side_effect=modified_subscription) as modify:
+            run_chunk(migration, chunk_size=5, concurrency=1)
+            run_chunk(migration, chunk_size=5, concurrency=1)
+        self.assertEqual(modify.call_count, 1)
+        self.assertEqual(migration.status, PriceMigration.DONE)
+        self.assertEqual(migration.migrated, 5)
+
+    def test_price_migration_status_endpoint(self):
+        migration = schedule(self.tier, 'price_new')
+        c_mentor_auth = Client(HTTP_AUTHORIZATION=f"Bearer {get_mentor_tokens(self.c)['access']}")
+        response = c_mentor_auth.get(f'/api/v1/tiers/{self.tier.surrogate}/price_migration/')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['surrogate'], str(migration.surrogate))
+        self.assertEqual(data['status'], PriceMigration.PENDING)
+        self.assertEqual(data['total'], 5)
+
+
+def stripe_event(id, type, data_object, created=1600000000):
+    return stripe.Event.construct_from({
+        'id': id,
+        'object': 'event',
+        'type': type,
+        'created': created,
+        'data': {'object': data_object},
+    }, 'key')
+
+
+class StripeWebhookTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        create_mentor(self.c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        Coach.objects.filter(pk=self.coach.pk).update(stripe_id='acct_test', charges_enabled=False)
+        load_handlers()
+
+    def post_event(self, event):
+        with mock.patch('stripe.Webhook.construct_event', return_value=event):
+            return self.c.post('/api/v1/webhooks/stripe/', data='{}', content_type='application/json',
+                               HTTP_STRIPE_SIGNATURE='signature')
+
+    def test_redelivered_event_is_stored_once(self):
+        event = stripe_event('evt_1', 'account.updated', {'id': 'acct_test', 'charges_enabled': True})
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(StripeEvent.objects.filter(event_id='evt_1').count(), 1)
+        # nothing is processed while handling the request
+        self.coach.refresh_from_db()
+        self.assertFalse(self.coach.charges_enabled)
+
+    def test_invalid_signature_is_rejected(self):
+        error = stripe.error.SignatureVerificationError('Invalid signature', 'signature')
+        with mock.patch('stripe.Webhook.construct_event', side_effect=error):
+            response = self.c.post('/api/v1/webhooks/stripe/', data='{}', content_type='application/json',
+                                   HTTP_STRIPE_SIGNATURE='signature')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_worker_processes_stored_events(self):
+        self.post_event(stripe_event('evt_1', 'account.updated', {'id': 'acct_test', 'charges_enabled': True}))
+        self.post_event(stripe_event('evt_2', 'customer.created', {'id': 'cus_test'}))
+        self.assertEqual(process_pending_events(), 2)
+        self.assertEqual(StripeEvent.objects.get(event_id='evt_1').status, StripeEvent.DONE)
+        self.assertEqual(StripeEvent.objects.get(event_id='evt_2').status, StripeEvent.IGNORED)
+        self.coach.refresh_from_db()
+        self.assertTrue(self.coach.charges_enabled)
+
+    def test_events_of_the_same_object_are_processed_in_order(self):
+        self.post_event(stripe_event('evt_2', 'account.updated', {'id': 'acct_test', 'charges_enabled': True},
+                                     created=1600000002))
+        self.post_event(stripe_event('evt_1', 'account.updated', {'id': 'acct_missing', 'charges_enabled': True},
+                                     created=1600000001))
+        self.post_event(stripe_event('evt_3', 'account.updated', {'id': 'acct_missing', 'charges_enabled': False},
+                                     created=1600000003))
+
+        # evt_1 fails since the account is unknown, evt_3 waits for it while evt_2 of another account goes ahead
+        failed_event = process_next_event()
+        self.assertEqual(failed_event.event_id, 'evt_1')
+        self.assertEqual(failed_event.status, StripeEvent.PENDING)
+        self.assertEqual(failed_event.attempts, 1)
+        self.assertEqual(process_next_event().event_id, 'evt_2')
+        self.assertIsNone(process_next_event())
+
+
+class StripeCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.c = Client()
+
+    def test_prices_are_retrieved_once(self):
+        price = stripe.Price.construct_from({'id': 'price_test', 'object': 'price', 'unit_amount': 1000}, 'key')
+        with mock.patch('stripe.Price.retrieve', return_value=price) as retrieve:
+            self.assertEqual(stripe_cache.retrieve_price('price_test').unit_amount, 1000)
+            self.assertEqual(stripe_cache.retrieve_price('price_test').unit_amount, 1000)
+        self.assertEqual(retrieve.call_count, 1)
+
+    def test_webhook_event_invalidates_cached_customer(self):
+        customer = stripe.Customer.construct_from({'id': 'cus_test', 'object': 'customer',
+                                                   'invoice_settings': {'default_payment_method': None}}, 'key')
+        with mock.patch('stripe.Customer.retrieve', return_value=customer) as retrieve:
+            stripe_cache.retrieve_customer('cus_test')
+            stripe_cache.retrieve_customer('cus_test')
+            self.assertEqual(retrieve.call_count, 1)
+
+            event = stripe_event('evt_1', 'payment_method.attached',
+                                 {'id': 'pm_test', 'object': 'payment_method', 'customer': 'cus_test'})
+            with mock.patch('stripe.Webhook.construct_event', return_value=event):
+                self.c.post('/api/v1/webhooks/stripe/', data='{}', content_type='application/json',
+                            HTTP_STRIPE_SIGNATURE='signature')
+            stripe_cache.retrieve_customer('cus_test')
+            self.assertEqual(retrieve.call_count, 2)
+
+
+class StripeStandInTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        self.standin = StripeStandIn()
+        self.server = make_server(self.standin, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        api_base, api_key = stripe.api_base, stripe.api_key
+        stripe.api_base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        stripe.api_key = 'sk_test_standin'
+
+        def restore():
+            self.server.shutdown()
+            self.server.server_close()
+            stripe.api_base, stripe.api_key = api_base, api_key
+        self.addCleanup(restore)
+
+    def test_outbox_creates_objects_on_the_standin(self):
+        create_mentor(self.c)
+        coach = Coach.objects.get(user__email='mentor@example.com')
+        project = Project.objects.create(coach=coach, name='Test project', credit=Money(10, 'EUR'))
+        process_pending()
+        project.refresh_from_db()
+        coach.refresh_from_db()
+        self.assertTrue(project.product_id.startswith('prod_'))
+        self.assertEqual(stripe.Price.retrieve(project.price_id).unit_amount, 1000)
+        self.assertTrue(coach.stripe_id.startswith('acct_'))
+        self.assertFalse(StripeOperation.objects.exclude(status=StripeOperation.DONE).exists())
+
+    def test_subscription_expands_latest_invoice(self):
+        customer = stripe.Customer.create(email='test@example.com', name='test')
+        product = stripe.Product.create(name='Tier 1')
+        price = stripe.Price.create(unit_amount=900, currency='eur', product=product.id,
+                                    recurring={'interval': 'month'})
+        subscription = stripe.Subscription.create(customer=customer.id, items=[{'price': price.id}],
+                                                  payment_behavior='default_incomplete',
+                                                  expand=['latest_invoice.payment_intent'],
+                                                  metadata={'tier': 'tier'})
+        self.assertEqual(subscription.latest_invoice.payment_intent.amount, 900)
+        self.assertTrue(subscription.latest_invoice.payment_intent.client_secret)
+
+        subscription = stripe.Subscription.modify(subscription.id, metadata={'troosh_status': 'completed'})
+        self.assertEqual(subscription.metadata['tier'], 'tier')
+        self.assertEqual(subscription.metadata['troosh_status'], 'completed')
+
+    def test_injected_errors_and_idempotency(self):
+        self.standin.rate_limit_rate = 1
+        with self.assertRaises(stripe.error.RateLimitError):
+            stripe.Product.create(name='Product')
+        self.standin.rate_limit_rate = 0
+        first = stripe.Product.create(name='Product', idempotency_key='key')
+        second = stripe.Product.create(name='Product', idempotency_key='key')
+        self.assertEqual(first.id, second.id)
+
+    def test_signed_payloads_pass_verification(self):
+        payload = json.dumps({'id': 'evt_test', 'object': 'event', 'type': 'account.updated',
+                              'data': {'object': {'id': 'acct_test'}}})
+        event = stripe.Webhook.construct_event(payload, sign_payload(payload, 'whsec_test'), 'whsec_test')
+        self.assertEqual(event.id, 'evt_test')
@@ -0,0 +1,47 @@
+from tempfile import TemporaryDirectory
+from django.test import Client, TestCase, override_settings
+from coach.profiling import profile_token
+from .test_v1 import create_user, get_tokens
+import json
+import os
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   PROFILE_STORAGE='coach.storage_backends.LocalProfileStorage', PROFILE_INTERVAL_MS=1)
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        c = Client()
+        create_user(c)
+        self.token = get_tokens(c)['access']
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def get(self, **headers):
+        with self.settings(PROFILE_DIR=self.directory):
+            return Client(HTTP_AUTHORIZATION=f"Bearer {self.token}", **headers).get('/api/v1/coaches/')
+
+    def test_signed_header_profiles_the_request(self):
+        response = self.get(HTTP_X_PROFILE=profile_token())
+        name = response['X-Profile']
+        self.assertIn('CoachViewSet-list', name)
+        with open(os.path.join(self.directory, f"{name}.json")) as file:
+            details = json.load(file)
+        self.assertEqual(details['reason'], 'requested')
+        self.assertEqual(details['queries'], len(details['sql']))
+        self.assertTrue(details['sql'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f"{name}.wall.folded")))
+
+    def test_unknown_method_is_not_in_the_name(self):
+        with self.settings(PROFILE_DIR=self.directory):
+            response = Client().generic('BREW', '/nowhere/', HTTP_X_PROFILE=profile_token())
+        self.assertIn('unresolved-other', response['X-Profile'])
+
+    def test_unsigned_header_is_ignored(self):
+        response = self.get(HTTP_X_PROFILE='profile:forged')
+        self.assertFalse(response.has_header('X-Profile'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(PROFILE_SAMPLE_RATE=1)
+    def test_sampled(self):
+        self.assertTrue(self.get().has_header('X-Profile'))
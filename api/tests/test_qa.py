@@ -0,0 +1,205 @@
+from datetime import datetime, time, timedelta
+from unittest import mock
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+from instructor.models import Coach
+from qa.models import AvailableTimeRange, AvailabilitySlot, Question
+from qa.availability import available_coaches
+from qa.slots import regenerate_coach_slots, book_slots, next_free_slots
+from expertisefields.models import ExpertiseFieldMultiple
+from api.v1.utils import classify_question
+from .test_v1 import create_mentor, create_mentor_2, get_mentor_tokens
+import json
+import uuid
+
+
+class CoachAvailabilityTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        create_mentor(self.c)
+        create_mentor_2(self.c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        self.coach_2 = Coach.objects.get(user__email='mentor2@example.com')
+        # a monday
+        self.start = datetime(2021, 3, 1, 10, 0, tzinfo=timezone.utc)
+        for coach in (self.coach, self.coach_2):
+            AvailableTimeRange.objects.create(coach=coach, weekday=1, start_time=time(9), end_time=time(12))
+
+    def test_time_range_of_another_weekday_does_not_count(self):
+        tuesday = self.start + timedelta(days=1)
+        self.assertEqual(available_coaches(Coach.objects.all(), tuesday).count(), 0)
+        self.assertEqual(available_coaches(Coach.objects.all(), self.start).count(), 2)
+
+    def test_call_length_must_be_a_minute_to_a_day(self):
+        for minutes in ('an hour', 0, -30, 1000000000):
+            response = self.c.get(f'/api/v1/check_available_coaches_for_question/{uuid.uuid4()}/',
+                                  {'minutes': minutes})
+            self.assertEqual(response.status_code, 400)
+
+    def test_time_range_must_cover_the_whole_call(self):
+        start = self.start.replace(hour=11, minute=30)
+        self.assertEqual(available_coaches(Coach.objects.all(), start).count(), 0)
+        self.assertEqual(available_coaches(Coach.objects.all(), start, timedelta(minutes=30)).count(), 2)
+
+    def test_overlapping_question_makes_coach_unavailable(self):
+        Question.objects.create(delivered_by=self.coach, initial_delivery_time=self.start - timedelta(minutes=30),
+                                delivery_time=self.start + timedelta(minutes=15))
+        # ends right when the call starts
+        Question.objects.create(delivered_by=self.coach_2, initial_delivery_time=self.start - timedelta(minutes=30),
+                                delivery_time=self.start)
+        self.assertEqual(list(available_coaches(Coach.objects.all(), self.start)), [self.coach_2])
+
+
+class AvailabilitySlotTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+        create_mentor(self.c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        # a sunday, the calendar covers the four weeks after it
+        self.now = datetime(2021, 2, 28, 12, 0, tzinfo=timezone.utc)
+        self.time_range = AvailableTimeRange.objects.create(coach=self.coach, weekday=1, start_time=time(9),
+                                                            end_time=time(10))
+
+    def test_slots_are_generated_for_the_coming_weeks(self):
+        regenerate_coach_slots(self.coach, now=self.now)
+        slots = AvailabilitySlot.objects.filter(coach=self.coach)
+        # 4 mondays with 4 slots of 15 minutes each
+        self.assertEqual(slots.count(), 16)
+        self.assertEqual(slots.first().start, datetime(2021, 3, 1, 9, 0, tzinfo=timezone.utc))
+
+    def test_regeneration_only_changes_the_difference(self):
+        regenerate_coach_slots(self.coach, now=self.now)
+        kept = AvailabilitySlot.objects.filter(coach=self.coach).first()
+        AvailableTimeRange.objects.create(coach=self.coach, weekday=2, start_time=time(9), end_time=time(9, 30))
+        created = regenerate_coach_slots(self.coach, now=self.now)
+        self.assertEqual(len(created), 8)
+        self.assertTrue(AvailabilitySlot.objects.filter(pk=kept.pk).exists())
+
+        self.time_range.delete()
+        regenerate_coach_slots(self.coach, now=self.now)
+        self.assertEqual(AvailabilitySlot.objects.filter(coach=self.coach).count(), 8)
+
+    def test_booked_question_marks_its_slots(self):
+        regenerate_coach_slots(self.coach, now=self.now)
+        start = datetime(2021, 3, 1, 9, 0, tzinfo=timezone.utc)
+        question = Question.objects.create(delivered_by=self.coach, initial_delivery_time=start,
+                                           delivery_time=start + timedelta(minutes=30))
+        self.assertEqual(book_slots(question), 2)
+        slots = list(next_free_slots(2, after=self.now))
+        self.assertEqual(slots[0].start, start + timedelta(minutes=30))
+
+    def test_moved_or_deleted_question_releases_its_slots(self):
+        regenerate_coach_slots(self.coach, now=self.now)
+        start = datetime(2021, 3, 1, 9, 0, tzinfo=timezone.utc)
+        question = Question.objects.create(delivered_by=self.coach, initial_delivery_time=start,
+                                           delivery_time=start + timedelta(minutes=30))
+        book_slots(question)
+
+        question.initial_delivery_time += timedelta(days=7)
+        question.delivery_time += timedelta(days=7)
+        question.save()
+        booked = AvailabilitySlot.objects.filter(is_booked=True)
+        next_week = start + timedelta(days=7)
+        self.assertEqual([slot.start for slot in booked], [next_week, next_week + timedelta(minutes=15)])
+        self.assertEqual({slot.question for slot in booked}, {question})
+
+        question.delete()
+        self.assertFalse(AvailabilitySlot.objects.filter(is_booked=True).exists())
+
+    def test_next_available_slots_endpoint(self):
+        regenerate_coach_slots(self.coach)
+        response = self.c.get('/api/v1/next_available_slots/', {'coach': str(self.coach.surrogate), 'limit': 3})
+        slots = json.loads(response.content)['slots']
+        self.assertEqual(len(slots), 3)
+        self.assertEqual(slots[0]['coach'], str(self.coach.surrogate))
+
+    def test_next_available_slots_rejects_bad_parameters(self):
+        for params in ({'limit': 'ten'}, {'coach': 'not-a-uuid'}):
+            response = self.c.get('/api/v1/next_available_slots/', params)
+            self.assertEqual(response.status_code, 400)
+        regenerate_coach_slots(self.coach)
+        response = self.c.get('/api/v1/next_available_slots/', {'coach': str(self.coach.surrogate), 'limit': -1})
+        self.assertEqual(len(json.loads(response.content)['slots']), 1)
+
+
+class CoachAvailabilityUpdateTestCase(TestCase):
+    def setUp(self):
+        c = Client()
+        create_mentor(c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        tokens = get_mentor_tokens(c)
+        self.c = Client(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.kept = AvailableTimeRange.objects.create(coach=self.coach, weekday=1, start_time=time(9),
+                                                      end_time=time(10))
+        AvailableTimeRange.objects.create(coach=self.coach, weekday=2, start_time=time(9), end_time=time(10))
+
+    def change_availability(self, ranges):
+        return self.c.post('/api/v1/change_availability_time_ranges/', {'availability_ranges': ranges},
+                           content_type='application/json')
+
+    def test_only_changed_ranges_are_written(self):
+        with mock.patch('api.v1.views.regenerate_coach_slots') as regenerate:
+            response = self.change_availability([
+                {'weekday': 1, 'start_time': '09:00', 'end_time': '10:00'},
+                {'weekday': 3, 'start_time': '14:30', 'end_time': '16:00'},
+            ])
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(AvailableTimeRange.objects.filter(pk=self.kept.pk).exists())
+            self.assertEqual(sorted(self.coach.available_time_ranges.values_list('weekday', flat=True)), [1, 3])
+            self.assertEqual(regenerate.call_count, 1)
+
+            # nothing changed, nothing to regenerate
+            self.change_availability([
+                {'weekday': 1, 'start_time': '09:00', 'end_time': '10:00'},
+                {'weekday': 3, 'start_time': '14:30', 'end_time': '16:00'},
+            ])
+            self.assertEqual(regenerate.call_count, 1)
+
+    def test_overlapping_ranges_are_rejected(self):
+        response = self.change_availability([
+            {'weekday': 1, 'start_time': '09:00', 'end_time': '10:00'},
+            {'weekday': 1, 'start_time': '09:30', 'end_time': '11:00'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.coach.available_time_ranges.count(), 2)
+
+    def test_common_questions_are_diffed(self):
+        self.c.post('/api/v1/change_common_questions/', ['How?', 'Why?'], content_type='application/json')
+        kept = self.coach.common_questions.get(body='Why?')
+        self.c.post('/api/v1/change_common_questions/', ['Why?', 'When?'], content_type='application/json')
+        self.assertEqual(sorted(self.coach.common_questions.values_list('body', flat=True)), ['When?', 'Why?'])
+        self.assertTrue(self.coach.common_questions.filter(pk=kept.pk).exists())
+
+
+class QuestionClassificationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.c = Client()
+        create_mentor(self.c)
+        coach = Coach.objects.get(user__email='mentor@example.com')
+        ExpertiseFieldMultiple.objects.create(coach=coach, name='Web Development')
+        ExpertiseFieldMultiple.objects.create(coach=coach, name='Databases')
+        self.question = Question.objects.create(body='How do I speed up queries on my database?')
+
+    @override_settings(QUESTION_CLASSIFIER='local')
+    def test_local_classification_is_stored_on_the_question(self):
+        result = classify_question(self.question)
+        self.assertEqual(result['umbrella_term'], 'Databases')
+        self.assertFalse(result['is_weak'])
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.classification['umbrella_term'], 'Databases')
+
+        with mock.patch('api.v1.utils.extract_tags_from_question') as extract:
+            classify_question(self.question)
+        extract.assert_not_called()
+
+    @override_settings(QUESTION_CLASSIFIER='remote')
+    def test_failing_watson_falls_back_to_the_local_classifier(self):
+        with mock.patch('api.v1.utils.get_nlu', side_effect=Exception('Read timed out')):
+            result = classify_question(self.question)
+        self.assertEqual(result['umbrella_term'], 'Databases')
+        self.assertEqual(result['source'], 'local')
+        # watson gets another chance on the next request
+        self.question.refresh_from_db()
+        self.assertIsNone(self.question.classification)
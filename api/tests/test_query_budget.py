@@ -0,0 +1,75 @@
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from comments.models import Comment
+from instructor.models import Coach, CoachApplication
+from posts.models import Post
+from subscribers.models import Subscriber, SubscriberAvatar, Subscription
+from .query_budget import QueryBudgetMixin
+from .test_v1 import create_user, create_mentor, create_mentor_2, get_tokens
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    POSTS_PER_COACH = 3
+
+    def setUp(self):
+        c = Client()
+        self.subscriber = create_user(c)
+        create_mentor(c)
+        create_mentor_2(c)
+        for coach in Coach.objects.all():
+            self.add_posts(coach)
+        self.c = Client(HTTP_AUTHORIZATION=f"Bearer {get_tokens(c)['access']}")
+
+    def add_posts(self, coach):
+        # a subscriber of the coach, notified of each of their posts
+        Coach.objects.filter(pk=coach.pk).update(charges_enabled=True)
+        tier = coach.tiers.first()
+        Subscription.objects.create(subscriber=self.subscriber, tier=tier)
+        tier.subscribers.add(self.subscriber.user)
+        for i in range(self.POSTS_PER_COACH):
+            Post.objects.create(coach=coach, tier=tier, text=f"post {i}")
+
+    def add_coach(self):
+        c = Client()
+        c.post('/rest-auth/registration/', {
+            'email': 'mentor3@example.com',
+            'username': 'mentor3@example.com',
+            'password1': 'fooooo112345',
+            'password2': 'fooooo112345'
+        })
+        application = CoachApplication(subscriber=Subscriber.objects.get(user__email='mentor3@example.com'),
+                                       message="testmessage")
+        application.status = CoachApplication.APPROVED
+        application.approved = True
+        application.save()
+        self.add_posts(Coach.objects.get(user__email='mentor3@example.com'))
+
+    def test_new_posts(self):
+        self.assertWithinQueryBudget(self.c, '/api/v1/new_posts/', grow=self.add_coach)
+
+    def test_coaches(self):
+        self.assertWithinQueryBudget(self.c, '/api/v1/coaches/', grow=self.add_coach)
+
+    def test_notifications(self):
+        self.assertWithinQueryBudget(self.c, '/api/v1/notifications/', grow=self.add_coach)
+
+    @override_settings(QUERY_COUNT_HEADERS=True)
+    def test_query_count_headers(self):
+        response = self.c.get('/api/v1/coaches/')
+        self.assertEqual(response['X-DB-Query-Budget'], '14')
+        self.assertGreater(int(response['X-DB-Query-Count']), 0)
+        self.assertIn('X-DB-Duplicate-Queries', response)
+
+    def test_comment_avatars_are_prefetched(self):
+        post = Post.objects.first()
+        for subscriber in Subscriber.objects.all():
+            avatar = SubscriberAvatar.objects.create(image=f'images/avatars/{subscriber.pk}.png', height=1, width=1)
+            Subscriber.objects.filter(pk=subscriber.pk).update(avatar=avatar)
+            Comment.objects.create(post=post, user=subscriber, text="comment")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get(f'/api/v1/comments/{post.surrogate}/')
+        self.assertEqual(len(response.json()['results']), Subscriber.objects.count())
+        avatar_queries = [query for query in queries if 'subscriberavatar' in query['sql']]
+        self.assertEqual(len(avatar_queries), 1)
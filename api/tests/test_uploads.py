@@ -0,0 +1,108 @@
+from io import BytesIO
+from unittest import mock
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from django.db import DatabaseError
+from django.test import Client, TestCase
+from PIL import Image
+from instructor.models import Coach
+from posts.models import PostImage
+from subscribers.models import Subscriber, SubscriberAvatar
+from uploads.models import Upload
+from .test_v1 import create_mentor, get_mentor_tokens
+
+
+class FakeS3Client:
+    """
+    Keeps the objects in memory, the uploads only use these calls.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def generate_presigned_post(self, Bucket, Key, Fields, Conditions, ExpiresIn):
+        return {'url': 'http://s3.local/bucket', 'fields': {'key': Key, **Fields}}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key])}
+
+    def get_object(self, Bucket, Key):
+        data = self.objects[Key]
+        return {'Body': StreamingBody(BytesIO(data), len(data))}
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.objects[Key] = self.objects[CopySource['Key']]
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+class DirectUploadTestCase(TestCase):
+    def setUp(self):
+        c = Client()
+        create_mentor(c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        tokens = get_mentor_tokens(c)
+        self.c = Client(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.s3 = FakeS3Client()
+        patcher = mock.patch('uploads.s3.get_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload_image(self, kind='post'):
+        response = self.c.post('/api/v1/uploads/', {'kind': kind, 'content_type': 'image/png'},
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        image = BytesIO()
+        Image.new('RGB', (30, 20)).save(image, 'PNG')
+        self.s3.objects[data['presigned_post']['fields']['key']] = image.getvalue()
+        return data['id']
+
+    def test_confirmed_upload_is_attached_to_a_post(self):
+        upload_id = self.upload_image()
+        response = self.c.post(f'/api/v1/uploads/{upload_id}/confirm/')
+        self.assertEqual(response.json()['width'], 30)
+        self.assertEqual(response.json()['height'], 20)
+
+        response = self.c.post('/api/v1/posts/', {'tier': self.coach.tiers.first().id, 'uploads': [upload_id]})
+        self.assertEqual(response.status_code, 201)
+        image = PostImage.objects.get()
+        self.assertEqual((image.width, image.height), (30, 20))
+        self.assertEqual(Upload.objects.get().status, Upload.ATTACHED)
+
+    def test_unconfirmed_upload_can_not_be_attached(self):
+        upload_id = self.upload_image()
+        response = self.c.post('/api/v1/posts/', {'tier': self.coach.tiers.first().id, 'uploads': [upload_id]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PostImage.objects.exists())
+
+    def test_upload_stays_claimable_when_the_post_fails(self):
+        upload_id = self.upload_image()
+        self.c.post(f'/api/v1/uploads/{upload_id}/confirm/')
+        with mock.patch('api.v1.serializers.PostImage.objects.create', side_effect=DatabaseError('insert failed')):
+            with self.assertRaises(DatabaseError):
+                self.c.post('/api/v1/posts/', {'tier': self.coach.tiers.first().id, 'uploads': [upload_id]})
+        self.assertEqual(Upload.objects.get().status, Upload.CONFIRMED)
+
+        response = self.c.post('/api/v1/posts/', {'tier': self.coach.tiers.first().id, 'uploads': [upload_id]})
+        self.assertEqual(response.status_code, 201)
+
+    def test_avatar_uploads_are_stored_under_their_hash(self):
+        for _ in range(2):
+            upload_id = self.upload_image(kind='avatar')
+            self.c.post(f'/api/v1/uploads/{upload_id}/confirm/')
+            # the coach avatar is shared by its hash, the uploaded file isn't downloaded again
+            with mock.patch('common.hashing.read_hash') as read_hash:
+                response = self.c.patch('/api/v1/subscriber/me/', {'avatar_upload': upload_id},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            read_hash.assert_not_called()
+
+        avatar = Subscriber.objects.get(user__email='mentor@example.com').avatar
+        self.assertEqual(SubscriberAvatar.objects.count(), 1)
+        self.assertEqual(avatar.image.name, f'images/avatars/{avatar.content_hash}.png')
+        self.assertEqual(Coach.objects.get(pk=self.coach.pk).avatar.content_hash, avatar.content_hash)
+        self.assertEqual(len(self.s3.objects), 1)
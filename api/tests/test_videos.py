@@ -0,0 +1,49 @@
+from asgiref.sync import async_to_sync
+import asyncio
+from django.test import Client, TransactionTestCase, override_settings
+from instructor.models import Coach
+from posts.models import Post, PostVideoAssetMetaData, PostVideo, PlaybackId
+import channels.layers
+from .test_v1 import create_mentor
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class VideoWebhookTestCase(TransactionTestCase):
+    # the uploader is notified after the video is committed
+    def setUp(self):
+        create_mentor(Client())
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        self.post = Post.objects.create(coach=self.coach, tier=self.coach.tiers.first(), text='video')
+        self.metadata = PostVideoAssetMetaData.objects.create(post=self.post)
+
+    def deliver(self):
+        return Client().post('/api/v1/webhooks/upload_video_webhook/', {
+            'type': 'video.asset.ready',
+            'data': {
+                'id': 'asset-1',
+                'passthrough': str(self.metadata.passthrough),
+                'playback_ids': [{'id': 'playback-1', 'policy': 'public'}, {'id': 'playback-2', 'policy': 'signed'}],
+            },
+        }, content_type='application/json')
+
+    def test_redelivered_asset_is_stored_once(self):
+        channel_layer = channels.layers.get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f"{self.coach.user.surrogate}.notifications.group", channel_name)
+
+        self.assertEqual(self.deliver().status_code, 200)
+        self.assertEqual(self.deliver().status_code, 200)
+
+        video = PostVideo.objects.get()
+        self.assertEqual(video.asset_id, 'asset-1')
+        self.assertEqual(video.post, self.post)
+        self.assertEqual(sorted(PlaybackId.objects.values_list('playback_id', flat=True)), ['playback-1', 'playback-2'])
+        self.assertEqual(Post.objects.get(pk=self.post.pk).status, Post.DONE)
+
+        async def receive():
+            return await asyncio.wait_for(channel_layer.receive(channel_name), timeout=1)
+
+        message = async_to_sync(receive)()
+        self.assertEqual(message['type'], 'send.video_ready')
+        self.assertEqual(message['id'], str(self.post.surrogate))
+        self.assertEqual(message['playback_ids'], ['playback-1', 'playback-2'])
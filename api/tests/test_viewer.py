@@ -0,0 +1,65 @@
+from django.test import Client, RequestFactory, TestCase
+from django.core.cache import cache
+from coach.middleware import Viewer
+from subscribers.entitlements import can_access_tier, can_access_coach
+from instructor.models import Coach
+from subscribers.models import Subscription
+from tiers.models import Tier
+from .test_v1 import create_user, create_mentor, get_tokens
+import json
+
+
+class ViewerTestCase(TestCase):
+    def setUp(self):
+        c = Client()
+        self.subscriber = create_user(c)
+        create_mentor(c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        self.coach.charges_enabled = True
+        self.coach.save()
+        self.tier = Tier.objects.get(coach=self.coach, tier=Tier.TIER1)
+        Subscription.objects.create(subscriber=self.subscriber, tier=self.tier)
+        tokens = get_tokens(c)
+        self.c = Client(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+
+    def test_subscriptions_are_loaded_once_per_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.subscriber.user
+        viewer = Viewer(request)
+        # the subscriber is cached on the user already, the subscriptions load with the benefits of their tiers
+        with self.assertNumQueries(2):
+            self.assertEqual(viewer.tier_for(self.coach), self.tier)
+            self.assertEqual(viewer.tier_for(self.coach), self.tier)
+            self.assertEqual(viewer.subscription_for(self.coach).subscriber, self.subscriber)
+
+    def test_coach_list_shows_the_viewers_tier(self):
+        response = self.c.get('/api/v1/coaches/')
+        coaches = json.loads(response.content)
+        coaches = coaches.get('results', coaches) if isinstance(coaches, dict) else coaches
+        coach = next(coach for coach in coaches if coach['surrogate'] == str(self.coach.surrogate))
+        self.assertEqual(coach['tier'], self.tier.get_tier_display())
+        self.assertEqual(coach['number_of_projects_joined'], 0)
+
+
+class EntitlementTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        c = Client()
+        self.subscriber = create_user(c)
+        create_mentor(c)
+        self.coach = Coach.objects.get(user__email='mentor@example.com')
+        self.tier = Tier.objects.get(coach=self.coach, tier=Tier.TIER1)
+
+    def test_entitlements_are_cached_and_invalidated_on_subscription_changes(self):
+        user = self.subscriber.user
+        self.assertFalse(can_access_tier(user, self.tier.pk))
+        subscription = Subscription.objects.create(subscriber=self.subscriber, tier=self.tier)
+        with self.assertNumQueries(1):
+            self.assertTrue(can_access_tier(user, self.tier.pk))
+            self.assertTrue(can_access_coach(user, self.coach.pk))
+        subscription.delete()
+        self.assertFalse(can_access_tier(user, self.tier.pk))
+
+    def test_coaches_can_access_their_own_tiers(self):
+        self.assertTrue(can_access_tier(self.coach.user, self.tier.pk))
+        self.assertTrue(can_access_coach(self.coach.user, self.coach.pk))
@@ -0,0 +1,149 @@
+"""
+Querysets that load everything their serializers read.
+
+The serializers nest deeply: a post has its coach, the coach its tiers with their benefits, its projects, QA
+sessions and so on. Without prefetching every level runs a query per object, so the queries of a page grow with
+its rows. The querysets here prefetch each level in one query and annotate the counts the serializers return,
+which keeps the queries of a page the same however many rows it has.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Exists, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from notifications.models import Notification
+from accounts.models import User
+from comments.models import Comment
+from instructor.models import Coach
+from posts.models import Post
+from projects.models import Project, MilestoneCompletionReport
+from reacts.models import React
+from subscribers.models import Subscriber, prefetch_xp
+from tiers.models import Tier
+
+
+def subquery_count(queryset, field):
+    """
+    The number of rows of the queryset whose `field` is the outer row, as a subquery.
+    """
+    rows = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(rows.annotate(count=Count('pk')).values('count')), 0)
+
+
+def tiers():
+    return Tier.objects.annotate(posts_count=subquery_count(Post.objects.all(), 'tier')).prefetch_related('benefits')
+
+
+def projects():
+    return Project.objects.annotate(
+        posts_count=subquery_count(Post.objects.all(), 'linked_project'),
+    ).select_related('coach__avatar').prefetch_related('prerequisites', 'milestones')
+
+
+def coaches():
+    return Coach.objects.select_related('expertise_field', 'avatar').prefetch_related(
+        'avatar__variants',
+        'expertise_fields',
+        Prefetch('created_projects', queryset=projects()),
+        Prefetch('tiers', queryset=tiers()),
+        'qa_sessions',
+        'common_questions',
+        'available_time_ranges',
+    )
+
+
+def subscribers():
+    return Subscriber.objects.select_related('avatar').prefetch_related('avatar__variants')
+
+
+def with_authors(queryset):
+    # comments and messages, with their images and the avatars of who wrote them
+    return queryset.select_related('user__avatar').prefetch_related('user__avatar__variants', 'images__variants')
+
+
+def with_members(queryset):
+    # chat rooms and teams, whose members are serialized with their avatars
+    return queryset.prefetch_related(Prefetch('members', queryset=subscribers()))
+
+
+def posts(user, queryset=None, chained=True):
+    """
+    The posts with what PostSerializer reads, `user` is who asks whether they reacted. Posts chained to the
+    posts are loaded one level deep, which is as deep as the apps chain them.
+    """
+    if queryset is None:
+        queryset = Post.objects.all()
+    reacts = React.objects.filter(content_type=ContentType.objects.get_for_model(Post))
+    queryset = queryset.annotate(
+        reacts_count=subquery_count(reacts, 'object_id'),
+        comments_count=subquery_count(Comment.objects.all(), 'post'),
+    ).prefetch_related(
+        Prefetch('coach', queryset=coaches()),
+        Prefetch('linked_project', queryset=projects()),
+        'images__variants',
+        'videos__playback_ids',
+        'tiers',
+    )
+    if user is not None and user.is_authenticated:
+        # like PostSerializer.get_reacted, which doesn't look at the type of the reacted object
+        queryset = queryset.annotate(viewer_reacted=Exists(React.objects.filter(user=user, object_id=OuterRef('pk'))))
+    if chained:
+        queryset = queryset.prefetch_related(
+            Prefetch('chained_posts', queryset=posts(user, chained=False)), 'chained_posts__chained_posts')
+    return queryset
+
+
+def _notification_objects(user):
+    # the querysets of the objects notifications point to, other objects are loaded as they are
+    return {
+        Post: posts(user),
+        Coach: coaches(),
+        Subscriber: subscribers(),
+        User: User.objects.select_related('subscriber__avatar').prefetch_related('subscriber__avatar__variants'),
+        Project: projects(),
+        MilestoneCompletionReport: MilestoneCompletionReport.objects.select_related(
+            'milestone__project', 'team').prefetch_related('members', 'images__variants', 'videos'),
+    }
+
+
+def notifications(queryset):
+    return queryset.prefetch_related(Prefetch('recipient', queryset=User.objects.prefetch_related(
+        Prefetch('coach', queryset=coaches()), Prefetch('subscriber', queryset=subscribers()))))
+
+
+def prefetch_notification_objects(notifications, user):
+    """
+    Loads the actors, targets and action objects of the notifications with one query per type of object, and the
+    xp of the subscribers among them and their recipients.
+    """
+    querysets = _notification_objects(user)
+    fields = [Notification._meta.get_field(name) for name in ('actor', 'target', 'action_object')]
+    wanted = {}
+    for notification in notifications:
+        for field in fields:
+            content_type_id = getattr(notification, field.ct_field + '_id')
+            object_id = getattr(notification, field.fk_field)
+            if content_type_id is not None and object_id is not None:
+                wanted.setdefault(content_type_id, set()).add(object_id)
+
+    loaded = {}
+    for content_type_id, ids in wanted.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        queryset = querysets.get(model, model._default_manager.all())
+        for instance in queryset.filter(pk__in=ids):
+            loaded[content_type_id, str(instance.pk)] = instance
+
+    subscribers = []
+    for notification in notifications:
+        for field in fields:
+            key = (getattr(notification, field.ct_field + '_id'), str(getattr(notification, field.fk_field)))
+            instance = loaded.get(key)
+            # deleted objects aren't loaded, reading them queries and returns None as before
+            if instance is not None:
+                field.set_cached_value(notification, instance)
+                if isinstance(instance, Subscriber):
+                    subscribers.append(instance)
+                elif isinstance(instance, User) and hasattr(instance, 'subscriber'):
+                    subscribers.append(instance.subscriber)
+        recipient = notification.recipient
+        if hasattr(recipient, 'subscriber'):
+            subscribers.append(recipient.subscriber)
+    prefetch_xp(subscribers)
@@ -1,4 +1,5 @@
 from operator import le
+from django.db import transaction
 from django.db.models import Q
 from djmoney.money import Money
 from rest_framework import serializers
@@ -14,7 +15,14 @@ from tiers.models import Tier, Benefit
 from reacts.models import React
 from chat.models import ChatRoom, Message, MessageImage
 from awards.models import Award, AwardBase
-from qa.models import Question, QuestionInvitation, QaSession, CommonQuestion, AvailableTimeRange
+from qa.models import Question, QuestionInvitation, QaSession, CommonQuestion, AvailableTimeRange, AvailabilitySlot
+from qa.diff import find_overlap
+from coach.middleware import get_viewer
+from uploads.models import Upload
+from uploads import s3 as uploads
+from common.derivatives import srcset
+from common import hashing
+from payments.models import PriceMigration
 from babel.numbers import get_currency_precision
 import channels.layers
 import stripe
@@ -25,6 +33,15 @@ import os
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
 
+def claim_uploads(user, surrogates, kind):
+    # the images uploaded straight to S3 through the uploads endpoints, claimed in the transaction that creates
+    # what they are attached to so they stay claimable when that fails
+    try:
+        return uploads.claim(user, surrogates, kind)
+    except uploads.UploadError as e:
+        raise serializers.ValidationError({'uploads': str(e)})
+
+
 def money_to_integer(money):
     try:
         return int(
@@ -57,11 +74,54 @@ class AvailableTimeRangeSerializer(serializers.ModelSerializer):
         model = AvailableTimeRange
         fields = ['id', 'weekday', 'start_time', 'end_time']
 
+    def validate(self, data):
+        if data['end_time'] <= data['start_time']:
+            raise serializers.ValidationError('The end time must be after the start time')
+        return data
+
+
+class AvailableTimeRangesSerializer(serializers.Serializer):
+    availability_ranges = AvailableTimeRangeSerializer(many=True)
+
+    def validate_availability_ranges(self, value):
+        overlap = find_overlap(value)
+        if overlap:
+            first, second = overlap
+            raise serializers.ValidationError(
+                f"The ranges {first['start_time']:%H:%M}-{first['end_time']:%H:%M} and "
+                f"{second['start_time']:%H:%M}-{second['end_time']:%H:%M} of weekday {first['weekday']} overlap")
+        return value
+
+
+class AvailabilitySlotSerializer(serializers.ModelSerializer):
+    coach = serializers.UUIDField(source='coach.surrogate')
+    coach_name = serializers.CharField(source='coach.name')
+
+    class Meta:
+        model = AvailabilitySlot
+        fields = ['start', 'end', 'coach', 'coach_name']
+
+
+class AvailableCoachesQuerySerializer(serializers.Serializer):
+    # the length of the call, in minutes, a longer call than a day can't fit in the time range of a weekday
+    minutes = serializers.IntegerField(default=60, min_value=1, max_value=24 * 60)
+
+
+class NextAvailableSlotsQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(default=10)
+    coach = serializers.UUIDField(required=False)
+    expertise = serializers.CharField(required=False)
+
+    def validate_limit(self, value):
+        # at most 50 slots are returned whatever is asked for
+        return max(1, min(value, 50))
+
 
 class CoachSerializer(serializers.ModelSerializer):
     expertise_field = serializers.StringRelatedField()
     expertise_fields = serializers.SerializerMethodField()
     avatar = serializers.SerializerMethodField()
+    avatar_srcset = serializers.SerializerMethodField()
     projects = serializers.SerializerMethodField()
     tier = serializers.SerializerMethodField()
     tiers = serializers.SerializerMethodField()
@@ -78,6 +138,12 @@ class CoachSerializer(serializers.ModelSerializer):
             return coach.avatar.image.url
         return None
 
+    @staticmethod
+    def get_avatar_srcset(coach):
+        if coach.avatar:
+            return srcset(coach.avatar)
+        return None
+
     def get_projects(self, coach):
         context = {
             "request": self.context["request"]
@@ -85,32 +151,25 @@ class CoachSerializer(serializers.ModelSerializer):
         return ProjectSerializer(coach.created_projects.all(), many=True, context=context).data
 
     def get_tier(self, coach):
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                if user.subscriber.subscriptions.filter(tier__coach=coach).exists():
-                    return user.subscriber.subscriptions.filter(tier__coach=coach).first().tier.get_tier_display()
-        except KeyError:
-            return None
+        viewer = get_viewer(self.context.get('request'))
+        tier = viewer and viewer.tier_for(coach)
+        if tier:
+            return tier.get_tier_display()
+        return None
 
     def get_tier_full(self, coach):
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                if user.subscriber.subscriptions.filter(tier__coach=coach).exists():
-                    return TierSerializer(user.subscriber.subscriptions.filter(tier__coach=coach).first().tier).data
-        except KeyError:
-            return None
+        viewer = get_viewer(self.context.get('request'))
+        tier = viewer and viewer.tier_for(coach)
+        if tier:
+            return TierSerializer(tier).data
+        return None
 
     def get_coupon(self, coach):
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                coupon = Coupon.objects.filter(subscriber=user.subscriber, coach=coach)
-                if coupon.exists():
-                    return CouponSerializer(coupon.first()).data
-        except KeyError:
-            return None
+        viewer = get_viewer(self.context.get('request'))
+        coupon = viewer and viewer.coupon_for(coach)
+        if coupon:
+            return CouponSerializer(coupon).data
+        return None
 
     def get_qa_sessions(self, coach):
         context = {
@@ -137,20 +196,17 @@ class CoachSerializer(serializers.ModelSerializer):
     # this is used for frontend validation because Tier 1 subscribers only have access to one project
     # and free subs have access to none
     def get_number_of_projects_joined(self, coach):
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                if user.subscriber.subscriptions.filter(tier__coach=coach).exists():
-                    return Team.objects.filter(project__coach=coach, members__in=[user.subscriber]).count()
-        except KeyError:
-            return None
+        viewer = get_viewer(self.context.get('request'))
+        if viewer and viewer.subscription_for(coach):
+            return viewer.projects_joined(coach)
+        return None
 
     def get_tiers(self, coach):
         return TierSerializer(coach.tiers.all(), many=True).data
 
     class Meta:
         model = Coach
-        fields = ['name', 'avatar', 'bio', 'expertise_field', 'expertise_fields', 'projects', 'number_of_projects_joined',
+        fields = ['name', 'avatar', 'avatar_srcset', 'bio', 'expertise_field', 'expertise_fields', 'projects', 'number_of_projects_joined',
                   'tier', 'tier_full', 'tiers', 'qa_sessions', 'available_time_ranges', 'common_questions', 'surrogate', 
                   'charges_enabled', 'coupon', 'seen_welcome_page', 'submitted_expertise', 'qa_session_credit']
 
@@ -172,6 +228,7 @@ class CoachApplicationSerializer(serializers.ModelSerializer):
 
 class SubscriberSerializer(serializers.ModelSerializer):
     avatar = serializers.SerializerMethodField()
+    avatar_srcset = serializers.SerializerMethodField()
     id = serializers.SerializerMethodField()
 
     def get_id(self, subscriber):
@@ -183,9 +240,15 @@ class SubscriberSerializer(serializers.ModelSerializer):
             return sub.avatar.image.url
         return None
 
+    @staticmethod
+    def get_avatar_srcset(sub):
+        if sub.avatar:
+            return srcset(sub.avatar)
+        return None
+
     class Meta:
         model = Subscriber
-        fields = ['name', 'avatar', 'xp', 'level', 'level_progression', 'id']
+        fields = ['name', 'avatar', 'avatar_srcset', 'xp', 'level', 'level_progression', 'id']
         read_only_fields = ['id', 'xp', 'level', 'level_progression']
 
 
@@ -197,27 +260,35 @@ class SubscriberAvatarSerializer(serializers.ModelSerializer):
 
 class SubscriberUpdateSerializer(serializers.ModelSerializer):
     avatar = serializers.ImageField(required=False)
+    avatar_upload = serializers.UUIDField(required=False, write_only=True)
     id = serializers.SerializerMethodField()
 
     def get_id(self, subscriber):
         return subscriber.surrogate
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         try:
             avatar = validated_data.pop('avatar')
-            new_avatar = SubscriberAvatar.objects.create(
-                subscriber=instance, image=avatar)
-            #instance.avatar.image = avatar
+            # uploading the current avatar again keeps the avatar
+            if instance.avatar is None or instance.avatar.get_content_hash() != hashing.content_hash(avatar):
+                SubscriberAvatar.objects.create(subscriber=instance, image=avatar)
         except KeyError:
             pass
 
+        avatar_upload = validated_data.pop('avatar_upload', None)
+        if avatar_upload:
+            upload, = claim_uploads(self.context['request'].user, [avatar_upload], Upload.AVATAR)
+            if instance.avatar is None or instance.avatar.get_content_hash() != upload.content_hash:
+                SubscriberAvatar.objects.create(subscriber=instance, **uploads.image_fields(upload))
+
         instance = super(SubscriberUpdateSerializer, self).update(
             instance, validated_data)
         return instance
 
     class Meta:
         model = Subscriber
-        fields = ['name', 'avatar', 'id']
+        fields = ['name', 'avatar', 'avatar_upload', 'id']
         read_only_fields = ['id']
 
 
@@ -286,6 +357,10 @@ class PrerequisiteSerializer(serializers.ModelSerializer):
 
 class MilestoneCompletionImageSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, image):
+        return srcset(image)
 
     def get_image(self, milestone_report):
         if milestone_report.image:
@@ -294,7 +369,7 @@ class MilestoneCompletionImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = MilestoneCompletionImage
-        fields = ['width', 'height', 'image']
+        fields = ['width', 'height', 'image', 'srcset']
 
 
 class MilestoneCompletionPlaybackSerializer(serializers.ModelSerializer):
@@ -316,7 +391,10 @@ class CreateMilestoneCompletionReportSerializer(serializers.ModelSerializer):
         child=serializers.UUIDField(), write_only=True)
     images = serializers.ListField(
         child=serializers.ImageField(), write_only=True, required=False)
+    uploads = serializers.ListField(
+        child=serializers.UUIDField(), write_only=True, required=False)
 
+    @transaction.atomic
     def create(self, validated_data):
         milestone_id = self.context['milestone_id']
 
@@ -324,6 +402,7 @@ class CreateMilestoneCompletionReportSerializer(serializers.ModelSerializer):
             images = validated_data.pop('images')
         except KeyError:
             images = []
+        uploaded = claim_uploads(self.context['request'].user, validated_data.pop('uploads', []), Upload.MILESTONE)
 
         try:
             members = validated_data.pop('members')
@@ -337,6 +416,9 @@ class CreateMilestoneCompletionReportSerializer(serializers.ModelSerializer):
         for image in images:
             MilestoneCompletionImage.objects.create(
                 milestone_completion_report=milestone_report, image=image)
+        for upload in uploaded:
+            MilestoneCompletionImage.objects.create(
+                milestone_completion_report=milestone_report, **uploads.image_fields(upload))
 
         for member in members:
             _member = Subscriber.objects.filter(surrogate=member)
@@ -351,7 +433,7 @@ class CreateMilestoneCompletionReportSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = MilestoneCompletionReport
-        fields = ['surrogate', 'members', 'team', 'message', 'milestone', 'images']
+        fields = ['surrogate', 'members', 'team', 'message', 'milestone', 'images', 'uploads']
         read_only_fields = ['milestone', 'surrogate', 'team']
 
 
@@ -429,23 +511,19 @@ class ProjectSerializer(serializers.ModelSerializer):
         return project.get_difficulty_display()
 
     def get_linked_posts_count(self, project):
+        # annotated by api.v1.querysets.projects
+        if hasattr(project, 'posts_count'):
+            return project.posts_count
         return project.posts.count()
 
     def get_coach_data(self, project):
         number_of_projects_joined = None
         my_tier = None
 
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                if user.subscriber.subscriptions.filter(tier__coach=project.coach).exists():
-                    subscription = user.subscriber.subscriptions.filter(
-                        tier__coach=project.coach).first()
-                    my_tier = subscription.tier
-                    number_of_projects_joined = Team.objects.filter(
-                        project__coach=project.coach, members__in=[user.subscriber]).count()
-        except KeyError:
-            number_of_projects_joined = None
+        viewer = get_viewer(self.context.get('request'))
+        if viewer and viewer.subscription_for(project.coach):
+            my_tier = viewer.tier_for(project.coach)
+            number_of_projects_joined = viewer.projects_joined(project.coach)
 
         return {'number_of_projects_joined': number_of_projects_joined, "id": project.coach.surrogate, "my_tier": TierSerializer(my_tier).data}
 
@@ -651,6 +729,10 @@ class CreateOrUpdateProjectSerializer(serializers.ModelSerializer):
 
 class PostImageSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, image):
+        return srcset(image)
 
     def get_image(self, post_image):
         if post_image.image:
@@ -659,7 +741,7 @@ class PostImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = PostImage
-        fields = ['height', 'width', 'image']
+        fields = ['height', 'width', 'image', 'srcset']
 
 
 class PlaybackSerializer(serializers.ModelSerializer):
@@ -707,6 +789,9 @@ class PostSerializer(serializers.ModelSerializer):
     def get_reacted(self, post):
         try:
             user = self.context['request'].user
+            # annotated by api.v1.querysets.posts
+            if hasattr(post, 'viewer_reacted'):
+                return post.viewer_reacted
             if user.reacts.filter(object_id=post.id, user=user).exists():
                 return True
             return False
@@ -714,9 +799,13 @@ class PostSerializer(serializers.ModelSerializer):
             return None
 
     def get_reacts(self, post):
+        if hasattr(post, 'reacts_count'):
+            return post.reacts_count
         return post.reacts.count()
 
     def get_comment_count(self, post):
+        if hasattr(post, 'comments_count'):
+            return post.comments_count
         return post.comments.count()
 
     class Meta:
@@ -782,6 +871,8 @@ class PostCreateSerializer(serializers.ModelSerializer):
     coach = CoachSerializer(required=False)
     images = serializers.ListField(
         child=serializers.ImageField(), write_only=True, required=False)
+    uploads = serializers.ListField(
+        child=serializers.UUIDField(), write_only=True, required=False)
     # tier = serializers.IntegerField(required=True)
     linked_project = serializers.UUIDField(required=False)
     has_videos = serializers.BooleanField(required=False)
@@ -797,13 +888,15 @@ class PostCreateSerializer(serializers.ModelSerializer):
 
     # FIXME
     # This should also return the whole linked_project as a ProjectSerializer instead of just the name
+    @transaction.atomic
     def create(self, validated_data):
         coach = self.context['request'].user.coach
 
         if not validated_data.get('tier'):
             raise serializers.ValidationError({'error': 'A tier is required'})
         
-        if not validated_data.get('text') and not validated_data.get('images') and not validated_data.get('has_videos'):
+        if not validated_data.get('text') and not validated_data.get('images') and not validated_data.get('uploads') \
+                and not validated_data.get('has_videos'):
             raise serializers.ValidationError({'error': 'Post contains no data'})
         
         try:
@@ -819,6 +912,7 @@ class PostCreateSerializer(serializers.ModelSerializer):
             images = validated_data.pop('images')
         except KeyError:
             images = []
+        uploaded = claim_uploads(self.context['request'].user, validated_data.pop('uploads', []), Upload.POST)
 
         # try:
         #     tiers = validated_data.pop('tiers')
@@ -846,13 +940,15 @@ class PostCreateSerializer(serializers.ModelSerializer):
 
         for image in images:
             PostImage.objects.create(post=post, coach=coach, image=image)
+        for upload in uploaded:
+            PostImage.objects.create(post=post, coach=coach, **uploads.image_fields(upload))
         # post.tiers.set(tiers)
 
         return post
 
     class Meta:
         model = Post
-        fields = ['tier', 'text', 'images', 'videos', 'id',
+        fields = ['tier', 'text', 'images', 'uploads', 'videos', 'id',
                   'linked_project', 'chained_posts', 'coach', 'has_videos']
         read_only_fields = ['id', 'chained_posts', 'coach',
                             'videos', 'reacted', 'reacts', 'status']
@@ -963,6 +1059,10 @@ class NewPostsSerializer(serializers.Serializer):
 
 class CommentImageSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, image):
+        return srcset(image)
 
     def get_image(self, comment_image):
         if comment_image.image:
@@ -971,7 +1071,7 @@ class CommentImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = CommentImage
-        fields = ['height', 'width', 'image']
+        fields = ['height', 'width', 'image', 'srcset']
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -1009,6 +1109,8 @@ class CommentSerializer(serializers.ModelSerializer):
 class CreateCommentSerializer(serializers.ModelSerializer):
     user = SubscriberSerializer(required=False)
     images = CommentImageSerializer(many=True, required=False)
+    uploads = serializers.ListField(
+        child=serializers.UUIDField(), write_only=True, required=False)
     id = serializers.SerializerMethodField(required=False)
     parent = serializers.UUIDField(required=False)
     post = serializers.UUIDField(required=True)
@@ -1019,6 +1121,7 @@ class CreateCommentSerializer(serializers.ModelSerializer):
     def get_parent(self, comment):
         return comment.id
 
+    @transaction.atomic
     def create(self, validated_data):
         user = self.context['request'].user
         post = Post.objects.filter(surrogate=validated_data.pop('post')).first()
@@ -1038,15 +1141,19 @@ class CreateCommentSerializer(serializers.ModelSerializer):
         # if this comment is a reply to another comment get the parent posts author
         reply_to = parent.user if parent else None
 
+        uploaded = claim_uploads(user, validated_data.pop('uploads', []), Upload.COMMENT)
+
         comment = Comment.objects.create(
             user=user.subscriber, parent=parent, post=post, reply_to=reply_to, **validated_data)
         comment.images.set(images)
+        for upload in uploaded:
+            CommentImage.objects.create(comment=comment, **uploads.image_fields(upload))
 
         return comment
 
     class Meta:
         model = Comment
-        fields = ['text', 'images', 'user', 'post', 'parent', 'id', 'level']
+        fields = ['text', 'images', 'uploads', 'user', 'post', 'parent', 'id', 'level']
         read_only_fields = ['user', 'id', 'level']
 
 
@@ -1098,17 +1205,10 @@ class MyProjectsSerializer(serializers.ModelSerializer):
         number_of_projects_joined = None
         my_tier = None
 
-        try:
-            user = self.context['request'].user
-            if user.is_authenticated:
-                if user.subscriber.subscriptions.filter(tier__coach=project.coach).exists():
-                    subscription = user.subscriber.subscriptions.filter(
-                        tier__coach=project.coach).first()
-                    my_tier = subscription.tier
-                    number_of_projects_joined = Team.objects.filter(
-                        project__coach=project.coach, members__in=[user.subscriber]).count()
-        except KeyError:
-            number_of_projects_joined = None
+        viewer = get_viewer(self.context.get('request'))
+        if viewer and viewer.subscription_for(project.coach):
+            my_tier = viewer.tier_for(project.coach)
+            number_of_projects_joined = viewer.projects_joined(project.coach)
 
         return {'number_of_projects_joined': number_of_projects_joined, "id": project.coach.surrogate, "my_tier": TierSerializer(my_tier).data}
 
@@ -1122,6 +1222,9 @@ class MyProjectsSerializer(serializers.ModelSerializer):
         return obj.get_difficulty_display()
 
     def get_linked_posts_count(self, project):
+        # annotated by api.v1.querysets.projects
+        if hasattr(project, 'posts_count'):
+            return project.posts_count
         return project.posts.count()
 
     class Meta:
@@ -1281,7 +1384,10 @@ class TierSerializer(serializers.ModelSerializer):
         return obj.get_tier_display()
 
     def get_post_count(self, tier):
-        return tier.posts.count()
+        # annotated by api.v1.querysets.tiers, counted once per instance otherwise
+        if not hasattr(tier, 'posts_count'):
+            tier.posts_count = tier.posts.count()
+        return tier.posts_count
 
     class Meta:
         model = Tier
@@ -1318,27 +1424,7 @@ class UpdateTierSerializer(serializers.ModelSerializer):
                 if description:
                     Benefit.objects.create(tier=instance, description=description)
 
-        try:
-            credit = validated_data.pop('credit')
-            if instance.credit != credit:
-                if isinstance(credit, Decimal):
-                    price = stripe.Price.create(
-                        unit_amount=money_to_integer(credit),
-                        currency='eur',
-                        recurring={"interval": "month"},
-                        product=instance.product_id,
-                    )
-                else:
-                    price = stripe.Price.create(
-                        unit_amount=money_to_integer(credit),
-                        currency=credit.currency.code.lower(),
-                        recurring={"interval": "month"},
-                        product=instance.product_id,
-                    )
-                instance.price_id = price.id
-        except KeyError:
-            pass
-
+        # a changed credit is picked up by Tier.save which records the new stripe price
         instance = super(UpdateTierSerializer, self).update(
             instance, validated_data)
         return instance
@@ -1356,6 +1442,27 @@ class UpdateTierSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'tier', 'tier_full']
 
 
+class UploadSerializer(serializers.ModelSerializer):
+    id = serializers.UUIDField(source='surrogate', read_only=True)
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'kind', 'status', 'content_type', 'size', 'height', 'width']
+        read_only_fields = ['id', 'status', 'size', 'height', 'width']
+
+
+class PriceMigrationSerializer(serializers.ModelSerializer):
+    status_display = serializers.SerializerMethodField()
+
+    def get_status_display(self, obj):
+        return obj.get_status_display()
+
+    class Meta:
+        model = PriceMigration
+        fields = ['surrogate', 'status', 'status_display', 'new_price_id', 'total', 'migrated', 'failed',
+                  'last_error', 'created', 'updated', 'finished']
+
+
 class ChatRoomSerializer(serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
     project = serializers.SerializerMethodField()
@@ -1376,9 +1483,14 @@ class ChatRoomSerializer(serializers.ModelSerializer):
 
 
 class MessageImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, image):
+        return srcset(image)
+
     class Meta:
         model = MessageImage
-        fields = ['image', 'height', 'width']
+        fields = ['image', 'height', 'width', 'srcset']
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -1401,34 +1513,40 @@ class CreateMessageSerializer(serializers.ModelSerializer):
     # message = MessageSerializer(required=False)
     images = serializers.ListField(
         child=serializers.ImageField(), write_only=False, required=False)
+    uploads = serializers.ListField(
+        child=serializers.UUIDField(), write_only=True, required=False)
     chat_room = serializers.UUIDField(required=False)
 
     def create(self, validated_data):
-        user = self.context['request'].user.subscriber
+        # the message and its images are committed before the chat is told about them
+        with transaction.atomic():
+            user = self.context['request'].user.subscriber
 
-        try:
-            images = validated_data.pop('images')
-        except KeyError:
-            images = []
+            try:
+                images = validated_data.pop('images')
+            except KeyError:
+                images = []
+            uploaded = claim_uploads(self.context['request'].user, validated_data.pop('uploads', []), Upload.MESSAGE)
 
-        try:
-            chat_room_surrogate = validated_data.pop('chat_room')
-        except KeyError:
-            chat_room_surrogate = None
+            try:
+                chat_room_surrogate = validated_data.pop('chat_room')
+            except KeyError:
+                chat_room_surrogate = None
 
-        if chat_room_surrogate:
-            chat_room = ChatRoom.objects.filter(surrogate=chat_room_surrogate)
+            if chat_room_surrogate:
+                chat_room = ChatRoom.objects.filter(surrogate=chat_room_surrogate)
 
-        message = Message.objects.create(
-            user=user, chat_room=chat_room.first(), **validated_data)
+            message = Message.objects.create(
+                user=user, chat_room=chat_room.first(), **validated_data)
 
-        # images_sent will be the object sent to the channel group
-        images_sent = []
-        for image in images:
-            message_image = MessageImage.objects.create(
-                message=message, image=image)
-            images_sent.append({'height': message_image.height,
-                               'width': message_image.width, 'image': message_image.image.url})
+            # images_sent will be the object sent to the channel group
+            images_sent = []
+            message_images = [MessageImage.objects.create(message=message, image=image) for image in images]
+            message_images += [MessageImage.objects.create(message=message, **uploads.image_fields(upload))
+                               for upload in uploaded]
+            for message_image in message_images:
+                images_sent.append({'height': message_image.height,
+                                   'width': message_image.width, 'image': message_image.image.url})
 
         channel_layer = channels.layers.get_channel_layer()
         # after message is created send it back to the group chat
@@ -1453,7 +1571,7 @@ class CreateMessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ['created', 'updated', 'chat_room', 'user', 'text', 'images']
+        fields = ['created', 'updated', 'chat_room', 'user', 'text', 'images', 'uploads']
         read_only_fields = ['created', 'updated', 'user']
 
 
@@ -0,0 +1,204 @@
+"""
+Handlers of the stripe webhook events, run by the `process_stripe_events` worker.
+Stripe may deliver an event more than once and a failed handler is retried, so the handlers
+check what has been done already before repeating it.
+"""
+from django.core.mail import send_mail
+from subscribers.models import Subscriber, Subscription
+from instructor.models import Coach
+from projects.models import Project, Coupon
+from tiers.models import Tier
+from qa.models import Question, QaSession
+from qa.slots import book_slots
+from payments.webhooks import handles
+from .views import handle_join_project, send_notification_on_subscribe
+from .utils import create_meeting
+import stripe
+import json
+import datetime
+
+
+@handles('payment_intent.payment_failed')
+def payment_intent_failed(event):
+    payment_intent_id = event.data.object['id']
+    stripe.PaymentIntent.modify(
+        payment_intent_id,
+        metadata={
+            'troosh_status': 'payment_failed'
+        }
+    )
+
+
+@handles('payment_intent.succeeded')
+def payment_intent_succeeded(event):
+    payment_intent_id = event.data.object['id']
+    payment_intent = stripe.PaymentIntent.retrieve(
+        payment_intent_id,
+    )
+    payment_type = payment_intent.metadata.get('type')
+    if payment_type == 'project':
+        project_id = payment_intent.metadata['id']
+        subscriber = payment_intent.metadata['subscriber']
+        subscriber = Subscriber.objects.filter(
+            surrogate=subscriber).first()
+        project = Project.objects.filter(surrogate=project_id).first()
+        if project:
+            # a redelivered event must not put the subscriber in a second team
+            if not project.teams.filter(members=subscriber).exists():
+                handle_join_project(project, subscriber)
+            stripe.PaymentIntent.modify(
+                payment_intent_id,
+                metadata={
+                    'troosh_status': 'completed'
+                }
+            )
+        else:
+            print(f"Project with id {project_id} not found")
+
+
+@handles('checkout.session.completed')
+def checkout_session_completed(event):
+    data_object = event.data.object
+    checkout_session = stripe.checkout.Session.retrieve(
+        data_object['id'],
+        expand=['customer']
+    )
+    # get customer so we can send him an email with the zoom link
+    customer = checkout_session['customer']
+    qa_session = QaSession.objects.get(
+        surrogate=data_object.metadata['id'])
+    question = Question.objects.get(
+        surrogate=data_object.metadata['question_id'])
+
+    # the meeting of a redelivered event has been created already
+    if question.zoom_link:
+        zoom_meeting_data = {'url': question.zoom_link, 'password': question.zoom_password,
+                             'start_time': question.initial_delivery_time}
+    else:
+        zoom_end_time = question.initial_delivery_time + \
+            datetime.timedelta(minutes=int(qa_session.minutes))
+        question.delivery_time = zoom_end_time
+        question.delivered_by = qa_session.coach
+        question.save()
+        zoom_meeting_data = create_meeting(
+            question.initial_delivery_time, qa_session.minutes, qa_session.coach)
+
+        # also save zoom data in admin
+        question.zoom_link = zoom_meeting_data['url']
+        question.zoom_password = zoom_meeting_data['password']
+        question.save()
+        # the coach's slots during the call can't be booked anymore
+        book_slots(question)
+
+    # send email to the customer
+    send_mail(
+        f"Your zoom call with {qa_session.coach.name}",
+        f"""
+        Here is your zoom meeting:
+
+        Start time: {zoom_meeting_data['start_time'].strftime("%m/%d/%Y, %H:%M:%S")} UTC
+        Duration: {qa_session.minutes}
+        Link: {zoom_meeting_data['url']}
+        Password: {zoom_meeting_data['password']}
+
+        For any questions feel free to reply to this email!
+        """,
+        'beta@troosh.app',
+        [customer['email']],
+        fail_silently=False,
+    )
+
+    # send email to mentor
+    send_mail(
+        f"You got a zoom call coming up!",
+        f"""
+        Here is your zoom meeting for the following question:
+        "{question.body}"
+
+        Start time: {zoom_meeting_data['start_time'].strftime("%m/%d/%Y, %H:%M:%S")} UTC
+        Duration: {qa_session.minutes}
+        Link: {zoom_meeting_data['url']}
+        Password: {zoom_meeting_data['password']}
+
+        For any questions feel free to reply to this email!
+        """,
+        'beta@troosh.app',
+        [qa_session.coach.user.email],
+        fail_silently=False,
+    )
+
+
+@handles('invoice.payment_failed')
+def invoice_payment_failed(event):
+    data_object = event.data.object
+    if data_object['billing_reason'] == 'subscription_create' or data_object['billing_reason'] == 'subscription_update':
+        subscription_id = data_object['subscription']
+
+        stripe.Subscription.modify(
+            subscription_id,
+            metadata={
+                'troosh_status': 'payment_failed'
+            }
+        )
+
+
+@handles('invoice.payment_succeeded')
+def invoice_payment_succeeded(event):
+    data_object = event.data.object
+    if data_object['billing_reason'] == 'subscription_create' or data_object['billing_reason'] == 'subscription_update':
+        # The subscription automatically activates after successful payment
+        subscription_id = data_object['subscription']
+
+        subscription = stripe.Subscription.retrieve(subscription_id)
+        subscriber = subscription.metadata['subscriber']
+        tier = subscription.metadata['tier']
+        subscriber = Subscriber.objects.filter(
+            surrogate=subscriber).first()
+        tier = Tier.objects.filter(surrogate=tier).first()
+
+        existing_subscription = Subscription.objects.filter(
+            subscriber=subscriber, tier__coach=tier.coach)
+        if existing_subscription.exists():
+            existing_subscription = existing_subscription.first()
+            existing_subscription.subscription_id = subscription.id
+            existing_subscription.json_data = json.dumps(subscription)
+            existing_subscription.tier = tier
+            existing_subscription.price_id = tier.price_id
+            existing_subscription.save()
+        else:
+            created_subscription = Subscription.objects.create(subscriber=subscriber, subscription_id=subscription.id,
+                                                               customer_id=subscriber.customer_id, json_data=json.dumps(
+                                                                   subscription),
+                                                               tier=tier, price_id=tier.price_id)
+            send_notification_on_subscribe(
+                subscriber, tier, created_subscription)
+
+        if tier.tier != Tier.FREE:
+            coupon = None
+            if not Coupon.objects.filter(subscriber=subscriber, coach=tier.coach).exists():
+                # the key makes a retried event reuse the coupon created by the failed attempt
+                coupon = stripe.Coupon.create(
+                    percent_off=100,
+                    duration="once",
+                    idempotency_key=f"{event.id}-coupon",
+                )
+            if coupon:
+                Coupon.objects.create(coach=tier.coach, subscriber=subscriber,
+                                      coupon_id=coupon.id, valid=coupon.valid, json_data=json.dumps(coupon))
+
+        # Update the status of the subscription
+        stripe.Subscription.modify(
+            subscription_id,
+            metadata={
+                'troosh_status': 'completed'
+            }
+        )
+
+
+@handles('account.updated')
+def account_updated(event):
+    data_object = event.data.object
+    charges_enabled = data_object.get('charges_enabled', '')
+    coach = Coach.objects.get(stripe_id=data_object.get('id', ''))
+    coach.charges_enabled = charges_enabled
+    coach.save()
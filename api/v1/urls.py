@@ -81,6 +81,9 @@ urlpatterns = [
     path('v1/get_stripe_balance/', views.get_stripe_balance,
          name="get_stripe_balance"),
     path('v1/get_stripe_login_link/', views.get_stripe_login, name="get_stripe_login_link"),
+    path('v1/tiers/<uuid:id>/price_migration/', views.get_tier_price_migration, name="tier_price_migration"),
+    path('v1/uploads/', views.create_upload, name="create_upload"),
+    path('v1/uploads/<uuid:id>/confirm/', views.confirm_upload, name="confirm_upload"),
     path('v1/posts/<uuid:id>/change_react/', views.change_or_delete_react, name="change_or_delete_react"),
     path('v1/comment/<uuid:id>/change_react/', views.change_or_delete_comment_react, name="change_or_delete_comment_react"),
     path('v1/milestone_report/<uuid:milestone_report_id>/update/', views.update_milestone_report_from_task_id, name="update_milestone_report_from_task_id"),
@@ -95,6 +98,8 @@ urlpatterns = [
          views.check_available_coaches_for_question, name="check_available_coaches_for_question"),
     path('v1/change_availability_time_ranges/',
          views.change_coach_qa_availability, name="change_availability_time_ranges"),
+    path('v1/next_available_slots/',
+         views.next_available_slots, name="next_available_slots"),
     path('v1/change_common_questions/',
          views.change_common_questions, name="change_common_questions"),
 ]
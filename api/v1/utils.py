@@ -1,6 +1,10 @@
 from ibm_watson import NaturalLanguageUnderstandingV1
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from ibm_watson.natural_language_understanding_v1 import Features, ClassificationsOptions, CategoriesOptions, KeywordsOptions
+from django.conf import settings
+from coach.metrics import outbound_call
+from expertisefields import classifier
+from qa.models import Question
 import datetime
 import requests
 import json
@@ -10,23 +14,35 @@ api_key = os.environ.get('WATSON_KEY')
 url = os.environ.get('WATSON_URL')
 model_id = os.environ.get('WATSON_MODEL_ID')
 
+# the client authenticates once and keeps its token, so it is shared by all the requests
+nlu = None
+
+
+def get_nlu():
+    global nlu
+    if nlu is None:
+        auth = IAMAuthenticator(api_key)
+        client = NaturalLanguageUnderstandingV1(
+            version='2021-03-25', authenticator=auth)
+        client.set_service_url(url)
+        # past this budget the question is classified locally instead
+        client.set_http_config({'timeout': settings.WATSON_TIMEOUT_SECONDS})
+        nlu = client
+    return nlu
 
-def extract_tags_from_question(question):
-    auth = IAMAuthenticator(api_key)
-    nlu = NaturalLanguageUnderstandingV1(
-        version='2021-03-25', authenticator=auth)
-    nlu.set_service_url(url)
 
-    # print("Successfully connected with the NLU service")
+def watson_tags_from_question(question):
     try:
-        analysis = nlu.analyze(text=question, features=Features(
-            classifications=ClassificationsOptions(model=model_id))).get_result()
+        with outbound_call('watson', 'extract_tags_from_question'):
+            analysis = get_nlu().analyze(text=question, features=Features(
+                classifications=ClassificationsOptions(model=model_id))).get_result()
     except Exception as e:
         return {
             'tags': [],
             'umbrella_term': '',
             'is_weak': False,
-            'status': 'error'
+            'status': 'error',
+            'source': 'watson'
         }
     weak_results = False
     try:
@@ -40,7 +56,8 @@ def extract_tags_from_question(question):
             'tags': tags[:-1],
             'umbrella_term': umbrella_term,
             'is_weak': weak_results,
-            'status': 'success'
+            'status': 'success',
+            'source': 'watson'
         }
     except Exception as e:
         print(e)
@@ -48,10 +65,48 @@ def extract_tags_from_question(question):
             'tags': [],
             'umbrella_term': '',
             'is_weak': weak_results,
-            'status': 'error'
+            'status': 'error',
+            'source': 'watson'
         }
 
+
+def local_tags_from_question(question):
+    return dict(classifier.classify(question), source='local')
+
+
+def extract_tags_from_question(question):
+    # 'local' only uses the expertise field names, 'local_first' asks watson only when they don't match well
+    # and 'remote' asks watson, falling back to the local classifier when it errors or times out
+    mode = settings.QUESTION_CLASSIFIER
+    if mode in ('local', 'local_first'):
+        result = local_tags_from_question(question)
+        if mode == 'local' or (result['status'] == 'success' and not result['is_weak']):
+            return result
+
+    result = watson_tags_from_question(question)
+    if result['status'] == 'error':
+        local_result = local_tags_from_question(question)
+        if local_result['status'] == 'success':
+            return local_result
+    return result
+
+
+def classify_question(question):
+    """
+    Classifies the question once and stores the result on it, clients poll the available coaches
+    of a question so it would be classified over and over otherwise.
+    """
+    if question.classification:
+        return question.classification
+    result = extract_tags_from_question(question.body)
+    # a local fallback for a slow watson isn't stored so the next request gives watson another chance
+    if result['status'] == 'success' and (result['source'] == 'watson' or settings.QUESTION_CLASSIFIER != 'remote'):
+        question.classification = result
+        Question.objects.filter(pk=question.pk).update(classification=result)
+    return result
+
 # Europe/London is GMT timezone equal to UTC that server uses
+@outbound_call('zoom', 'create_meeting')
 def create_meeting(start_time, duration, coach):
     meetingdetails = {"topic": "Troosh QA session",
                       "type": 2,
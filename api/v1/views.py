@@ -2,13 +2,12 @@ from cmath import exp
 import os
 from collections import OrderedDict
 from django.core.exceptions import ObjectDoesNotExist
-import mux_python
-from mux_python.rest import ApiException
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.http import HttpResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
-from django.core.mail import send_mail
 from rest_framework.views import APIView
 from rest_framework import viewsets, mixins, permissions, generics, status
 from rest_framework.decorators import api_view, permission_classes
@@ -23,17 +22,29 @@ from notifications.models import Notification
 from accounts.models import User
 from subscribers.models import Subscriber, Subscription
 from instructor.models import Coach, CoachApplication
-from posts.models import Post, PostVideoAssetMetaData, PlaybackId, PostVideo
-from projects.models import Project, Team, MilestoneCompletionReport, Milestone, MilestoneCompletionVideo, MilestoneCompletionVideoAssetMetaData, MilestoneCompletionPlaybackId, Coupon
+from posts.models import Post, PostVideoAssetMetaData
+from projects.models import Project, Team, MilestoneCompletionReport, Milestone, MilestoneCompletionVideoAssetMetaData, Coupon
 from tiers.models import Tier
 from expertisefields.models import ExpertiseField, ExpertiseFieldSuggestion
 from comments.models import Comment
 from reacts.models import React
 from chat.models import ChatRoom, Message
 from awards.models import Award, AwardBase
-from qa.models import Question, QuestionInvitation, QaSession, AvailableTimeRange, CommonQuestion
-from . import serializers
-from .utils import extract_tags_from_question, create_meeting
+from qa.models import Question, QuestionInvitation, QaSession
+from qa.availability import annotate_availability
+from qa.slots import regenerate_coach_slots, next_free_slots
+from qa.diff import update_time_ranges, update_common_questions
+from subscribers.entitlements import can_access_tier, subscribed_tier
+from . import serializers, querysets
+from .utils import classify_question
+from payments.outbox import run_pending_operations
+from payments.webhooks import construct_event, record_event
+from payments import stripe_cache
+from uploads.models import Upload
+from uploads import s3 as uploads
+from common import mux
+from coach.querybudget import query_budget
+from coach.dbrouter import read_replica
 import uuid
 import stripe
 import json
@@ -45,29 +56,11 @@ stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
 
 def get_user_posts(user):
-    post_query = Post.objects.none()
-    for coach in Coach.objects.filter(tiers__subscriptions__subscriber=user.subscriber).exclude(user=user):
-        subscription = Subscription.objects.filter(
-            subscriber=user.subscriber, tier__coach=coach).first()
-        # by default get all posts available (except the ones that are chained to others, in that case just get the initial),
-        # later we exclude posts based on the user subscription
-
-        # UPDATE: all posts are free now so just return everything
-        post_query |= coach.posts.exclude(parent_post__isnull=False)
-
-        # # if use has subscriberd to tier 1 exclude tier 2 posts
-        # if subscription.tier.tier==Tier.TIER1:
-        #     post_query = post_query.exclude(coach=coach, tier__tier=Tier.TIER2)
-        # elif subscription.tier.tier==Tier.FREE:
-        #     post_query = post_query.exclude(coach=coach, tier__tier__in=[Tier.TIER2, Tier.TIER1])
-
-    # user might not be a coach, in that case an exception is thrown
-    try:
-        post_query = post_query | Post.objects.filter(
-            coach=user.coach).exclude(parent_post__isnull=False)
-    except Exception:
-        pass
-    return post_query.distinct()
+    # the posts of the coaches the user subscribed to and the user's own, all posts are free now, chained posts are
+    # only shown inside the post they are chained to
+    coaches = Coach.objects.filter(tiers__subscriptions__subscriber=user.subscriber).exclude(user=user)
+    return Post.objects.filter(Q(coach__in=coaches) | Q(coach__user=user)).exclude(
+        parent_post__isnull=False).distinct()
 
 
 class IsCoach(permissions.BasePermission):
@@ -82,26 +75,18 @@ class IsSubscribedToPostTier(permissions.BasePermission):
 
     def has_permission(self, request, view):
         _id = request.data['post']
-        post = Post.objects.filter(surrogate=_id)
-        if not post.exists():
+        tier_ids = Post.objects.filter(surrogate=_id).values_list('tier_id', flat=True)[:1]
+        if not tier_ids:
             return False
-        post = post.first()
-        post_tier = post.tier
-        # check if user is the coach that created the post
-        if request.user.is_coach:
-            if request.user.coach == post_tier.coach:
-                return True
-        # else check if the user has subscribed to the tier this post belongs to
-        return request.user.subscriber.subscriptions.filter(tier=post_tier).exists()
+        return self.can_see_tier(request, tier_ids[0])
 
     def has_object_permission(self, request, view, obj):
-        post_tier = obj.tier
-        # check if user is the coach that created the post
-        if request.user.is_coach:
-            if request.user.coach == post_tier.coach:
-                return True
-        # else check if the user has subscribed to the tier this post belongs to
-        return request.user.subscriber.subscriptions.filter(tier=post_tier).exists()
+        return self.can_see_tier(request, obj.tier_id)
+
+    @staticmethod
+    def can_see_tier(request, tier_id):
+        # the user is the coach that created the post or subscribed to the tier it belongs to
+        return request.user.is_authenticated and can_access_tier(request.user, tier_id)
 
 
 class CursorPaginationWithCount(CursorPagination):
@@ -236,6 +221,10 @@ class CoachFilterSet(filters.FilterSet):
         fields = ['expertise_field', 'expertise', 'name']
 
 
+# the budgets are the queries a page runs, api/tests/test_query_budget.py checks they stay the same when the
+# page shows more rows
+@query_budget(14)
+@read_replica
 class CoachViewSet(viewsets.ModelViewSet):
     queryset = Coach.objects.all()
     serializer_class = serializers.CoachSerializer
@@ -250,7 +239,7 @@ class CoachViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         if self.action == 'list' or self.action == 'retrieve':
-            queryset = Coach.objects.filter(charges_enabled=True)
+            queryset = querysets.coaches().filter(charges_enabled=True)
         else:
             queryset = Coach.objects.all()
 
@@ -259,7 +248,7 @@ class CoachViewSet(viewsets.ModelViewSet):
 
     def get_object(self):
         try:
-            return Coach.objects.get(surrogate=self.kwargs.get('surrogate'))
+            return querysets.coaches().get(surrogate=self.kwargs.get('surrogate'))
         except ObjectDoesNotExist:
             raise Http404
 
@@ -338,7 +327,7 @@ class PostViewSet(viewsets.GenericViewSet,
 
     def get_queryset(self):
         # prevents chained posts from being displayed outside parent post
-        return Post.objects.exclude(parent_post__isnull=False)
+        return querysets.posts(self.request.user, Post.objects.exclude(parent_post__isnull=False))
 
     def get_serializer_context(self):
         return {
@@ -346,6 +335,7 @@ class PostViewSet(viewsets.GenericViewSet,
         }
 
 
+@read_replica
 class CoachPostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = serializers.PostSerializer
@@ -374,7 +364,7 @@ class CoachPostViewSet(viewsets.ModelViewSet):
         #     if self.request.user != coach.user:
         #         post_query = post_query.exclude(coach=coach, tier__tier__in=[Tier.TIER2, Tier.TIER1])
 
-        return post_query.distinct()
+        return querysets.posts(self.request.user, post_query.distinct())
 
 
 class ChainedPostsViewSet(generics.ListCreateAPIView, viewsets.GenericViewSet):
@@ -382,13 +372,15 @@ class ChainedPostsViewSet(generics.ListCreateAPIView, viewsets.GenericViewSet):
     serializer_class = serializers.ChainedPostsSerializer
 
 
+@query_budget(21)
+@read_replica
 class NewPostsViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, ]
     serializer_class = serializers.PostSerializer
     pagination_class = PostPagination
 
     def get_queryset(self):
-        return get_user_posts(self.request.user)
+        return querysets.posts(self.request.user, get_user_posts(self.request.user))
 
     def get_serializer_context(self):
         return {
@@ -406,8 +398,8 @@ class NewPosts2ViewSet(viewsets.ModelViewSet):
         if self.request.user.subscriber.last_seen_post:
             unseen_posts = user_posts.filter(
                 created__gt=self.request.user.subscriber.last_seen_post.created)
-            return unseen_posts
-        return user_posts
+            return querysets.posts(self.request.user, unseen_posts)
+        return querysets.posts(self.request.user, user_posts)
 
     def get_serializer_context(self):
         return {
@@ -497,7 +489,7 @@ class TeamsViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         project = self.kwargs['project_id']
-        return Team.objects.filter(project__surrogate=project)
+        return querysets.with_members(Team.objects.filter(project__surrogate=project))
 
     def get_serializer_context(self):
         project = Project.objects.get(surrogate=self.kwargs['project_id'])
@@ -513,7 +505,7 @@ class ProjectPostsViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         project_id = self.kwargs['project_id']
         project = Project.objects.filter(surrogate=project_id).first()
-        return project.posts.all()
+        return querysets.posts(self.request.user, project.posts.all())
 
     def get_serializer_context(self):
         return {
@@ -547,9 +539,10 @@ class MyTeamsViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, ]
 
     def get_queryset(self):
-        return self.request.user.subscriber.teams.all()
+        return querysets.with_members(self.request.user.subscriber.teams.all())
 
 
+@read_replica
 class CommentsViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.CommentSerializer
     pagination_class = CommentPagination
@@ -562,7 +555,7 @@ class CommentsViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         post = self.kwargs['post_id']
         # get only top level comments
-        return Post.objects.get(surrogate=post).comments.filter(level=0)
+        return querysets.with_authors(Post.objects.get(surrogate=post).comments.filter(level=0))
 
     def get_serializer_context(self):
         return {
@@ -583,13 +576,14 @@ class CreateCommentViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
         }
 
 
+@read_replica
 class CommentRepliesViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.CommentSerializer
     pagination_class = CommentPagination
 
     def get_queryset(self):
         comment = self.kwargs['comment_id']
-        return Comment.objects.get(surrogate=comment).children.all()
+        return querysets.with_authors(Comment.objects.get(surrogate=comment).children.all())
 
 
 class ReactsViewSet(viewsets.ModelViewSet):
@@ -636,15 +630,16 @@ class MyChatRoomsViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.ChatRoomSerializer
 
     def get_queryset(self):
-        return self.request.user.subscriber.chat_rooms.all()
+        return querysets.with_members(self.request.user.subscriber.chat_rooms.all())
 
 
+@read_replica
 class RoomMessagesViewSet(viewsets.ModelViewSet):
     pagination_class = MessagePagination
     serializer_class = serializers.MessageSerializer
 
     def get_queryset(self):
-        return ChatRoom.objects.get(surrogate=self.kwargs['surrogate']).messages.all()
+        return querysets.with_authors(ChatRoom.objects.get(surrogate=self.kwargs['surrogate']).messages.all())
 
 
 class CreateMessageViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
@@ -718,6 +713,8 @@ class MyArchivedQuestions(viewsets.ModelViewSet):
         return self.request.user.coach.assigned_questions.filter(initial_delivery_time__lte=now)
 
 
+@query_budget(32)
+@read_replica
 class NotificationsViewSet(viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = serializers.NotificationSerializer
@@ -725,7 +722,12 @@ class NotificationsViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        return user.notifications.all()
+        return querysets.notifications(user.notifications.all())
+
+    def list(self, request, *args, **kwargs):
+        notifications = list(self.filter_queryset(self.get_queryset()))
+        querysets.prefetch_notification_objects(notifications, request.user)
+        return Response(self.get_serializer(notifications, many=True).data)
 
     def get_serializer_context(self):
         return {
@@ -778,7 +780,8 @@ def create_qa_checkout_session(request):
     question_id = request.data.get('question_id')
     qa_session = QaSession.objects.get(surrogate=qa_session_id)
     question = Question.objects.get(surrogate=question_id)
-    price = stripe.Price.retrieve(qa_session.price_id)
+    run_pending_operations(qa_session)
+    price = stripe_cache.retrieve_price(qa_session.price_id)
 
     if os.environ.get('DEBUG') == 'True':
         success_url = 'http://localhost:3000/checkout?status=success'
@@ -813,8 +816,11 @@ def create_qa_checkout_session(request):
 @api_view(http_method_names=['GET'])
 @permission_classes((permissions.AllowAny,))
 def check_available_coaches_for_question(request, question_id):
+    query = serializers.AvailableCoachesQuerySerializer(data=request.query_params)
+    if not query.is_valid():
+        return Response(query.errors, status=400)  # `status` is the status of the question below
     question = Question.objects.filter(surrogate=question_id).first()
-    question_data = extract_tags_from_question(question.body)
+    question_data = classify_question(question)
     # let user be able to filter mentors based on their expertise
     expertise = request.query_params.get('expertise')
     enforced_expertise = True
@@ -831,52 +837,37 @@ def check_available_coaches_for_question(request, question_id):
     status = question_data['status']
     coaches = Coach.objects.filter(
         expertise_fields__name__iexact=expertise).all()
-    available_coaches = Coach.objects.none()
+    available_coaches = []
     available_on_other_times = 0
-    for coach in coaches:
-        _coach = Coach.objects.filter(id=coach.id)
-        if not question.answer_needed_now:
-            # get the 1 hour range at the time the user wants the answer
-            one_hour_after_delivery_time_estimate = question.initial_delivery_time + \
-                datetime.timedelta(hours=1)
-
-            # we then check if he has another question lined up during that time
-            # since the ranges are not really percise we leave a 1 hour buffer to be safe that
-            # no questions overlap with each other
-            # in case he is free during that time range we can add him to the available coaches
-
-            # the below query will extend over the coach's availability if the range window is small
-            # for example if user requests 60 minutes and coach is available during 7:00-7:20
-            # the query will be equal to false
-            is_coach_available_during_that_time = coach.available_time_ranges.filter(
-                start_time__lte=question.initial_delivery_time.time(), end_time__gte=question.initial_delivery_time.time()).exists()
-            is_coach_booked_for_this_time = coach.assigned_questions.filter(delivery_time__range=[
-                                                                            question.initial_delivery_time, one_hour_after_delivery_time_estimate]).exists()
-            if not is_coach_available_during_that_time or is_coach_booked_for_this_time:
-                available_on_other_times += 1
-            if is_coach_available_during_that_time and not is_coach_booked_for_this_time:
-                available_coaches = available_coaches | _coach
-        else:
-            invitation = QuestionInvitation.objects.filter(
-                question=question, coach=coach)
+    if not question.answer_needed_now:
+        # a coach is available when one of their time ranges covers the call and they have no other question
+        # lined up during it, the whole expertise is checked with a single query (see qa/availability.py)
+        # the call defaults to 1 hour, the longest session, so that no questions overlap with each other
+        duration = datetime.timedelta(minutes=query.validated_data['minutes'])
+        coaches = list(annotate_availability(coaches, question.initial_delivery_time, duration))
+        available_coaches = [coach for coach in coaches if coach.has_time_range and not coach.is_booked]
+        available_on_other_times = len(coaches) - len(available_coaches)
+    else:
+        invitations = {}
+        for invitation in QuestionInvitation.objects.filter(question=question).order_by('-id'):
+            invitations[invitation.coach_id] = invitation
+        for coach in coaches:
+            invitation = invitations.get(coach.id)
             # Don't bother to send an invitation if the question is a hit or miss
             if not is_weak:
-                if not invitation.exists():
+                if invitation is None:
                     # create an invitation
                     # this sends an email to each coach and informs him that a question needs an answer now
                     # they can then accept or decline the request
                     QuestionInvitation.objects.create(
                         question=question, coach=coach)
                     status = 'waiting_for_mentors'
-                else:
-                    invitation = invitation.first()
-                    if invitation.status == QuestionInvitation.ACCEPTED:
-                        available_coaches = available_coaches | _coach
-                    elif invitation.status == QuestionInvitation.DECLINED:
-                        available_on_other_times += 1
+                elif invitation.status == QuestionInvitation.ACCEPTED:
+                    available_coaches.append(coach)
+                elif invitation.status == QuestionInvitation.DECLINED:
+                    available_on_other_times += 1
             else:
                 status = 'error'
-        # serializer = serializers.QuestionSerializer(question)
     coach_serializer = serializers.CoachSerializer(
         available_coaches, context={'request': request}, many=True)
     return Response({'available_coaches': coach_serializer.data, 'is_weak': is_weak, 'expertise': expertise,
@@ -920,9 +911,9 @@ def change_common_questions(request):
     coach = request.user.coach
     common_questions = request.data
     if common_questions:
-        coach.common_questions.all().delete()
-        for question in common_questions:
-            CommonQuestion.objects.create(body=question, coach=coach)
+        if not isinstance(common_questions, list) or not all(isinstance(body, str) for body in common_questions):
+            return Response({'status': 'expected a list of questions'}, status=status.HTTP_400_BAD_REQUEST)
+        update_common_questions(coach, common_questions)
     return Response({'status': 'ok'})
 
 
@@ -930,23 +921,37 @@ def change_common_questions(request):
 @permission_classes((permissions.IsAuthenticated, IsCoach))
 def change_coach_qa_availability(request):
     coach = request.user.coach
-    availability_ranges = request.data.get('availability_ranges')
-    if availability_ranges:
-        # just delete the old ones and add the new ones again
-        coach.available_time_ranges.all().delete()
-        for time_range in availability_ranges:
-            weekday = time_range['weekday']
-            start_time_hour = int(time_range['start_time'][:2])
-            start_time_minutes = int(time_range['start_time'][3:5])
-            end_time_hour = int(time_range['end_time'][:2])
-            end_time_minutes = int(time_range['end_time'][3:5])
-            AvailableTimeRange.objects.create(weekday=weekday, coach=coach,
-                                              start_time=datetime.time(
-                                                  hour=start_time_hour, minute=start_time_minutes),
-                                              end_time=datetime.time(hour=end_time_hour, minute=end_time_minutes))
+    if request.data.get('availability_ranges'):
+        serializer = serializers.AvailableTimeRangesSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            # only the ranges that changed are written, and the slots regenerated once for the whole change
+            if update_time_ranges(coach, serializer.validated_data['availability_ranges']):
+                regenerate_coach_slots(coach)
     return Response({'status': 'ok'})
 
 
+@api_view(http_method_names=['GET'])
+@permission_classes((permissions.AllowAny,))
+def next_available_slots(request):
+    # the earliest free slots across the coaches of an expertise, or of a single coach
+    query = serializers.NextAvailableSlotsQuerySerializer(data=request.query_params)
+    if not query.is_valid():
+        return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+    limit = query.validated_data['limit']
+    coaches = None
+    expertise = query.validated_data.get('expertise')
+    coach_id = query.validated_data.get('coach')
+    if coach_id:
+        coaches = Coach.objects.filter(surrogate=coach_id)
+    elif expertise:
+        coaches = Coach.objects.filter(expertise_fields__name__iexact=expertise)
+    slots = next_free_slots(limit, coaches=coaches)
+    return Response({'slots': serializers.AvailabilitySlotSerializer(slots, many=True).data})
+
+
+@read_replica
 @api_view(http_method_names=['GET'])
 @permission_classes((permissions.IsAuthenticated,))
 def get_unread_count(request):
@@ -972,6 +977,7 @@ def get_unseen_posts(request):
     return Response({'unseen_posts': user_posts})
 
 
+@read_replica
 @api_view(http_method_names=['GET'])
 @permission_classes((permissions.IsAuthenticated,))
 def get_unseen_post_count(request):
@@ -1009,7 +1015,7 @@ def subscriber_me(request):
         return Response(serializer.data)
     elif request.method == 'PATCH':
         serializer = serializers.SubscriberUpdateSerializer(
-            subscriber, data=request.data, partial=True)
+            subscriber, data=request.data, partial=True, context={'request': request})
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data, status=status.HTTP_200_OK)
@@ -1093,25 +1099,23 @@ def project_payment_sheet(request, id):
     project = Project.objects.filter(surrogate=id)
     if project.exists():
         project = project.first()
+        # stripe objects are created in the background, make sure they exist before using them
+        run_pending_operations(user.subscriber)
+        run_pending_operations(project)
         ephemeralKey = stripe.EphemeralKey.create(
             customer=user.subscriber.customer_id,
             stripe_version='2020-08-27',
         )
 
-        subscription = Subscription.objects.filter(
-            subscriber=user.subscriber, tier__coach=project.coach)
-        if not subscription.exists():
+        if subscribed_tier(user, project.coach_id) is None:
             return Response({'error': 'You need to be at least Tier 1 subsciber or above to join projects'})
-        subscription = subscription.first()
         # if subscription.tier.tier == Tier.FREE:
         #     return Response({'error': 'Free tier subscribers cannot join projects'})
         invoice = None
         payment_intent = None
         coupon = Coupon.objects.filter(
             subscriber=request.user.subscriber, coach=project.coach)
-        price = stripe.Price.retrieve(
-            project.price_id,
-        )
+        price = stripe_cache.retrieve_price(project.price_id)
         if coupon.exists():
             coupon = coupon.first()
             if coupon.valid:
@@ -1160,25 +1164,24 @@ def join_project(request, id):
         project = project.first()
         # this will later be used for validation
         invoice = None
+        run_pending_operations(user.subscriber)
+        run_pending_operations(project)
 
         # Do some tier validation here
-        subscription = Subscription.objects.filter(
-            subscriber=user.subscriber, tier__coach=project.coach)
-        if not subscription.exists():
+        subscription = subscribed_tier(user, project.coach_id)
+        if subscription is None:
             return Response({'error': 'You need to be at least Tier 1 subsciber or above to join projects'})
-        subscription = subscription.first()
-        if subscription.tier.tier == Tier.FREE:
+        tier_id, tier_level = subscription
+        if tier_level == Tier.FREE:
             return Response({'error': 'Free tier subscribers cannot join projects'})
-        elif subscription.tier.tier == Tier.TIER1:
+        elif tier_level == Tier.TIER1:
             coupon = Coupon.objects.filter(
                 subscriber=request.user.subscriber, coach=project.coach)
 
             if coupon.exists():
                 coupon = coupon.first()
                 try:
-                    price = stripe.Price.retrieve(
-                        project.price_id,
-                    )
+                    price = stripe_cache.retrieve_price(project.price_id)
                     if coupon.valid:
                         invoice_item = stripe.InvoiceItem.create(
                             customer=request.user.subscriber.customer_id,
@@ -1293,6 +1296,8 @@ def create_stripe_subscription(request, id):
     user = request.user
     tier = Tier.objects.get(surrogate=id)
     creation_id = str(uuid.uuid4())
+    run_pending_operations(user.subscriber)
+    run_pending_operations(tier)
     ephemeralKey = stripe.EphemeralKey.create(
         customer=request.user.subscriber.customer_id,
         stripe_version='2020-08-27',
@@ -1487,6 +1492,7 @@ def cancel_subscription(request, id):
 @api_view(http_method_names=['POST'])
 @permission_classes((permissions.IsAuthenticated,))
 def preview_subscription_invoice(request, id):
+    run_pending_operations(request.user.subscriber)
     ephemeralKey = stripe.EphemeralKey.create(
         customer=request.user.subscriber.customer_id,
         stripe_version='2020-08-27',
@@ -1515,6 +1521,7 @@ def preview_subscription_invoice(request, id):
 @parser_classes([JSONParser])
 @permission_classes((permissions.IsAuthenticated,))
 def card_wallet(request):
+    run_pending_operations(request.user.subscriber)
     setup_intent = stripe.SetupIntent.create(
         customer=request.user.subscriber.customer_id
     )
@@ -1550,6 +1557,8 @@ def check_subscription_status(request, id):
 def subscribe(request, id):
     user = request.user
     tier = Tier.objects.get(surrogate=id)
+    run_pending_operations(user.subscriber)
+    run_pending_operations(tier)
     if request.method == 'POST':
 
         # First check if the user has already subscribed to this coach with another tier
@@ -1659,6 +1668,7 @@ def subscribe(request, id):
 def attach_payment_method(request):
     user = request.user
     if request.method == 'POST':
+        run_pending_operations(request.user.subscriber)
         customer_id = request.user.subscriber.customer_id
 
         # attach the payment method to the customer
@@ -1672,6 +1682,7 @@ def attach_payment_method(request):
             request.user.subscriber.customer_id,
             invoice_settings={"default_payment_method": payment_method.id},
         )
+        stripe_cache.invalidate_customer(customer_id)
         return Response({'payment_id': payment_method.id})
     if request.method == 'DELETE':
         return Response({'payment_id': None})
@@ -1681,13 +1692,14 @@ def attach_payment_method(request):
 @permission_classes((permissions.IsAuthenticated,))
 def get_payment_method(request):
     user = request.user
+    run_pending_operations(user.subscriber)
     customer_id = request.user.subscriber.customer_id
 
-    customer = stripe.Customer.retrieve(customer_id)
+    customer = stripe_cache.retrieve_customer(customer_id)
 
     payment_method_id = customer['invoice_settings']['default_payment_method']
     if payment_method_id:
-        payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
+        payment_method = stripe_cache.retrieve_payment_method(payment_method_id)
         return Response({'payment_method': {
             'id': payment_method['id'],
             'card': {
@@ -1778,103 +1790,36 @@ def select_expertise(request):
 @api_view(http_method_names=['POST'])
 @permission_classes((permissions.AllowAny,))
 def upload_video(request):
-    # Authentication Setup
-    configuration = mux_python.Configuration()
-    configuration.username = os.environ['MUX_TOKEN_ID']
-    configuration.password = os.environ['MUX_TOKEN_SECRET']
-
     passthrough_id = str(uuid.uuid1())
 
     # Mark post as processing while video is being processed by mux
     post = Post.objects.get(surrogate=request.data['post'])
-    post.status == Post.PROCESSING
-    post.save(processing=True)
+    Post.objects.filter(pk=post.pk).update(status=Post.PROCESSING)
     PostVideoAssetMetaData.objects.create(
         passthrough=passthrough_id, post=post)
-    create_asset_request = mux_python.CreateAssetRequest(playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
-                                                         mp4_support="standard", passthrough=passthrough_id)
-
-    # API Client Initialization
-    request = mux_python.CreateUploadRequest(
-        new_asset_settings=create_asset_request, test=True if settings.DEVELOPMENT_MODE else False)
-    direct_uploads_api = mux_python.DirectUploadsApi(
-        mux_python.ApiClient(configuration))
-    response = direct_uploads_api.create_direct_upload(request)
-
-    try:
-        pass
-    except ApiException as e:
-        print("Exception when calling AssetsApi->list_assets: %s\n" % e)
-    return Response({"url": response.data.url})
+    return Response({"url": mux.create_direct_upload(passthrough_id)})
 
 
 @api_view(http_method_names=['POST'])
 @permission_classes((permissions.AllowAny,))
 def upload_milestonecompletion_video(request):
-    # Authentication Setup
-    configuration = mux_python.Configuration()
-    configuration.username = os.environ['MUX_TOKEN_ID']
-    configuration.password = os.environ['MUX_TOKEN_SECRET']
-
     passthrough_id = str(uuid.uuid1())
 
     # Mark milestone report as processing while video is being processed by mux
     milestone_completion_report = MilestoneCompletionReport.objects.get(
         surrogate=request.data['milestone_completion_report'])
-    milestone_completion_report.video_status == MilestoneCompletionReport.PROCESSING
-    milestone_completion_report.save()
+    MilestoneCompletionReport.objects.filter(pk=milestone_completion_report.pk).update(
+        video_status=MilestoneCompletionReport.PROCESSING)
     MilestoneCompletionVideoAssetMetaData.objects.create(
         passthrough=passthrough_id, milestone_completion_report=milestone_completion_report)
-    create_asset_request = mux_python.CreateAssetRequest(playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
-                                                         mp4_support="standard", passthrough=passthrough_id)
-
-    # API Client Initialization
-    request = mux_python.CreateUploadRequest(
-        new_asset_settings=create_asset_request, test=True if settings.DEVELOPMENT_MODE else False)
-    direct_uploads_api = mux_python.DirectUploadsApi(
-        mux_python.ApiClient(configuration))
-    response = direct_uploads_api.create_direct_upload(request)
-
-    try:
-        pass
-    except ApiException as e:
-        print("Exception when calling AssetsApi->list_assets: %s\n" % e)
-    return Response({"url": response.data.url})
+    return Response({"url": mux.create_direct_upload(passthrough_id)})
 
 
 @api_view(http_method_names=['POST'])
 @permission_classes((permissions.AllowAny,))
 def upload_video_webhook(request):
     if request.data['type'] == 'video.asset.ready':
-        passthrough = request.data['data']['passthrough']
-        playback_ids = request.data['data']['playback_ids']
-        asset_id = request.data['data']['id']
-
-        # in case the video is attached to a post
-        if PostVideoAssetMetaData.objects.filter(passthrough=passthrough).exists():
-            video_data = PostVideoAssetMetaData.objects.get(
-                passthrough=passthrough)
-            video = PostVideo.objects.create(
-                asset_id=asset_id, passthrough=video_data.passthrough, post=video_data.post)
-            for playback_id in playback_ids:
-                PlaybackId.objects.create(
-                    playback_id=playback_id['id'], policy=playback_id['policy'], video=video)
-            # Video is done processing by mux. Mark it as done.
-            video_data.post.status = Post.DONE
-            video_data.post.save()
-
-        # in case the video is attached to a post
-        if MilestoneCompletionVideoAssetMetaData.objects.filter(passthrough=passthrough).exists():
-            video_data = MilestoneCompletionVideoAssetMetaData.objects.get(
-                passthrough=passthrough)
-            video = MilestoneCompletionVideo.objects.create(
-                asset_id=asset_id, passthrough=video_data.passthrough, milestone_completion_report=video_data.milestone_completion_report)
-            for playback_id in playback_ids:
-                MilestoneCompletionPlaybackId.objects.create(
-                    playback_id=playback_id['id'], policy=playback_id['policy'], video=video)
-            # Video is done processing by mux. Mark it as done.
-            video_data.milestone_completion_report.status = MilestoneCompletionReport.DONE
-            video_data.milestone_completion_report.save()
+        mux.ingest_asset_ready(request.data['data'])
     return Response()
 
 
@@ -1882,6 +1827,7 @@ def upload_video_webhook(request):
 @permission_classes((permissions.IsAuthenticated,))
 def get_stripe_login(request):
     stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+    run_pending_operations(request.user.coach)
     login = stripe.Account.create_login_link(f'{request.user.coach.stripe_id}')
     return Response({'url': login.url})
 
@@ -1890,7 +1836,7 @@ def get_stripe_login(request):
 @permission_classes((permissions.IsAuthenticated,))
 def create_stripe_account_link(request):
     stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-    coach = request.user.coach
+    coach = run_pending_operations(request.user.coach)
 
     redirect = 'https://troosh.app/users/oauth/callback'
     refresh_url = 'https://troosh.app/reauth'
@@ -1913,7 +1859,7 @@ def create_stripe_account_link(request):
 @permission_classes((permissions.IsAuthenticated,))
 def create_stripe_account_link_qa(request):
     stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-    coach = request.user.coach
+    coach = run_pending_operations(request.user.coach)
 
     redirect = 'https://questions.troosh.app/users/oauth/callback'
     refresh_url = 'https://questions.troosh.app/reauth'
@@ -1935,9 +1881,8 @@ def create_stripe_account_link_qa(request):
 @api_view(http_method_names=['GET'])
 @permission_classes((permissions.IsAuthenticated,))
 def get_stripe_balance(request):
-    balance = stripe.Balance.retrieve(
-        stripe_account=request.user.coach.stripe_id
-    )
+    run_pending_operations(request.user.coach)
+    balance = stripe_cache.retrieve_balance(request.user.coach.stripe_id)
     print(balance)
     return Response({
         'available': balance['available'][0]['amount'] / 100,
@@ -1945,214 +1890,59 @@ def get_stripe_balance(request):
     })
 
 
-@csrf_exempt
 @api_view(http_method_names=['POST'])
-@permission_classes((permissions.AllowAny,))
-def stripe_webhook(request):
-    payload = request.body
-    sig_header = request.META['HTTP_STRIPE_SIGNATURE']
-    event = None
-
-    # endpoints received from "account" and "connect applications" both land here
-    # so we have to check both signatured
-    # if one fails try the other
+@parser_classes([JSONParser])
+@permission_classes((permissions.IsAuthenticated,))
+def create_upload(request):
+    # the client uploads the image straight to S3 with the returned form, then confirms the upload
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, os.environ.get('STRIPE_ENDPOINT_SECRET')
-        )
-    except ValueError as e:
-        # Invalid payload
-        return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError as e:
-        try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, os.environ.get(
-                    'STRIPE_ENDPOINT_REGULAR_SECRET')
-            )
-        except stripe.error.SignatureVerificationError as e2:
-            # Invalid signature
-            return HttpResponse(status=400)
-
-    data_object = event.data.object
-    if event.type == 'payment_intent.payment_failed':
-        payment_intent_id = data_object['id']
-        stripe.PaymentIntent.modify(
-            payment_intent_id,
-            metadata={
-                'troosh_status': 'payment_failed'
-            }
-        )
-
-    if event.type == 'payment_intent.succeeded':
-        payment_intent_id = data_object['id']
-        payment_intent = stripe.PaymentIntent.retrieve(
-            payment_intent_id,
-        )
-        payment_type = payment_intent.metadata.get('type')
-        if payment_type == 'project':
-            project_id = payment_intent.metadata['id']
-            subscriber = payment_intent.metadata['subscriber']
-            subscriber = Subscriber.objects.filter(
-                surrogate=subscriber).first()
-            project = Project.objects.filter(surrogate=project_id).first()
-            if project:
-                handle_join_project(project, subscriber)
-                stripe.PaymentIntent.modify(
-                    payment_intent_id,
-                    metadata={
-                        'troosh_status': 'completed'
-                    }
-                )
-                return Response({'success': 'Successfully joined project'})
-            else:
-                return Response({'error': f"Project with id {project_id} not found"})
+        upload = uploads.create_upload(request.user, request.data.get('kind'), request.data.get('content_type'))
+    except uploads.UploadError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({**serializers.UploadSerializer(upload).data, 'presigned_post': uploads.presign(upload)},
+                    status=status.HTTP_201_CREATED)
 
-        # return Response({'error': json.dumps(payment_intent)})
 
-    if event.type == 'checkout.session.completed':
-        checkout_session = stripe.checkout.Session.retrieve(
-            data_object['id'],
-            expand=['customer']
-        )
-        # get customer so we can send him an email with the zoom link
-        customer = checkout_session['customer']
-        qa_session = QaSession.objects.get(
-            surrogate=data_object.metadata['id'])
-        question = Question.objects.get(
-            surrogate=data_object.metadata['question_id'])
-        zoom_end_time = question.initial_delivery_time + \
-            datetime.timedelta(minutes=int(qa_session.minutes))
-        question.delivery_time = zoom_end_time
-        question.delivered_by = qa_session.coach
-        question.save()
-        zoom_meeting_data = create_meeting(
-            question.initial_delivery_time, qa_session.minutes, qa_session.coach)
-
-        # also save zoom data in admin
-        question.zoom_link = zoom_meeting_data['url']
-        question.zoom_password = zoom_meeting_data['password']
-        question.save()
-
-        # send email to the customer
-        send_mail(
-            f"Your zoom call with {qa_session.coach.name}",
-            f"""
-            Here is your zoom meeting:
-
-            Start time: {zoom_meeting_data['start_time'].strftime("%m/%d/%Y, %H:%M:%S")} UTC
-            Duration: {qa_session.minutes}
-            Link: {zoom_meeting_data['url']}
-            Password: {zoom_meeting_data['password']}
-            
-            For any questions feel free to reply to this email!
-            """,
-            'beta@troosh.app',
-            [customer['email']],
-            fail_silently=False,
-        )
-
-        # send email to mentor
-        send_mail(
-            f"You got a zoom call coming up!",
-            f"""
-            Here is your zoom meeting for the following question: 
-            "{question.body}"
-            
-            Start time: {zoom_meeting_data['start_time'].strftime("%m/%d/%Y, %H:%M:%S")} UTC
-            Duration: {qa_session.minutes}
-            Link: {zoom_meeting_data['url']}
-            Password: {zoom_meeting_data['password']}
-            
-            For any questions feel free to reply to this email!
-            """,
-            'beta@troosh.app',
-            [qa_session.coach.user.email],
-            fail_silently=False,
-        )
-
-        return Response({'url': zoom_meeting_data['url'], 'password': zoom_meeting_data['password']})
-
-    if event.type == 'invoice.payment_failed':
-        if data_object['billing_reason'] == 'subscription_create' or data_object['billing_reason'] == 'subscription_update':
-            subscription_id = data_object['subscription']
-            payment_intent_id = data_object['payment_intent']
+@api_view(http_method_names=['POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def confirm_upload(request, id):
+    upload = Upload.objects.filter(surrogate=id, user=request.user).first()
+    if not upload:
+        raise Http404
+    try:
+        uploads.confirm(upload)
+    except uploads.UploadError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(serializers.UploadSerializer(upload).data)
 
-            # Retrieve the payment intent used to pay the subscription
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
 
-            subscription = stripe.Subscription.modify(
-                subscription_id,
-                # default_payment_method=payment_intent.payment_method,
-                metadata={
-                    'troosh_status': 'payment_failed'
-                }
-            )
-
-    if event.type == 'invoice.payment_succeeded':
-        if data_object['billing_reason'] == 'subscription_create' or data_object['billing_reason'] == 'subscription_update':
-            # The subscription automatically activates after successful payment
-            # Set the payment method used to pay the first invoice
-            # as the default payment method for that subscription
-            subscription_id = data_object['subscription']
-            payment_intent_id = data_object['payment_intent']
+@api_view(http_method_names=['GET'])
+@permission_classes((permissions.IsAuthenticated,))
+def get_tier_price_migration(request, id):
+    # progress of moving the tier's subscriptions to its latest price
+    if not request.user.is_coach:
+        return Response({'error': 'Only coaches can view price migrations'}, status=status.HTTP_403_FORBIDDEN)
+    tier = Tier.objects.filter(surrogate=id, coach=request.user.coach).first()
+    if not tier:
+        raise Http404
+    migration = tier.price_migrations.order_by('-id').first()
+    if not migration:
+        return Response({'status': None})
+    return Response(serializers.PriceMigrationSerializer(migration).data)
 
-            # Retrieve the payment intent used to pay the subscription
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
 
-            subscription = stripe.Subscription.retrieve(subscription_id)
-            sub_instance = Subscription.objects.filter(
-                subscription_id=subscription_id)
-            subscriber = subscription.metadata['subscriber']
-            tier = subscription.metadata['tier']
-            subscriber = Subscriber.objects.filter(
-                surrogate=subscriber).first()
-            tier = Tier.objects.filter(surrogate=tier).first()
-
-            existing_subscription = Subscription.objects.filter(
-                subscriber=subscriber, tier__coach=tier.coach)
-            if existing_subscription.exists():
-                existing_subscription = existing_subscription.first()
-                existing_subscription.subscription_id = subscription.id
-                existing_subscription.json_data = json.dumps(subscription)
-                existing_subscription.tier = tier
-                existing_subscription.price_id = tier.price_id
-                existing_subscription.save()
-            else:
-                created_subscription = Subscription.objects.create(subscriber=subscriber, subscription_id=subscription.id,
-                                                                   customer_id=subscriber.customer_id, json_data=json.dumps(
-                                                                       subscription),
-                                                                   tier=tier, price_id=tier.price_id)
-                send_notification_on_subscribe(
-                    subscriber, tier, created_subscription)
-
-            if tier.tier != Tier.FREE:
-                coupon = None
-                if not Coupon.objects.filter(subscriber=subscriber, coach=tier.coach).exists():
-                    coupon = stripe.Coupon.create(
-                        percent_off=100,
-                        duration="once",
-                    )
-                if coupon:
-                    Coupon.objects.create(coach=tier.coach, subscriber=subscriber,
-                                          coupon_id=coupon.id, valid=coupon.valid, json_data=json.dumps(coupon))
-
-            # Update the status of the subscription
-            # Set the default payment method
-            subscription = stripe.Subscription.modify(
-                subscription_id,
-                # default_payment_method=payment_intent.payment_method,
-                metadata={
-                    'troosh_status': 'completed'
-                }
-            )
+@csrf_exempt
+@api_view(http_method_names=['POST'])
+@permission_classes((permissions.AllowAny,))
+def stripe_webhook(request):
+    # the event is only verified and stored here so stripe gets its response right away,
+    # the handlers in stripe_events.py are run by the process_stripe_events worker
+    try:
+        event = construct_event(request.body, request.META['HTTP_STRIPE_SIGNATURE'])
+    except (ValueError, KeyError, stripe.error.SignatureVerificationError):
+        # Invalid payload or signature
+        return HttpResponse(status=400)
 
-    if event.type == 'payment_method.attached':
-        payment_method = event.data.object  # contains a stripe.PaymentMethod
-    elif event.type == 'account.updated':
-        charges_enabled = data_object.get('charges_enabled', '')
-        coach = Coach.objects.get(stripe_id=data_object.get('id', ''))
-        coach.charges_enabled = charges_enabled
-        coach.save()
-    else:
-        print('Unhandled event type {}'.format(event.type))
+    record_event(event)
+    stripe_cache.invalidate_for_event(event)
     return HttpResponse(status=200)
@@ -7,9 +7,10 @@ from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from subscribers.models import Subscriber
 from chat.models import Message, ChatRoom
+from coach.metrics import ConnectionMetricsMixin
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(ConnectionMetricsMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # self.user = await self.get_subscriber(self.scope['user'])
         self.room_name = self.scope['url_route']['kwargs']['room_name']
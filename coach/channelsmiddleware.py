@@ -1,21 +1,95 @@
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import UntypedToken
+from subscribers.models import Subscriber
+from instructor.models import Coach
+
+PRINCIPAL_CACHE_TIMEOUT = getattr(settings, 'CHANNELS_PRINCIPAL_CACHE_TIMEOUT', 60)
+
+USER_FIELDS = ['id', 'surrogate', 'is_coach', 'is_subscriber', 'is_active']
+SUBSCRIBER_FIELDS = ['id', 'surrogate', 'name', 'avatar_id']
+COACH_FIELDS = ['id', 'surrogate', 'name']
+
+
+def principal_cache_key(jti):
+    return f"channels:principal:{jti}"
+
+
+def _fields(instance, fields):
+    return {field: getattr(instance, field) for field in fields}
+
+
+def _from_db(model, values):
+    # from_db expects the values in the order of the model's fields
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db('default', names, [values[name] for name in names])
+
+
+def to_principal(user):
+    """
+    The few fields of the user, their subscriber and coach the consumers use, small enough to cache.
+    """
+    subscriber = getattr(user, 'subscriber', None)
+    coach = getattr(user, 'coach', None)
+    return {
+        'user': _fields(user, USER_FIELDS),
+        'subscriber': subscriber and _fields(subscriber, SUBSCRIBER_FIELDS),
+        'coach': coach and _fields(coach, COACH_FIELDS),
+    }
+
+
+def from_principal(principal):
+    """
+    Rebuilds the user from a cached principal without querying the database. The other fields are deferred,
+    so they are loaded on access and a save only writes the fields that were loaded.
+    """
+    user = _from_db(get_user_model(), principal['user'])
+    if principal['subscriber']:
+        user.subscriber = _from_db(Subscriber, principal['subscriber'])
+    if principal['coach']:
+        user.coach = _from_db(Coach, principal['coach'])
+    return user
 
 
 @database_sync_to_async
-def get_user(token):
+def load_user(jti, user_id):
+    """
+    The user of a token together with their subscriber and coach, the consumers use both. Reconnecting clients
+    present the same token, the principal of a token seen recently is read from the cache so a reconnect storm
+    after a deploy doesn't run a query per client. The cache is redis, which is a blocking call as much as the
+    database is, so both happen here off the event loop.
+    """
+    key = principal_cache_key(jti)
+    principal = cache.get(key)
+    if principal is not None:
+        return from_principal(principal)
+
+    User = get_user_model()
+    try:
+        user = User.objects.select_related('subscriber', 'coach').get(id=user_id)
+    except User.DoesNotExist:
+        return None
+    cache.set(key, to_principal(user), PRINCIPAL_CACHE_TIMEOUT)
+    return user
+
+
+async def get_user(token):
     """
     get_user from token
     """
     try:
         token_data = UntypedToken(token)
-        return get_user_model().objects.get(id=token_data["user_id"])
-    except (InvalidToken, TokenError, get_user_model().DoesNotExist):
+    except (InvalidToken, TokenError):
         return AnonymousUser()
 
+    user = await load_user(token_data[api_settings.JTI_CLAIM], token_data[api_settings.USER_ID_CLAIM])
+    return user if user is not None else AnonymousUser()
+
 
 class JWTChannelMiddleware:
     """
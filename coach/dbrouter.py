@@ -0,0 +1,167 @@
+"""
+Reads of read-only requests from the replicas.
+
+GET, HEAD and OPTIONS requests to views marked with `read_replica` read from one of REPLICA_DATABASES, everything
+else uses the primary. A user keeps reading from the primary for REPLICA_STICKY_SECONDS after a request of theirs
+wrote, so they see what they just changed, and so does the rest of a request once it wrote. Replicas more than
+REPLICA_MAX_LAG_SECONDS behind the primary, or that can't be reached, aren't read from until they caught up.
+"""
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+import logging
+import random
+import time
+
+logger = logging.getLogger('coach.dbrouter')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_request_state = ContextVar('replica_request_state', default=None)
+# alias: (checked at, lag in seconds)
+_lag = {}
+
+# how far behind the primary the replica has applied, 0 when it applied everything it received
+LAG_SQL = ("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+           "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+
+def read_replica(view):
+    """
+    Lets the safe requests of a view read from the replicas. Decorates view classes and, above @api_view, view
+    functions.
+    """
+    view.read_replica = True
+    return view
+
+
+def uses_read_replica(view_func):
+    if getattr(view_func, 'read_replica', False):
+        return True
+    # as_view() keeps the class of viewsets and @api_view views on the view function
+    return getattr(getattr(view_func, 'cls', None), 'read_replica', False)
+
+
+def sticky_key(user_id):
+    return f"dbrouter:sticky:{user_id}"
+
+
+def replica_lag(alias):
+    """
+    The lag of the replica, checked at most every REPLICA_LAG_CHECK_INTERVAL seconds per process.
+    """
+    checked, lag = _lag.get(alias, (None, None))
+    now = time.monotonic()
+    if checked is not None and now - checked < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+    connection = connections[alias]
+    try:
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0] or 0)
+        else:
+            # only postgres replicates, any other database is a copy made for trying this out
+            lag = 0.0
+    except DatabaseError:
+        logger.exception("Could not check the lag of %s", alias)
+        lag = float('inf')
+    _lag[alias] = (now, lag)
+    return lag
+
+
+def healthy_replicas():
+    return [alias for alias in settings.REPLICA_DATABASES if replica_lag(alias) <= settings.REPLICA_MAX_LAG_SECONDS]
+
+
+class RequestState:
+    """
+    Where the reads of a request go. The user is checked for stickiness once rest framework authenticated them,
+    which happens after the middleware ran, until then a request with credentials reads from the primary.
+    """
+
+    def __init__(self, request, allowed):
+        self.request = request
+        self.allowed = allowed
+        self.wrote = False
+        self.checked_user = None
+        self.checking = False
+        self.replica = None
+
+    def user_allows_replica(self):
+        """
+        Whether it is known who the request is from and they aren't sticky.
+        """
+        # loading the session's user reads from the database, which asks this again
+        if self.checking:
+            return False
+        self.checking = True
+        try:
+            user = getattr(self.request, 'user', None)
+            if user is None or not user.is_authenticated:
+                return 'HTTP_AUTHORIZATION' not in self.request.META
+            if user.pk != self.checked_user:
+                self.checked_user = user.pk
+                if cache.get(sticky_key(user.pk)):
+                    self.allowed = False
+            return self.allowed
+        finally:
+            self.checking = False
+
+    def read_alias(self):
+        if not self.allowed or not self.user_allows_replica():
+            return DEFAULT_DB_ALIAS
+        if self.replica is None:
+            replicas = healthy_replicas()
+            # the whole request reads from one replica, so it sees one consistent state
+            self.replica = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+        return self.replica
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.read_alias()
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+            state.allowed = False
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_DATABASES:
+            return self.get_response(request)
+
+        state = RequestState(request, allowed=False)
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+
+        user = getattr(request, 'user', None)
+        if (state.wrote or request.method not in SAFE_METHODS) and user is not None and user.is_authenticated:
+            cache.set(sticky_key(user.pk), True, settings.REPLICA_STICKY_SECONDS)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _request_state.get()
+        if state is not None and request.method in SAFE_METHODS and uses_read_replica(view_func):
+            state.allowed = not state.wrote
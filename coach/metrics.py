@@ -0,0 +1,153 @@
+"""
+Prometheus metrics, served at /metrics.
+
+Every label takes its values from the code rather than from requests: views are labelled with the view class and
+DRF action, not the path, consumers with their class, group sends with the message type, not the group, outbound
+calls with a fixed service and operation and cache reads with their namespace. So the number of series stays the
+same however much traffic the server sees. The metrics are per process.
+"""
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+from channels_redis.core import RedisChannelLayer
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+import stripe
+import time
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to respond to a request', ['view', 'action', 'method', 'status'])
+HTTP_REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries run by a request', ['view', 'action'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')))
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_duration_seconds', 'Time a request spent in the database', ['view', 'action'])
+WEBSOCKET_CONNECTIONS = Gauge('websocket_connections', 'Open websocket connections', ['consumer'])
+WEBSOCKET_CONNECTIONS_OPENED = Counter(
+    'websocket_connections_opened_total', 'Websocket connections opened', ['consumer'])
+GROUP_SEND_SECONDS = Histogram(
+    'channel_layer_group_send_duration_seconds', 'Time to send a message to a group', ['type'])
+GROUP_SEND_FAILURES = Counter(
+    'channel_layer_group_send_failures_total', 'Group sends that raised', ['type', 'error'])
+OUTBOUND_SECONDS = Histogram(
+    'outbound_request_duration_seconds', 'Time of calls to external services', ['service', 'operation', 'outcome'])
+# result is hit, miss or coalesced, when the value was built by another caller while this one waited
+CACHE_REQUESTS = Counter('cache_requests_total', 'Reads of the tagged cache', ['namespace', 'result'])
+CACHE_BUILD_SECONDS = Histogram('cache_build_duration_seconds', 'Time to build a missing cache value', ['namespace'])
+
+UNRESOLVED = 'unresolved'
+# any method can be sent, the others are labelled OTHER_METHOD so they don't add series
+METHODS = {'GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'}
+OTHER_METHOD = 'other'
+
+
+@contextmanager
+def outbound_call(service, operation):
+    """
+    Times a call to an external service, as a `with` block or a decorator. Calls that raise count as errors.
+    """
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        OUTBOUND_SECONDS.labels(service, operation, outcome).observe(time.perf_counter() - started)
+
+
+def method_label(method):
+    return method if method in METHODS else OTHER_METHOD
+
+
+def view_labels(view_func, method):
+    """
+    The view and action of a view function, viewsets carry the action of each method in `actions`.
+    """
+    view = getattr(view_func, 'cls', view_func).__name__
+    actions = getattr(view_func, 'actions', None) or {}
+    return view, actions.get(method.lower(), method_label(method).lower())
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        method = method_label(request.method)
+        view, action = getattr(request, 'metrics_labels', (UNRESOLVED, method.lower()))
+        HTTP_REQUEST_SECONDS.labels(view, action, method, f"{response.status_code // 100}xx").observe(elapsed)
+        # recorded by QueryCountMiddleware
+        recorder = getattr(request, 'query_recorder', None)
+        if recorder is not None:
+            HTTP_REQUEST_QUERIES.labels(view, action).observe(recorder.count)
+            HTTP_REQUEST_DB_SECONDS.labels(view, action).observe(recorder.time)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_labels = view_labels(view_func, request.method)
+
+
+def metrics(request):
+    """
+    The metrics in the Prometheus text format. The scraper authenticates with METRICS_TOKEN as a bearer token,
+    without one the endpoint only exists in DEBUG.
+    """
+    token = settings.METRICS_TOKEN
+    if not token and not settings.DEBUG:
+        raise Http404
+    if token and not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
+class ConnectionMetricsMixin:
+    """
+    Counts the open websockets of a consumer.
+    """
+
+    async def websocket_connect(self, message):
+        WEBSOCKET_CONNECTIONS.labels(type(self).__name__).inc()
+        WEBSOCKET_CONNECTIONS_OPENED.labels(type(self).__name__).inc()
+        try:
+            await super().websocket_connect(message)
+        except Exception:
+            # the consumer is gone, websocket_disconnect won't be called
+            WEBSOCKET_CONNECTIONS.labels(type(self).__name__).dec()
+            raise
+
+    async def websocket_disconnect(self, message):
+        WEBSOCKET_CONNECTIONS.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+
+class InstrumentedRedisChannelLayer(RedisChannelLayer):
+    """
+    The redis channel layer timing group sends.
+    """
+
+    async def group_send(self, group, message):
+        started = time.perf_counter()
+        try:
+            await super().group_send(group, message)
+        except Exception as e:
+            GROUP_SEND_FAILURES.labels(message.get('type', ''), type(e).__name__).inc()
+            raise
+        GROUP_SEND_SECONDS.labels(message.get('type', '')).observe(time.perf_counter() - started)
+
+
+class StripeHTTPClient(stripe.http_client.RequestsClient):
+    """
+    Times the requests of the stripe library, each retry separately. The operation is the method and the
+    resource, e.g. "post subscriptions", the ids in the path are left out.
+    """
+
+    def request(self, method, url, headers, post_data=None):
+        path = urlparse(url).path.split('/')
+        resource = path[2] if len(path) > 2 else ''
+        with outbound_call('stripe', f"{method.lower()} {resource}"):
+            return super().request(method, url, headers, post_data)
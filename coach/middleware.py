@@ -1,5 +1,105 @@
+from django.db.models import Count
 from django.utils.deprecation import MiddlewareMixin
 
+
 class DisableCSRF(MiddlewareMixin):
     def process_request(self, request):
         setattr(request, '_dont_enforce_csrf_checks', True)
+
+
+class Viewer:
+    """
+    The subscriber, coach, subscriptions, coupons and teams of the user making the request, each loaded once
+    the first time a permission or serializer asks for it. The user is read when needed because rest framework
+    authenticates the JWT after the middleware ran.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._user_id = None
+        self._loaded = {}
+
+    @property
+    def user(self):
+        return getattr(self.request, 'user', None)
+
+    def _get(self, name, load):
+        user = self.user
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        if user_id != self._user_id:
+            self._user_id = user_id
+            self._loaded = {}
+        if name not in self._loaded:
+            self._loaded[name] = load(user) if user_id is not None else None
+        return self._loaded[name]
+
+    @property
+    def subscriber(self):
+        return self._get('subscriber', lambda user: getattr(user, 'subscriber', None))
+
+    @property
+    def coach(self):
+        return self._get('coach', lambda user: getattr(user, 'coach', None) if user.is_coach else None)
+
+    def _subscriptions(self, user):
+        subscriptions = {}
+        if self.subscriber is not None:
+            subscribed = self.subscriber.subscriptions.select_related('tier').prefetch_related('tier__benefits')
+            for subscription in subscribed.annotate(tier_posts_count=Count('tier__posts')).order_by('id'):
+                if subscription.tier is not None:
+                    # the post count TierSerializer returns
+                    subscription.tier.posts_count = subscription.tier_posts_count
+                    # the first subscription of a coach, like `.filter(tier__coach=coach).first()`
+                    subscriptions.setdefault(subscription.tier.coach_id, subscription)
+        return subscriptions
+
+    def _coupons(self, user):
+        coupons = {}
+        if self.subscriber is not None:
+            for coupon in self.subscriber.coupons.order_by('id'):
+                coupons.setdefault(coupon.coach_id, coupon)
+        return coupons
+
+    def _projects_joined(self, user):
+        if self.subscriber is None:
+            return {}
+        teams = self.subscriber.teams.values('project__coach').annotate(count=Count('id'))
+        return {team['project__coach']: team['count'] for team in teams}
+
+    def subscription_for(self, coach):
+        return (self._get('subscriptions', self._subscriptions) or {}).get(coach.pk)
+
+    def tier_for(self, coach):
+        subscription = self.subscription_for(coach)
+        return subscription.tier if subscription else None
+
+    def coupon_for(self, coach):
+        return (self._get('coupons', self._coupons) or {}).get(coach.pk)
+
+    def projects_joined(self, coach):
+        """
+        The number of teams of the coach's projects the viewer is a member of.
+        """
+        return (self._get('projects_joined', self._projects_joined) or {}).get(coach.pk, 0)
+
+
+def get_viewer(request):
+    """
+    The viewer of the request, also when the request did not go through ViewerMiddleware.
+    """
+    if request is None:
+        return None
+    viewer = getattr(request, 'viewer', None)
+    if viewer is None:
+        viewer = Viewer(request)
+        request.viewer = viewer
+    return viewer
+
+
+class ViewerMiddleware(MiddlewareMixin):
+    """
+    Installs the request's `Viewer`, so permissions and serializers share what they load about the user.
+    """
+
+    def process_request(self, request):
+        request.viewer = Viewer(request)
@@ -0,0 +1,184 @@
+"""
+Sampled profiles of live requests.
+
+A request is profiled when it carries an `X-Profile` header signed with the SECRET_KEY (see the `profile_token`
+command), or at random at PROFILE_SAMPLE_RATE. While it runs, a thread samples the stack of the thread handling it
+every PROFILE_INTERVAL_MS, weighting each stack by the wall time and by the cpu time of the handling thread since the
+previous sample, and every query is timed. The profiles are stored to PROFILE_STORAGE as folded stacks, one per
+line with its weight in microseconds, which flamegraph.pl, inferno and speedscope read, next to a json file with
+the request and its SQL timeline. Requests that are not profiled only pay for the header lookup.
+"""
+from collections import Counter
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from django.utils import timezone
+from .metrics import UNRESOLVED, method_label
+from .querybudget import QueryRecorder
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('coach.profiling')
+
+SALT = 'coach.profiling'
+
+
+def profile_token(label=''):
+    """
+    The value of the X-Profile header that profiles a request, valid for PROFILE_TOKEN_MAX_AGE seconds.
+    """
+    return signing.TimestampSigner(salt=SALT).sign(label or 'profile')
+
+
+def profile_reason(request):
+    """
+    Why the request is profiled, None when it isn't.
+    """
+    token = request.META.get('HTTP_X_PROFILE')
+    if token:
+        try:
+            signing.TimestampSigner(salt=SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            return None
+        return 'requested'
+    if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def folded(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename.rsplit('site-packages/', 1)[-1].replace(str(settings.BASE_DIR) + '/', '')
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of another thread until stopped, into `wall` and `cpu` counters of microseconds per stack.
+    The cpu time of a thread can only be read on Linux, elsewhere the cpu profile stays empty.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.stopped = threading.Event()
+        try:
+            self.clock = time.pthread_getcpuclockid(thread_id)
+        except (AttributeError, OSError):
+            self.clock = None
+
+    def cpu_time(self):
+        return time.clock_gettime(self.clock) if self.clock is not None else 0
+
+    def run(self):
+        last_wall, last_cpu = time.perf_counter(), self.cpu_time()
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = folded(frame)
+            wall, cpu = time.perf_counter(), self.cpu_time()
+            self.wall[stack] += round((wall - last_wall) * 1e6)
+            if cpu > last_cpu:
+                self.cpu[stack] += round((cpu - last_cpu) * 1e6)
+            last_wall, last_cpu = wall, cpu
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class SQLTimeline(QueryRecorder):
+    """
+    Records when each query started, relative to `started`, and how long it took.
+    """
+
+    def __init__(self, started):
+        super().__init__()
+        self.started = started
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return super().__call__(execute, sql, params, many, context)
+        finally:
+            self.queries.append({
+                'start_ms': round((started - self.started) * 1000, 3),
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+                'database': context['connection'].alias,
+                'sql': sql,
+            })
+
+
+def _folded_lines(counter):
+    return ''.join(f"{stack} {weight}\n" for stack, weight in counter.most_common() if weight)
+
+
+def store_profile(name, sampler, timeline, details):
+    storage = get_storage_class(settings.PROFILE_STORAGE)()
+    storage.save(f"{name}.wall.folded", ContentFile(_folded_lines(sampler.wall).encode()))
+    if sampler.clock is not None:
+        storage.save(f"{name}.cpu.folded", ContentFile(_folded_lines(sampler.cpu).encode()))
+    details['sql'] = timeline.queries
+    return storage.save(f"{name}.json", ContentFile(json.dumps(details, indent=2, default=str).encode()))
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reason = profile_reason(request)
+        if reason is None:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        sampler = StackSampler(threading.get_ident(), settings.PROFILE_INTERVAL_MS / 1000)
+        timeline = SQLTimeline(started)
+        sampler.start()
+        try:
+            with timeline.record():
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+        duration = time.perf_counter() - started
+
+        # set by MetricsMiddleware
+        view, action = getattr(request, 'metrics_labels', (UNRESOLVED, method_label(request.method).lower()))
+        name = f"{timezone.now():%Y%m%d-%H%M%S}-{view}-{action}-{uuid.uuid4().hex[:8]}"
+        details = {
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'action': action,
+            'status': response.status_code,
+            'reason': reason,
+            'duration_ms': round(duration * 1000, 3),
+            'cpu_ms': round(sum(sampler.cpu.values()) / 1000, 3) if sampler.clock is not None else None,
+            'queries': timeline.count,
+            'db_ms': round(timeline.time * 1000, 3),
+            'interval_ms': settings.PROFILE_INTERVAL_MS,
+        }
+        try:
+            stored = store_profile(name, sampler, timeline, details)
+        except Exception:
+            # a profile is never worth failing the request for
+            logger.exception("Could not store the profile of %s %s", request.method, request.path)
+            return response
+        logger.info("Profiled %s %s (%s) in %s", request.method, request.path, reason, stored)
+        response['X-Profile'] = name
+        return response
@@ -0,0 +1,107 @@
+"""
+The queries of a request.
+
+`QueryCountMiddleware` counts the queries a request runs, the time they take in the database and the statements
+that run more than once, which is how an N+1 shows up. With QUERY_COUNT_HEADERS the numbers are returned in
+X-DB-* response headers, otherwise they are logged. Views declare how many queries they may run with
+`query_budget`, requests over their budget are logged as warnings and fail `assertWithinQueryBudget` in tests.
+"""
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+import logging
+import time
+
+logger = logging.getLogger('coach.queries')
+
+
+def query_budget(budget):
+    """
+    Declares the number of queries a view may run. Decorates view classes and, above @api_view, view functions.
+    """
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def get_query_budget(view_func):
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None:
+        # as_view() keeps the class of viewsets and @api_view views on the view function
+        budget = getattr(getattr(view_func, 'cls', None), 'query_budget', None)
+    return budget
+
+
+class QueryRecorder:
+    """
+    A database execute wrapper recording the queries it sees.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def duplicates(self):
+        """
+        The statements that ran more than once with how often they ran, the most frequent first.
+        Statements differing only in their parameters are the same statement.
+        """
+        return [(sql, count) for sql, count in self.statements.most_common() if count > 1]
+
+    def record(self):
+        """
+        Records the queries of all database connections inside the `with` block.
+        """
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def summary(self, limit=3):
+        lines = [f"{self.count} queries in {self.time * 1000:.1f}ms"]
+        for sql, count in self.duplicates()[:limit]:
+            lines.append(f"{count}x {sql}")
+        return '\n'.join(lines)
+
+
+class QueryCountMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        request.query_recorder = recorder
+        with recorder.record():
+            response = self.get_response(request)
+
+        budget = getattr(request, 'query_budget', None)
+        duplicated = sum(count - 1 for sql, count in recorder.duplicates())
+        if getattr(settings, 'QUERY_COUNT_HEADERS', settings.DEBUG):
+            response['X-DB-Query-Count'] = str(recorder.count)
+            response['X-DB-Time-Ms'] = f"{recorder.time * 1000:.1f}"
+            response['X-DB-Duplicate-Queries'] = str(duplicated)
+            if budget is not None:
+                response['X-DB-Query-Budget'] = str(budget)
+
+        if budget is not None and recorder.count > budget:
+            logger.warning("%s %s ran %s queries, its budget is %s\n%s", request.method, request.path,
+                           recorder.count, budget, recorder.summary())
+        else:
+            logger.info("%s %s queries=%s db_ms=%.1f duplicates=%s", request.method, request.path,
+                        recorder.count, recorder.time * 1000, duplicated)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func)
@@ -16,6 +16,7 @@ import environ
 from datetime import timedelta
 from django.core.management.utils import get_random_secret_key
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 env = environ.Env(
     # set casting, default value
@@ -41,8 +42,16 @@ ACCOUNT_EMAIL_VERIFICATION = 'none'
 
 ALLOWED_HOSTS = os.environ.get(
     "DJANGO_ALLOWED_HOSTS", "127.0.0.1,localhost,192.168.1.10,20a555a15e3e.ngrok.io,146a-2a02-587-4503-483b-cdad-5959-d585-9834.ngrok.io").split(",")
-# EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Emails are queued in the database and delivered by `python manage.py send_queued_emails`
+# through EMAIL_DELIVERY_BACKEND. For benchmarks deliver them with
+# 'django.core.mail.backends.console.EmailBackend' or 'django.core.mail.backends.filebased.EmailBackend'
+# (written to EMAIL_FILE_PATH) instead of gmail.
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'emails.backends.OutboxBackend')
+EMAIL_DELIVERY_BACKEND = os.environ.get('EMAIL_DELIVERY_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH', '/tmp/emails')
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
+EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS = 30
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 2))
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_USE_TLS = True
 EMAIL_PORT = 587
@@ -52,12 +61,64 @@ EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 AWS_STORAGE_BUCKET_NAME = os.environ.get("AWS_STORAGE_BUCKET_NAME")
-AWS_S3_CUSTOM_DOMAIN = '%s.s3.amazonaws.com' % AWS_STORAGE_BUCKET_NAME
+# e.g. http://localhost:9000 for the minio service of docker-compose.debug.yml, files are then served
+# through the endpoint instead of the bucket's domain
+AWS_S3_ENDPOINT_URL = os.environ.get("AWS_S3_ENDPOINT_URL")
+AWS_S3_CUSTOM_DOMAIN = None if AWS_S3_ENDPOINT_URL else '%s.s3.amazonaws.com' % AWS_STORAGE_BUCKET_NAME
 AWS_S3_OBJECT_PARAMETERS = {
     'CacheControl': 'max-age=86400',
 }
 AWS_LOCATION = 'static'
 DEFAULT_FILE_STORAGE = 'coach.storage_backends.MediaStorage'
+# Uploaded images are resized to these widths in these formats by `python manage.py generate_image_variants`
+IMAGE_VARIANT_WIDTHS = [160, 480, 1080]
+IMAGE_VARIANT_FORMATS = ['webp', 'avif']
+IMAGE_VARIANT_POLL_INTERVAL = float(os.environ.get('IMAGE_VARIANT_POLL_INTERVAL', 2))
+# Images can be uploaded straight to the bucket with presigned POSTs (see uploads/s3.py)
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 10 * 1024 * 1024))
+UPLOAD_EXPIRES_SECONDS = 10 * 60
+
+# Connections the shared Mux client keeps open per host (see common/mux.py)
+MUX_CONNECTION_POOL_SIZE = int(os.environ.get('MUX_CONNECTION_POOL_SIZE', 10))
+
+# The benchmark commands write their results here as JSON (see common/benchmarks.py)
+BENCHMARK_RESULTS_DIR = os.environ.get('BENCHMARK_RESULTS_DIR', os.path.join(BASE_DIR, 'benchmarks', 'results'))
+
+# Point the stripe client to another server, e.g. http://localhost:12111 for the local stand-in
+# started with `python manage.py run_stripe_standin`
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')
+
+# Stripe calls triggered by model saves are recorded in an outbox
+# and executed by `python manage.py process_stripe_operations`
+STRIPE_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('STRIPE_OUTBOX_MAX_ATTEMPTS', 8))
+STRIPE_OUTBOX_RETRY_BACKOFF_SECONDS = 5
+STRIPE_OUTBOX_POLL_INTERVAL = float(os.environ.get('STRIPE_OUTBOX_POLL_INTERVAL', 1))
+
+# Subscriptions are moved to a tier's new price by `python manage.py process_price_migrations`.
+# The request rate is kept well below stripe's limit of 100 requests per second in live mode
+# because the rest of the application shares the same limit.
+STRIPE_PRICE_MIGRATION_CHUNK_SIZE = int(os.environ.get('STRIPE_PRICE_MIGRATION_CHUNK_SIZE', 100))
+STRIPE_PRICE_MIGRATION_CONCURRENCY = int(os.environ.get('STRIPE_PRICE_MIGRATION_CONCURRENCY', 4))
+STRIPE_PRICE_MIGRATION_REQUESTS_PER_SECOND = float(os.environ.get('STRIPE_PRICE_MIGRATION_REQUESTS_PER_SECOND', 20))
+
+# Modules registering the handlers of the events stored by the stripe webhook,
+# they are run by `python manage.py process_stripe_events`
+STRIPE_WEBHOOK_HANDLERS = ['api.v1.stripe_events']
+
+# Seconds stripe customers, payment methods and balances are cached for, prices are cached for good.
+# Webhook events drop the cached objects they report changes of.
+STRIPE_CACHE_CUSTOMER_TIMEOUT = int(os.environ.get('STRIPE_CACHE_CUSTOMER_TIMEOUT', 60))
+STRIPE_CACHE_BALANCE_TIMEOUT = int(os.environ.get('STRIPE_CACHE_BALANCE_TIMEOUT', 30))
+# How questions are classified: 'remote' uses watson, 'local' the expertise field names
+# and 'local_first' asks watson only when the local classifier isn't confident
+QUESTION_CLASSIFIER = os.environ.get('QUESTION_CLASSIFIER', 'remote')
+# watson calls taking longer fall back to the local classifier
+WATSON_TIMEOUT_SECONDS = float(os.environ.get('WATSON_TIMEOUT_SECONDS', 2))
+
+# The QA slot calendar holds slots of QA_SLOT_MINUTES for the next QA_SLOT_WEEKS weeks,
+# `python manage.py generate_qa_slots` should run daily to keep it rolling
+QA_SLOT_MINUTES = 15
+QA_SLOT_WEEKS = int(os.environ.get('QA_SLOT_WEEKS', 4))
 TAGGIT_CASE_INSENSITIVE = True
 
 CORS_ALLOWED_ORIGINS = [
@@ -70,6 +131,9 @@ CORS_ALLOWED_ORIGINS = [
 ]
 
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = list(default_headers) + ['x-profile']
+CORS_EXPOSE_HEADERS = ['X-DB-Query-Count', 'X-DB-Time-Ms', 'X-DB-Duplicate-Queries', 'X-DB-Query-Budget',
+                       'X-Profile']
 
 # Application definition
 JQUERY_URL = "https://code.jquery.com/jquery-3.5.1.min.js"
@@ -99,6 +163,7 @@ INSTALLED_APPS = [
     'mptt',
     'storages',
     'accounts',
+    'common',
     'instructor',
     'subscribers',
     'posts',
@@ -110,13 +175,43 @@ INSTALLED_APPS = [
     'chat',
     'awards',
     'qa',
+    'payments',
+    'emails',
+    'uploads',
     'api'
 ]
 
 ASGI_APPLICATION = "coach.asgi.application"
+
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
+# The cache lives in its own database of the redis the channel layer uses, reads fall back to the database when
+# it's down. Tags, read-through helpers and stampede protection are in common/cache.py
+CACHE_URL = os.environ.get('CACHE_URL', 'redis://redis:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': CACHE_URL,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_CONNECT_TIMEOUT': 1,
+            'SOCKET_TIMEOUT': 1,
+            'IGNORE_EXCEPTIONS': True,
+        },
+    },
+}
+if TESTING:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# Seconds values read through common/cache.py are cached for unless the read says otherwise
+CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 10 * 60))
+# Seconds a user's entitlements (subscribed and own tiers) are cached for, changes to subscriptions and tiers
+# drop them right away
+ENTITLEMENT_CACHE_TIMEOUT = int(os.environ.get('ENTITLEMENT_CACHE_TIMEOUT', 60 * 60))
+# Seconds the user resolved from a websocket's token is cached for, keyed by the token's jti
+CHANNELS_PRINCIPAL_CACHE_TIMEOUT = int(os.environ.get('CHANNELS_PRINCIPAL_CACHE_TIMEOUT', 60))
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'coach.metrics.InstrumentedRedisChannelLayer',
         'CONFIG': {
             "hosts": [os.environ.get("REDIS_URL", ('redis', 6379))],
         },
@@ -124,6 +219,9 @@ CHANNEL_LAYERS = {
 }
 
 MIDDLEWARE = [
+    'coach.metrics.MetricsMiddleware',
+    'coach.profiling.ProfilingMiddleware',
+    'coach.dbrouter.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -132,9 +230,56 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'coach.middleware.DisableCSRF'
+    'coach.middleware.DisableCSRF',
+    'coach.middleware.ViewerMiddleware',
+    'coach.querybudget.QueryCountMiddleware',
 ]
 
+# Return the query count, database time and duplicated queries of a request in X-DB-* headers instead of logging them
+# (see coach/querybudget.py)
+QUERY_COUNT_HEADERS = os.environ.get('QUERY_COUNT_HEADERS', str(DEBUG)) == 'True'
+
+# Bearer token Prometheus scrapes /metrics with, without one the endpoint is only served in DEBUG (see coach/metrics.py)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Share of requests profiled at random, requests with a signed X-Profile header are always profiled
+# (see coach/profiling.py and the profile_token command)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# Milliseconds between the stack samples of a profiled request
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+# Seconds an X-Profile header stays valid
+PROFILE_TOKEN_MAX_AGE = int(os.environ.get('PROFILE_TOKEN_MAX_AGE', 60 * 60))
+# Where profiles are stored, coach.storage_backends.ProfileStorage keeps them in the S3 bucket
+PROFILE_STORAGE = os.environ.get('PROFILE_STORAGE', 'coach.storage_backends.LocalProfileStorage')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'coach.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        'coach.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'coach.dbrouter': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 ROOT_URLCONF = 'coach.urls'
 
 TEMPLATES = [
@@ -200,6 +345,22 @@ elif len(sys.argv) > 0 and sys.argv[1] != 'collectstatic':
         "default": dj_database_url.parse(os.environ.get("DATABASE_URL")),
     }
 
+# Comma separated urls of read replicas of the default database, the safe requests of views marked with read_replica
+# read from them (see coach/dbrouter.py)
+DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+REPLICA_DATABASES = []
+for number, url in enumerate(DATABASE_REPLICA_URLS, 1):
+    # tests read the replicas' rows from the test database of default
+    DATABASES[f'replica{number}'] = {**dj_database_url.parse(url), 'TEST': {'MIRROR': 'default'}}
+    REPLICA_DATABASES.append(f'replica{number}')
+DATABASE_ROUTERS = ['coach.dbrouter.ReplicaRouter']
+# Seconds a replica may be behind the primary before reads go to the primary instead
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+# Seconds a user reads from the primary after one of their requests wrote, so they see their own changes
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+# Seconds between the checks of a replica's lag, per process
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
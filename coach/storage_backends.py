@@ -1,5 +1,18 @@
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
 from storages.backends.s3boto3 import S3Boto3Storage
 
 class MediaStorage(S3Boto3Storage):
     location = 'media'
-    file_overwrite = False
\ No newline at end of file
+    file_overwrite = False
+
+
+class ProfileStorage(S3Boto3Storage):
+    location = 'profiles'
+    default_acl = 'private'
+    file_overwrite = False
+
+
+class LocalProfileStorage(FileSystemStorage):
+    def __init__(self, **kwargs):
+        super().__init__(location=settings.PROFILE_DIR, **kwargs)
@@ -1,3 +1,25 @@
 from django.contrib import admin
+from django.utils import timezone
+from .models import ImageVariant, ImageVariantJob
 
-# Register your models here.
+
+class ImageVariantAdmin(admin.ModelAdmin):
+    model = ImageVariant
+    list_display = ('content_type', 'object_id', 'format', 'width', 'height', 'size', 'created')
+    list_filter = ('format', 'width', 'content_type')
+
+
+class ImageVariantJobAdmin(admin.ModelAdmin):
+    model = ImageVariantJob
+    list_display = ('content_type', 'object_id', 'status', 'attempts', 'cpu_time', 'created')
+    list_filter = ('status', 'content_type')
+    readonly_fields = ('last_error',)
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        queryset.update(status=ImageVariantJob.PENDING, attempts=0, next_attempt_at=timezone.now())
+    retry_jobs.short_description = 'Generate the variants of the selected images again'
+
+
+admin.site.register(ImageVariant, ImageVariantAdmin)
+admin.site.register(ImageVariantJob, ImageVariantJobAdmin)
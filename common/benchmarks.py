@@ -0,0 +1,110 @@
+"""
+Shared parts of the benchmark commands.
+
+The commands run against a database seeded with `generate_dataset` and write their results as JSON to
+BENCHMARK_RESULTS_DIR, named after the benchmark and the git revision, so runs of different commits can be
+compared with `--compare`.
+"""
+from django.conf import settings
+from django.utils import timezone
+import json
+import math
+import os
+import subprocess
+
+
+def percentile(values, fraction):
+    """
+    The nearest rank percentile of the values, `fraction` between 0 and 1.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """
+    Latency percentiles in milliseconds and the throughput of `latencies` (seconds) measured over `elapsed` seconds.
+    """
+    milliseconds = [latency * 1000 for latency in latencies]
+    summary = {
+        'count': len(milliseconds),
+        'per_second': round(len(milliseconds) / elapsed, 1) if elapsed else None,
+    }
+    for name, fraction in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(milliseconds, fraction)
+        summary[name] = round(value, 2) if value is not None else None
+    summary['max_ms'] = round(max(milliseconds), 2) if milliseconds else None
+    return summary
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=settings.BASE_DIR, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                    text=True, cwd=settings.BASE_DIR, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return revision, dirty
+
+
+def write_results(benchmark, results, output_dir=None):
+    """
+    Stores the results of a run together with when and on which commit it ran, returns the path.
+    """
+    revision, dirty = git_revision()
+    started = timezone.now()
+    document = {
+        'benchmark': benchmark,
+        'revision': revision,
+        'dirty': dirty,
+        'created': started.isoformat(),
+        **results,
+    }
+    output_dir = output_dir or settings.BENCHMARK_RESULTS_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"{benchmark}-{started:%Y%m%d-%H%M%S}-{revision or 'unknown'}.json")
+    with open(path, 'w') as file:
+        json.dump(document, file, indent=2, default=str)
+    return path
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(results, baseline, metrics=('p50_ms', 'p95_ms', 'per_second')):
+    """
+    Lines comparing each case of `results` to the same case of `baseline`, e.g. "new_posts p95_ms 120.0 -> 80.0 (-33%)".
+    """
+    lines = []
+    for name, case in results['cases'].items():
+        previous = baseline.get('cases', {}).get(name)
+        if previous is None:
+            continue
+        for metric in metrics:
+            old, new = previous.get(metric), case.get(metric)
+            if old is None or new is None:
+                continue
+            change = f" ({(new - old) / old * 100:+.0f}%)" if old else ''
+            lines.append(f"{name} {metric} {old} -> {new}{change}")
+    return lines
+
+
+def process_usage(pid):
+    """
+    The cpu seconds used so far and the resident memory in bytes of the process, from /proc so only on Linux.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            # the fields after the command name, which is in parentheses and may contain spaces
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as file:
+            rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return None, None
+    # utime and stime are the 14th and 15th fields of stat
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss
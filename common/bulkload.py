@@ -0,0 +1,111 @@
+"""
+Loading large numbers of rows.
+
+Rows are dicts of attnames. On PostgreSQL they are streamed into the table with COPY, on other databases they
+are inserted with bulk_create. Either way no signals are sent, so nothing is queued for stripe. The ids are
+handed out by the loader, so rows can point to each other before they are loaded; `reset_sequences` moves the
+sequences past them afterwards.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime
+from io import StringIO
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Max
+import csv
+
+NULL = '\\N'
+
+
+@contextmanager
+def keep_timestamps(model):
+    """
+    bulk_create sets auto_now and auto_now_add fields to the current time, this keeps the given timestamps.
+    """
+    fields = [field for field in model._meta.concrete_fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Loader:
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=10000):
+        self.using = using
+        self.connection = connections[using]
+        self.batch_size = batch_size
+        self.use_copy = self.connection.vendor == 'postgresql'
+        self.counts = Counter()
+        self._next_ids = {}
+
+    def allocate(self, model, count=1):
+        """
+        Reserves `count` consecutive ids of the model and returns the first.
+        """
+        if model not in self._next_ids:
+            last = model.objects.using(self.using).aggregate(last=Max('pk'))['last'] or 0
+            self._next_ids[model] = last + 1
+        first = self._next_ids[model]
+        self._next_ids[model] += count
+        return first
+
+    def load(self, model, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._insert(model, batch)
+                batch = []
+        if batch:
+            self._insert(model, batch)
+
+    def _insert(self, model, rows):
+        if self.use_copy:
+            self._copy(model, rows)
+        else:
+            with keep_timestamps(model):
+                model.objects.using(self.using).bulk_create([model(**row) for row in rows])
+        self.counts[model] += len(rows)
+
+    @staticmethod
+    def _format(value):
+        if value is None:
+            return NULL
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return str(value)
+
+    def _copy(self, model, rows):
+        fields = {field.attname: field for field in model._meta.concrete_fields}
+        names = list(rows[0])
+        # COPY doesn't apply the defaults django would, the constant ones are filled in here
+        defaults = {attname: field.get_default() for attname, field in fields.items()
+                    if attname not in names and field.has_default() and not callable(field.default)}
+        names += list(defaults)
+        columns = [fields[name].column for name in names]
+
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([self._format(row[name] if name in row else defaults[name]) for name in names])
+        buffer.seek(0)
+
+        quote = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {quote(model._meta.db_table)} ({', '.join(quote(column) for column in columns)}) "
+                f"FROM STDIN WITH (FORMAT csv, NULL '{NULL}')", buffer)
+
+    def reset_sequences(self, models):
+        statements = self.connection.ops.sequence_reset_sql(no_style(), models)
+        with self.connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
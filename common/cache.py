@@ -0,0 +1,192 @@
+"""
+Read-through caching with tags.
+
+A cached value is stored together with the versions its tags had before it was built. Invalidating a tag bumps
+its version, so every value built earlier is stale on its next read without anything having to find their keys.
+Models declare the tags their changes invalidate with `register_cache_tags` in their models.py, reads name the
+tags they depend on:
+
+    @cached('coach_projects', tags=lambda coach_id: [tag(Coach, coach_id), tag(Project)])
+    def coach_projects(coach_id):
+        ...
+
+When a value is missing one caller builds it. The other threads of the process wait for it on a lock, other
+processes on a lock in the cache for up to LOCK_WAIT seconds, so a popular key expiring costs one build instead
+of one per request in flight.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from coach.metrics import CACHE_REQUESTS, CACHE_BUILD_SECONDS
+from functools import wraps
+import hashlib
+import threading
+import time
+
+DEFAULT_TIMEOUT = getattr(settings, 'CACHE_DEFAULT_TIMEOUT', 10 * 60)
+# how long a build may hold the lock of its key, and how long the other processes wait for it
+LOCK_TIMEOUT = 30
+LOCK_WAIT = 5
+POLL_INTERVAL = 0.05
+
+# the threads building keys that hash to the same lock wait for each other, a fixed number keeps memory bounded
+_locks = [threading.Lock() for _ in range(64)]
+
+
+def tag(model, pk=None):
+    """
+    The tag of a model instance, of the instance with the pk, or of the whole model when there's neither.
+    """
+    if isinstance(model, Model):
+        pk = model.pk
+    label = model._meta.label_lower
+    return label if pk is None else f"{label}:{pk}"
+
+
+def _tag_key(name):
+    return f"cache:tag:{name}"
+
+
+def tag_versions(tags):
+    keys = [_tag_key(name) for name in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # a tag starts at the current time rather than 1, so the values of an evicted tag don't become
+            # fresh again when it is recreated
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def invalidate_tags(*tags):
+    def bump():
+        for name in tags:
+            try:
+                cache.incr(_tag_key(name))
+            except ValueError:
+                # no value depends on a tag that doesn't exist
+                pass
+    bump()
+    # a request could rebuild a value from the rows before the change is committed
+    transaction.on_commit(bump)
+
+
+def make_key(namespace, key, version=1):
+    return f"cache:{namespace}:v{version}:{key}"
+
+
+def _local_lock(key):
+    return _locks[hash(key) % len(_locks)]
+
+
+def _fresh(entry, versions):
+    return entry is not None and entry[1] == versions
+
+
+def get_or_build(namespace, key, build, tags=(), timeout=DEFAULT_TIMEOUT, version=1):
+    """
+    The cached value of the key, built with `build()` when it is missing or one of its tags changed since.
+    Bumping `version` makes the values cached by earlier code misses, e.g. when what `build` returns changes.
+    """
+    full_key = make_key(namespace, key, version)
+    entry = cache.get(full_key)
+    versions = tag_versions(tags)
+    if _fresh(entry, versions):
+        CACHE_REQUESTS.labels(namespace, 'hit').inc()
+        return entry[0]
+
+    with _local_lock(full_key):
+        # another thread may have built it while this one waited
+        entry = cache.get(full_key)
+        if _fresh(entry, versions):
+            CACHE_REQUESTS.labels(namespace, 'coalesced').inc()
+            return entry[0]
+
+        lock_key = f"{full_key}:lock"
+        # when the cache is down neither add nor get work, then there's nothing to wait for
+        if not cache.add(lock_key, 1, LOCK_TIMEOUT) and cache.get(lock_key) is not None:
+            deadline = time.monotonic() + LOCK_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                entry = cache.get(full_key)
+                if _fresh(entry, versions):
+                    CACHE_REQUESTS.labels(namespace, 'coalesced').inc()
+                    return entry[0]
+            # the build elsewhere is slow or died, build it here too rather than wait longer
+
+        CACHE_REQUESTS.labels(namespace, 'miss').inc()
+        started = time.perf_counter()
+        try:
+            value = build()
+            cache.set(full_key, (value, versions), timeout)
+        finally:
+            cache.delete(lock_key)
+            CACHE_BUILD_SECONDS.labels(namespace).observe(time.perf_counter() - started)
+        return value
+
+
+def _argument_key(args, kwargs):
+    return hashlib.sha1(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+
+
+def cached(namespace, tags=None, timeout=DEFAULT_TIMEOUT, version=1):
+    """
+    Caches what the function returns per arguments, `tags` is called with the same arguments. The arguments
+    are part of the key through their repr, so they should be ids and other plain values.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return get_or_build(namespace, _argument_key(args, kwargs), lambda: function(*args, **kwargs),
+                                tags(*args, **kwargs) if tags else (), timeout, version)
+        return wrapper
+    return decorator
+
+
+def cached_queryset(namespace, key, queryset, tags=(), timeout=DEFAULT_TIMEOUT, version=1):
+    """
+    The instances of the queryset, which depend on the tag of its model besides `tags`.
+    """
+    return get_or_build(namespace, key, lambda: list(queryset), [tag(queryset.model), *tags], timeout, version)
+
+
+def cached_serializer_data(namespace, key, serializer_class, instance, tags=(), many=False, context=None,
+                           timeout=DEFAULT_TIMEOUT, version=1):
+    """
+    The data of the serializer. Only for serializers whose output doesn't depend on who asks.
+    """
+    return get_or_build(namespace, key,
+                        lambda: serializer_class(instance, many=many, context=context or {}).data,
+                        tags, timeout, version)
+
+
+def register_cache_tags(model, related=None):
+    """
+    Invalidates the tags of an instance and of its model when it is saved, deleted or one of its many to
+    many fields changes. `related(instance)` returns the tags of other objects the instance is part of,
+    e.g. the coach of a tier.
+    """
+    def instance_tags(instance):
+        return [tag(instance), tag(model), *(related(instance) if related else [])]
+
+    def changed(sender, instance, **kwargs):
+        invalidate_tags(*instance_tags(instance))
+
+    def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        if not reverse:
+            invalidate_tags(*instance_tags(instance))
+        else:
+            # changed from the other side, pk_set are instances of the model, None when all were cleared
+            invalidate_tags(tag(model), *(tag(model, pk) for pk in pk_set or ()))
+
+    uid = f"cache_tags:{model._meta.label_lower}"
+    post_save.connect(changed, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(changed, sender=model, weak=False, dispatch_uid=uid)
+    for field in model._meta.many_to_many:
+        m2m_changed.connect(members_changed, sender=field.remote_field.through, weak=False,
+                            dispatch_uid=f"{uid}:{field.name}")
@@ -0,0 +1,140 @@
+"""
+Resized variants of the uploaded images.
+
+When an image based on `CommonImage` is created an `ImageVariantJob` is recorded, and the
+`generate_image_variants` worker renders the image at each of IMAGE_VARIANT_WIDTHS in each of
+IMAGE_VARIANT_FORMATS. Variants that exist already are skipped, so a job can be run again safely.
+Serializers return the variants with `srcset`, clients pick the smallest one that fits.
+"""
+from datetime import timedelta
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+from .models import ImageVariant, ImageVariantJob
+import time
+
+WIDTHS = getattr(settings, 'IMAGE_VARIANT_WIDTHS', [160, 480, 1080])
+# formats pillow was built without are left out
+FORMATS = [format for format in getattr(settings, 'IMAGE_VARIANT_FORMATS', [ImageVariant.WEBP, ImageVariant.AVIF])
+           if features.check(format)]
+QUALITY = {ImageVariant.WEBP: 80, ImageVariant.AVIF: 60}
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 30
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+
+
+def variant_sizes(width, height):
+    """
+    The (width, height) of the variants of an image, images are never scaled up.
+    """
+    return [(variant_width, max(1, round(height * variant_width / width)))
+            for variant_width in WIDTHS if variant_width < width]
+
+
+def render_variants(file, skip=()):
+    """
+    Renders the variants of the image in `file`, returns (format, width, height, bytes) tuples.
+    `skip` holds the (format, width) pairs that exist already.
+    """
+    with Image.open(file) as original:
+        # phones store the orientation in the exif data instead of rotating the pixels
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            has_alpha = original.mode in ('LA', 'PA') or 'transparency' in original.info
+            original = original.convert('RGBA' if has_alpha else 'RGB')
+        variants = []
+        for width, height in variant_sizes(*original.size):
+            resized = None
+            for format in FORMATS:
+                if (format, width) in skip:
+                    continue
+                if resized is None:
+                    resized = original.resize((width, height), Image.LANCZOS)
+                output = BytesIO()
+                resized.save(output, format.upper(), quality=QUALITY[format])
+                variants.append((format, width, height, output.getvalue()))
+        return variants
+
+
+def generate_variants(image):
+    """
+    Renders and stores the missing variants of an image model instance. Returns the cpu seconds spent.
+    """
+    existing = set(image.variants.values_list('format', 'width'))
+    started = time.process_time()
+    with image.image.open('rb') as file:
+        variants = render_variants(file, skip=existing)
+    cpu_time = time.process_time() - started
+
+    for format, width, height, content in variants:
+        name = f"{image._meta.model_name}-{image.pk}-{width}.{format}"
+        variant = ImageVariant(original=image, format=format, width=width, height=height, size=len(content))
+        variant.image.save(name, ContentFile(content), save=False)
+        try:
+            with transaction.atomic():
+                variant.save()
+        except IntegrityError:
+            # another worker stored the same variant in the meantime
+            variant.image.delete(save=False)
+    return cpu_time
+
+
+def _retry_later(job, error):
+    job.last_error = str(error)
+    if job.attempts >= MAX_ATTEMPTS:
+        job.status = ImageVariantJob.FAILED
+        return
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+    job.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
+def run_job(job):
+    job.attempts += 1
+    try:
+        image = job.original
+        # the image was deleted before its variants were generated
+        if image is not None and image.image:
+            job.cpu_time = generate_variants(image)
+    except Exception as e:
+        _retry_later(job, e)
+    else:
+        job.status = ImageVariantJob.DONE
+        job.last_error = None
+    job.save()
+    return job
+
+
+def process_next_job():
+    """
+    Claims the oldest due job and runs it, None when nothing is due. Several workers can run side by side.
+    """
+    with transaction.atomic():
+        job = ImageVariantJob.objects.select_for_update(skip_locked=True).filter(
+            status=ImageVariantJob.PENDING, next_attempt_at__lte=timezone.now()).order_by('id').first()
+        if job is None:
+            return None
+        return run_job(job)
+
+
+def process_pending_jobs(limit=None):
+    processed = 0
+    while limit is None or processed < limit:
+        if process_next_job() is None:
+            break
+        processed += 1
+    return processed
+
+
+def srcset(image):
+    """
+    The urls of the image's variants by format and width, e.g. {'webp': {160: url, 480: url}}.
+    Uses the prefetched `variants` when the queryset prefetched them.
+    """
+    variants = {}
+    for variant in image.variants.all():
+        variants.setdefault(variant.format, {})[variant.width] = variant.image.url
+    return variants
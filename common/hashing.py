@@ -0,0 +1,48 @@
+"""
+Content addressed image storage.
+
+Images based on `HashedImage` are stored under the sha256 of their content, so uploading the same file twice
+stores one object and rows with the same `content_hash` can share it.
+"""
+import hashlib
+import posixpath
+
+HASHED_IMAGE_FOLDER = 'images/avatars'
+
+
+def content_hash(file):
+    digest = hashlib.sha256()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def hashed_name(digest, name):
+    extension = posixpath.splitext(name)[1].lower()
+    return f"{HASHED_IMAGE_FOLDER}/{digest}{extension}"
+
+
+def store(field_file):
+    """
+    Saves a file that was just assigned under the hash of its content, unless an identical file is stored
+    already. Returns the hash.
+    """
+    digest = content_hash(field_file.file)
+    name = hashed_name(digest, field_file.name)
+    if not field_file.storage.exists(name):
+        name = field_file.storage.save(name, field_file.file)
+    field_file.name = name
+    field_file._committed = True
+    return digest
+
+
+def read_hash(field_file):
+    """
+    The hash of a file that is stored already, e.g. an image uploaded before the hashes were recorded.
+    """
+    with field_file.storage.open(field_file.name, 'rb') as file:
+        return content_hash(file)
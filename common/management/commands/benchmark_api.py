@@ -0,0 +1,138 @@
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from channels.testing import HttpCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.models import ChatRoom
+from posts.models import Post
+from subscribers.models import Subscriber
+from common.benchmarks import summarize, write_results, load_results, compare
+import asyncio
+import logging
+import time
+
+# the endpoints behind the feed, the coach page, the comments, chat, notifications and the profile,
+# formatted with the context of the requesting subscriber
+ENDPOINTS = {
+    'new_posts': '/api/v1/new_posts/',
+    'coach_posts': '/api/v1/coach/{coach}/posts/',
+    'coaches': '/api/v1/coaches/',
+    'comments': '/api/v1/comments/{post}/',
+    'room_messages': '/api/v1/my_chat_rooms/{room}/messages/',
+    'notifications': '/api/v1/notifications/',
+    'unread_notifications_count': '/api/v1/unread_notifications_count/',
+    'user_me': '/api/v1/user/me/',
+    'my_projects': '/api/v1/my_projects/',
+}
+
+
+class Command(BaseCommand):
+    help = ('Measures the latency and throughput of the hot API endpoints with concurrent authenticated clients '
+            'against the ASGI application, run it on a database seeded with generate_dataset')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS))
+        parser.add_argument('--users', type=int, default=50, help='Subscribers the requests are spread over')
+        parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at the same time')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='Requests per endpoint before measuring')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds a request may take')
+        parser.add_argument('--output-dir', help='Where the results are written, BENCHMARK_RESULTS_DIR by default')
+        parser.add_argument('--compare', help='Results of an earlier run to compare with')
+
+    def viewers(self, count):
+        """
+        The context of subscribers who follow a coach with posts and are in a chat room, the first `count` by id
+        so runs on the same dataset request the same pages.
+        """
+        subscribers = Subscriber.objects.filter(
+            subscriptions__tier__coach__posts__isnull=False, chat_rooms__isnull=False
+        ).select_related('user').distinct().order_by('id')[:count]
+        viewers = []
+        for subscriber in subscribers:
+            post = Post.objects.filter(coach__tiers__subscriptions__subscriber=subscriber).select_related(
+                'coach').order_by('-id').first()
+            room = ChatRoom.objects.filter(members=subscriber).order_by('id').first()
+            viewers.append({
+                'token': str(RefreshToken.for_user(subscriber.user).access_token),
+                'coach': post.coach.surrogate,
+                'post': post.surrogate,
+                'room': room.surrogate,
+            })
+        return viewers
+
+    async def request(self, application, path, token, timeout):
+        communicator = HttpCommunicator(application, 'GET', path, headers=[
+            (b'host', b'localhost'),
+            (b'authorization', f'Bearer {token}'.encode()),
+        ])
+        started = time.perf_counter()
+        response = await communicator.get_response(timeout=timeout)
+        latency = time.perf_counter() - started
+        headers = {name.lower(): value for name, value in response['headers']}
+        queries = headers.get(b'x-db-query-count')
+        return response['status'], latency, int(queries) if queries is not None else None
+
+    async def run(self, application, template, viewers, total, concurrency, timeout):
+        latencies, queries, status_codes = [], [], Counter()
+        next_request = iter(range(total))
+
+        async def worker():
+            for index in next_request:
+                viewer = viewers[index % len(viewers)]
+                try:
+                    status, latency, query_count = await self.request(
+                        application, template.format(**viewer), viewer['token'], timeout)
+                except asyncio.TimeoutError:
+                    status_codes['timeout'] += 1
+                    continue
+                status_codes[str(status)] += 1
+                if status == 200:
+                    latencies.append(latency)
+                if query_count is not None:
+                    queries.append(query_count)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, queries, status_codes, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        from coach.asgi import application
+
+        viewers = self.viewers(options['users'])
+        if not viewers:
+            raise CommandError('No subscriber follows a coach with posts and is in a chat room, run generate_dataset')
+        self.stdout.write(f"{len(viewers)} users, concurrency {options['concurrency']}, "
+                          f"{options['requests']} requests per endpoint on {connection.vendor}")
+
+        cases = {}
+        # the query counts come back in the headers, logging every request would only slow the run down
+        logging.getLogger('coach.queries').setLevel(logging.WARNING)
+        with override_settings(QUERY_COUNT_HEADERS=True):
+            for name in options['endpoints']:
+                template = ENDPOINTS[name]
+                if options['warmup']:
+                    asyncio.run(self.run(application, template, viewers, options['warmup'],
+                                         options['concurrency'], options['timeout']))
+                latencies, queries, status_codes, elapsed = asyncio.run(self.run(
+                    application, template, viewers, options['requests'], options['concurrency'], options['timeout']))
+                case = summarize(latencies, elapsed)
+                case['errors'] = options['requests'] - status_codes['200']
+                case['status_codes'] = dict(status_codes)
+                case['queries_per_request'] = round(sum(queries) / len(queries), 1) if queries else None
+                cases[name] = case
+                self.stdout.write(
+                    f"{name}: p50 {case['p50_ms']}ms p95 {case['p95_ms']}ms p99 {case['p99_ms']}ms "
+                    f"{case['per_second']}/s queries {case['queries_per_request']} errors {case['errors']}")
+
+        results = {
+            'database': connection.vendor,
+            'options': {key: options[key] for key in ('users', 'concurrency', 'requests', 'warmup')},
+            'cases': cases,
+        }
+        path = write_results('api', results, options['output_dir'])
+        self.stdout.write(f"Results written to {path}")
+        if options['compare']:
+            for line in compare(results, load_results(options['compare'])):
+                self.stdout.write(line)
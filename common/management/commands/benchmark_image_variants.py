@@ -0,0 +1,59 @@
+from io import BytesIO
+from django.core.management.base import BaseCommand
+from PIL import Image
+from common.derivatives import render_variants, FORMATS, WIDTHS
+import glob
+import os
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measures the cpu time rendering the variants of an image takes, on generated photos or the given files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Images to render, photos are generated when none are given')
+        parser.add_argument('--images', type=int, default=20, help='Photos to generate')
+        parser.add_argument('--width', type=int, default=3024)
+        parser.add_argument('--height', type=int, default=4032)
+
+    def generated(self, options):
+        for _ in range(options['images']):
+            # noise compresses as badly as a photo does
+            size = (options['width'], options['height'])
+            image = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+            image = image.resize((size[0] // 8, size[1] // 8)).resize(size, Image.BILINEAR)
+            output = BytesIO()
+            image.save(output, 'JPEG', quality=random.randint(80, 95))
+            yield output.getvalue()
+
+    def given(self, paths):
+        for pattern in paths:
+            for path in glob.glob(pattern):
+                with open(path, 'rb') as file:
+                    yield file.read()
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"widths {WIDTHS}, formats {FORMATS}")
+        cpu_times = []
+        original_bytes = 0
+        variant_bytes = {}
+        images = self.given(options['paths']) if options['paths'] else self.generated(options)
+        for content in images:
+            started = time.process_time()
+            variants = render_variants(BytesIO(content))
+            cpu_times.append((time.process_time() - started) * 1000)
+            original_bytes += len(content)
+            for format, width, height, data in variants:
+                variant_bytes[(format, width)] = variant_bytes.get((format, width), 0) + len(data)
+
+        if not cpu_times:
+            self.stdout.write('No images')
+            return
+        count = len(cpu_times)
+        cpu_times.sort()
+        self.stdout.write(f"{count} images, cpu time per image: median {cpu_times[count // 2]:.0f}ms, "
+                          f"max {cpu_times[-1]:.0f}ms, mean {sum(cpu_times) / count:.0f}ms")
+        self.stdout.write(f"original: {original_bytes / count / 1024:.0f}KB on average")
+        for (format, width), size in sorted(variant_bytes.items()):
+            self.stdout.write(f"{format} {width}w: {size / count / 1024:.1f}KB on average")
@@ -0,0 +1,342 @@
+from collections import Counter
+from urllib.parse import urlparse
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.models import ChatRoom
+from subscribers.models import Subscriber
+from common.benchmarks import summarize, write_results, load_results, compare, process_usage
+import asyncio
+import base64
+import channels.layers
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+class WebSocketClient:
+    """
+    A minimal RFC 6455 client on asyncio streams. autobahn's asyncio client can't be used next to daphne, which
+    sets txaio up for twisted when it's imported.
+    """
+
+    def __init__(self, reader, writer, on_message):
+        self.reader = reader
+        self.writer = writer
+        self.on_message = on_message
+
+    @classmethod
+    async def connect(cls, url, protocols, on_message):
+        parsed = urlparse(url)
+        reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET {parsed.path} HTTP/1.1\r\n"
+                      f"Host: {parsed.netloc}\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      f"Sec-WebSocket-Key: {key}\r\n"
+                      "Sec-WebSocket-Version: 13\r\n"
+                      f"Sec-WebSocket-Protocol: {', '.join(protocols)}\r\n\r\n").encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        status = response.split(b'\r\n', 1)[0]
+        if b' 101 ' not in status:
+            writer.close()
+            raise ConnectionError(status.decode(errors='replace'))
+        client = cls(reader, writer, on_message)
+        client.task = asyncio.ensure_future(client.receive())
+        return client
+
+    def frame(self, opcode, payload):
+        # frames sent by clients are masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 2 ** 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        return header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    def send(self, text):
+        self.writer.write(self.frame(0x1, text.encode()))
+
+    async def receive(self):
+        message = b''
+        try:
+            while True:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7f
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                payload = await self.reader.readexactly(length)
+                opcode = first & 0x0f
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self.writer.write(self.frame(0xa, payload))
+                elif opcode in (0x0, 0x1):
+                    message += payload
+                    if first & 0x80:
+                        self.on_message(json.loads(message))
+                        message = b''
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.write(self.frame(0x8, struct.pack('!H', 1000)))
+        self.task.cancel()
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = ('Opens many authenticated websockets to the chat and notification consumers, sends chat messages and '
+            'notifications at a fixed rate and measures the latency until each socket receives them, together '
+            'with the cpu and memory of the server. Run it on a database seeded with generate_dataset with Redis '
+            'running, the chat messages it sends are stored like any other.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='ws://host:port of a running server, by default daphne is started')
+        parser.add_argument('--server-pid', type=int, help='Process of the server at --url to measure')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--users', type=int, default=500, help='Subscribers, each with a notifications socket')
+        parser.add_argument('--connections', type=int, default=2000, help='Chat sockets spread over the rooms')
+        parser.add_argument('--max-room-size', type=int, default=200)
+        parser.add_argument('--room-size-alpha', type=float, default=1.2,
+                            help='Room sizes follow a pareto distribution, lower is more skewed to large rooms')
+        parser.add_argument('--connect-rate', type=int, default=200, help='Sockets opened per second')
+        parser.add_argument('--message-rate', type=float, default=20, help='Chat messages sent per second')
+        parser.add_argument('--notification-rate', type=float, default=50, help='Notifications sent per second')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to send messages and notifications')
+        parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for deliveries after sending')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds opening a socket may take')
+        parser.add_argument('--output-dir', help='Where the results are written, BENCHMARK_RESULTS_DIR by default')
+        parser.add_argument('--compare', help='Results of an earlier run to compare with')
+
+    def plan(self, options):
+        """
+        The users with their tokens and the rooms with the users joining them. Most rooms are small and a few
+        are large, the consumers don't check membership so any user can join any room.
+        """
+        subscribers = list(Subscriber.objects.select_related('user').order_by('id')[:options['users']])
+        rooms = list(ChatRoom.objects.order_by('id').values_list('surrogate', flat=True))
+        if not subscribers or not rooms:
+            raise CommandError('No subscribers or chat rooms, run generate_dataset first')
+        users = [{'surrogate': str(subscriber.user.surrogate),
+                  'token': str(RefreshToken.for_user(subscriber.user).access_token)} for subscriber in subscribers]
+
+        rng = random.Random(options['seed'])
+        planned = []
+        remaining = options['connections']
+        for surrogate in rooms:
+            if remaining <= 0:
+                break
+            size = min(int(rng.paretovariate(options['room_size_alpha'])) + 1, options['max_room_size'],
+                       len(users), remaining)
+            planned.append((str(surrogate), rng.sample(users, size)))
+            remaining -= size
+        return users, planned
+
+    async def connect(self, url, path, token, on_message, timeout):
+        started = time.perf_counter()
+        # JWTChannelMiddleware reads the token from the subprotocols
+        client = await asyncio.wait_for(
+            WebSocketClient.connect(f"{url}{path}", ['authorization', f'Bearer:{token}'], on_message), timeout)
+        return client, time.perf_counter() - started
+
+    async def open_all(self, sockets, options):
+        """
+        Opens the (path, token, on_message) sockets at the connect rate, returns the clients in the same order,
+        None where opening failed, the time opening each took and the errors.
+        """
+        latencies, errors = [], Counter()
+
+        async def open_one(path, token, on_message):
+            try:
+                client, latency = await self.connect(self.url, path, token, on_message, options['timeout'])
+            except (OSError, asyncio.TimeoutError) as error:
+                errors[type(error).__name__] += 1
+                return None
+            latencies.append(latency)
+            return client
+
+        started = time.perf_counter()
+        tasks = []
+        for index, (path, token, on_message) in enumerate(sockets):
+            await asyncio.sleep(max(0, started + index / options['connect_rate'] - time.perf_counter()))
+            tasks.append(asyncio.ensure_future(open_one(path, token, on_message)))
+        results = await asyncio.gather(*tasks)
+        return results, latencies, errors, time.perf_counter() - started
+
+    async def send_at_rate(self, rate, duration, send):
+        started = time.perf_counter()
+        count = int(rate * duration)
+        for sequence in range(count):
+            await asyncio.sleep(max(0, started + sequence / rate - time.perf_counter()))
+            await send(sequence)
+        return count
+
+    def sample(self):
+        cpu, rss = process_usage(self.server_pid) if self.server_pid else (None, None)
+        return time.perf_counter(), cpu, rss
+
+    async def benchmark(self, users, rooms, options):
+        rng = random.Random(options['seed'])
+        sent = {}
+        latencies = {'chat': [], 'notifications': []}
+        received = Counter()
+
+        def on_message(kind):
+            def received_message(data):
+                # chat messages carry the sequence number in their text, notifications in their id
+                text = data.get('message') if kind == 'chat' else data.get('id')
+                if not isinstance(text, str) or not text.startswith('benchmark '):
+                    return
+                sent_at = sent.get((kind, int(text.split()[1])))
+                if sent_at is not None:
+                    latencies[kind].append(time.perf_counter() - sent_at)
+                    received[kind] += 1
+            return received_message
+
+        idle = self.sample()
+        sockets = [('/ws/notifications/', user['token'], on_message('notifications')) for user in users]
+        for room, members in rooms:
+            sockets += [(f'/ws/chat/{room}/', member['token'], on_message('chat')) for member in members]
+        clients, connect_latencies, connect_errors, connect_elapsed = await self.open_all(sockets, options)
+        connected = self.sample()
+        self.stdout.write(f"{len(connect_latencies)} of {len(sockets)} sockets open in {connect_elapsed:.1f}s")
+
+        # the senders of a room are its open chat sockets
+        room_clients = []
+        offset = len(users)
+        for room, members in rooms:
+            open_clients = [client for client in clients[offset:offset + len(members)] if client is not None]
+            offset += len(members)
+            if open_clients:
+                room_clients.append((room, open_clients))
+        notified = [user for user, client in zip(users, clients) if client is not None]
+        expected = Counter()
+
+        async def send_message(sequence):
+            room, open_clients = rng.choice(room_clients)
+            sent['chat', sequence] = time.perf_counter()
+            expected['chat'] += len(open_clients)
+            rng.choice(open_clients).send(json.dumps({'text': f'benchmark {sequence}', 'room': room}))
+
+        channel_layer = channels.layers.get_channel_layer()
+
+        async def send_notification(sequence):
+            user = rng.choice(notified)
+            sent['notifications', sequence] = time.perf_counter()
+            expected['notifications'] += 1
+            await channel_layer.group_send(f"{user['surrogate']}.notifications.group",
+                                           {'type': 'send.notification', 'id': f'benchmark {sequence}'})
+
+        senders = []
+        if room_clients and options['message_rate']:
+            senders.append(self.send_at_rate(options['message_rate'], options['duration'], send_message))
+        if notified and options['notification_rate']:
+            senders.append(self.send_at_rate(options['notification_rate'], options['duration'], send_notification))
+        started = time.perf_counter()
+        await asyncio.gather(*senders)
+        await asyncio.sleep(options['drain'])
+        finished = self.sample()
+        elapsed = time.perf_counter() - started
+
+        for client in clients:
+            if client is not None:
+                client.close()
+
+        cases = {'connect': {**summarize(connect_latencies, connect_elapsed), 'errors': dict(connect_errors)}}
+        for kind in ('chat', 'notifications'):
+            cases[kind] = {**summarize(latencies[kind], elapsed), 'expected': expected[kind],
+                           'lost': expected[kind] - received[kind]}
+        server = {}
+        if idle[2] is not None:
+            open_sockets = len(connect_latencies)
+            server = {
+                'rss_idle_mb': round(idle[2] / 2 ** 20, 1),
+                'rss_connected_mb': round(connected[2] / 2 ** 20, 1),
+                'rss_finished_mb': round(finished[2] / 2 ** 20, 1),
+                'kb_per_socket': round((connected[2] - idle[2]) / 1024 / open_sockets, 1) if open_sockets else None,
+                'cpu_connect_percent': round((connected[1] - idle[1]) / (connected[0] - idle[0]) * 100, 1),
+                'cpu_messages_percent': round((finished[1] - connected[1]) / (finished[0] - connected[0]) * 100, 1),
+            }
+        return cases, server
+
+    def start_server(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        # without SECRET_KEY in the environment each process generates its own and the tokens wouldn't verify
+        server = subprocess.Popen([sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port),
+                                   'coach.asgi:application'], stdout=subprocess.DEVNULL,
+                                  env={**os.environ, 'SECRET_KEY': settings.SECRET_KEY})
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    server.kill()
+                    raise CommandError('daphne did not start')
+                time.sleep(0.2)
+        return server, f"ws://127.0.0.1:{port}"
+
+    def handle(self, *args, **options):
+        # a socket is a file, both this process and the server it starts need more than the default 1024
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        users, rooms = self.plan(options)
+        sizes = sorted(len(members) for room, members in rooms)
+        self.stdout.write(f"{len(users)} users, {len(rooms)} rooms of {sizes[0]} to {sizes[-1]} sockets, "
+                          f"median {sizes[len(sizes) // 2]}")
+
+        server = None
+        if options['url']:
+            self.url, self.server_pid = options['url'].rstrip('/'), options['server_pid']
+        else:
+            server, self.url = self.start_server()
+            self.server_pid = server.pid
+        try:
+            cases, server_usage = asyncio.run(self.benchmark(users, rooms, options))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        for name, case in cases.items():
+            self.stdout.write(f"{name}: {case['count']} p50 {case['p50_ms']}ms p95 {case['p95_ms']}ms "
+                              f"p99 {case['p99_ms']}ms {case['per_second']}/s")
+        if cases['chat']['lost'] or cases['notifications']['lost']:
+            self.stdout.write(f"lost {cases['chat']['lost']} chat and {cases['notifications']['lost']} "
+                              f"notification deliveries")
+        for name, value in server_usage.items():
+            self.stdout.write(f"server {name}: {value}")
+
+        options_used = ('seed', 'users', 'connections', 'max_room_size', 'room_size_alpha', 'connect_rate',
+                        'message_rate', 'notification_rate', 'duration')
+        results = {
+            'options': {key: options[key] for key in options_used},
+            'rooms': {'count': len(rooms), 'sizes': dict(Counter(sizes))},
+            'server': server_usage,
+            'cases': cases,
+        }
+        path = write_results('websockets', results, options['output_dir'])
+        self.stdout.write(f"Results written to {path}")
+        if options['compare']:
+            for line in compare(results, load_results(options['compare'])):
+                self.stdout.write(line)
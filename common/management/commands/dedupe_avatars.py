@@ -0,0 +1,102 @@
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from common.hashing import HASHED_IMAGE_FOLDER, hashed_name
+from common.models import CommonImage, ImageVariant
+from instructor.models import Coach, CoachAvatar
+from subscribers.models import SubscriberAvatar
+from uploads.models import Upload
+
+# an avatar is unused when nothing points to it, deleting one that is used would delete its coach or subscriber
+UNUSED = {
+    CoachAvatar: {'coach__isnull': True},
+    SubscriberAvatar: {'subscriber__isnull': True},
+}
+
+
+class Command(BaseCommand):
+    help = ('Collapses coach avatars with the same content into one row, deletes avatars nothing uses and '
+            'the stored files only they referenced. Best run when few profiles are being edited.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted without deleting')
+
+    def record_hashes(self):
+        for model in (SubscriberAvatar, CoachAvatar):
+            for avatar in model.objects.filter(content_hash__isnull=True).exclude(image='').exclude(image=None):
+                try:
+                    avatar.get_content_hash()
+                except (IOError, OSError) as e:
+                    self.stderr.write(f"Could not read {model.__name__} {avatar.pk} {avatar.image.name}: {e}")
+
+    def duplicates(self):
+        """
+        The coach avatars with the content of an older one, with the avatar each should be replaced with.
+        """
+        keepers = {}
+        duplicates = []
+        for avatar in CoachAvatar.objects.exclude(content_hash=None).order_by('id'):
+            keeper = keepers.setdefault(avatar.content_hash, avatar)
+            if keeper is not avatar:
+                duplicates.append((avatar, keeper))
+        return duplicates
+
+    def is_referenced(self, name, removed):
+        # the rows copied the file names, so a file can be used by images of any model
+        for model in apps.get_models():
+            if issubclass(model, CommonImage):
+                if model.objects.filter(image=name).exclude(pk__in=removed.get(model, ())).exists():
+                    return True
+        return False
+
+    def confirmed_uploads(self):
+        # confirming an avatar upload stores it under its hash, the avatar pointing to it is only created when
+        # the upload is claimed
+        uploads = Upload.objects.filter(status=Upload.CONFIRMED).exclude(content_hash=None)
+        return {hashed_name(content_hash, name) for content_hash, name in uploads.values_list('content_hash', 'name')}
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        self.record_hashes()
+
+        duplicates = self.duplicates()
+        duplicate_ids = {avatar.pk for avatar, keeper in duplicates}
+        removed = {model: set(model.objects.filter(**unused).values_list('pk', flat=True))
+                   for model, unused in UNUSED.items()}
+        unused_coach_avatars = len(removed[CoachAvatar] - duplicate_ids)
+        removed[CoachAvatar] |= duplicate_ids
+
+        names = set()
+        variant_names = set()
+        for model, ids in removed.items():
+            names.update(model.objects.filter(pk__in=ids).exclude(image='').values_list('image', flat=True))
+            variant_names.update(ImageVariant.objects.filter(
+                content_type__app_label=model._meta.app_label, content_type__model=model._meta.model_name,
+                object_id__in=ids).values_list('image', flat=True))
+        try:
+            _, stored = default_storage.listdir(HASHED_IMAGE_FOLDER)
+        except FileNotFoundError:
+            stored = []
+        names.update(f"{HASHED_IMAGE_FOLDER}/{name}" for name in stored)
+        names -= self.confirmed_uploads()
+        orphans = sorted(name for name in names if name and not self.is_referenced(name, removed))
+
+        self.stdout.write(f"{len(duplicates)} duplicate coach avatars, "
+                          f"{unused_coach_avatars} unused coach avatars, "
+                          f"{len(removed[SubscriberAvatar])} unused subscriber avatars, "
+                          f"{len(orphans) + len(variant_names)} orphaned files")
+        if dry_run:
+            for name in orphans:
+                self.stdout.write(f"Would delete {name}")
+            return
+
+        with transaction.atomic():
+            for avatar, keeper in duplicates:
+                Coach.objects.filter(avatar=avatar).update(avatar=keeper)
+            for model, ids in removed.items():
+                # deleting the avatars deletes their variants too
+                model.objects.filter(pk__in=ids, **UNUSED[model]).delete()
+        for name in orphans + sorted(variant_names):
+            default_storage.delete(name)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(orphans) + len(variant_names)} files"))
@@ -0,0 +1,435 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from notifications.models import Notification
+from accounts.models import User
+from chat.models import ChatRoom, Message
+from comments.models import Comment
+from common.bulkload import Loader
+from instructor.models import Coach
+from posts.models import Post
+from projects.models import Project, Prerequisite, Milestone, Team, MilestoneCompletionReport
+from reacts.models import React
+from subscribers.models import Subscriber, Subscription
+from tiers.models import Tier
+import random
+import time
+import uuid
+
+EMAIL_DOMAIN = 'synthetic.example'
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+SPAN_SECONDS = 365 * 24 * 60 * 60
+
+WORDS = ('the a to and of project milestone team python react design api deploy build test review data '
+         'model week today finally shipped feedback question answer help idea video stream code bug fix '
+         'great thanks learn practice progress launch plan next step update release').split()
+
+# the share of subscriptions to the paid tier, the rest are free
+PAID_SHARE = 0.3
+UNREAD_SHARE = 0.3
+
+
+def through_row(m2m_field, source_id, target_id):
+    """
+    A row of the m2m table of `m2m_field`, e.g. the post and tier of Post.tiers.
+    """
+    return {f"{m2m_field.m2m_field_name()}_id": source_id, f"{m2m_field.m2m_reverse_field_name()}_id": target_id}
+
+
+class Command(BaseCommand):
+    help = ('Generates a deterministic synthetic dataset of coaches, subscribers, posts, comments, reacts, projects, '
+            'chats and notifications to benchmark against. Rows are loaded with COPY on PostgreSQL and bulk_create '
+            'elsewhere, without signals, so no stripe calls are queued and the stripe ids are made up.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of every kind of row')
+        parser.add_argument('--coaches', type=int, default=2000)
+        parser.add_argument('--subscribers', type=int, default=200000)
+        parser.add_argument('--subscriptions-per-subscriber', type=int, default=3)
+        parser.add_argument('--posts', type=int, default=1000000)
+        parser.add_argument('--comments', type=int, default=500000)
+        parser.add_argument('--reacts', type=int, default=2000000)
+        parser.add_argument('--projects-per-coach', type=int, default=2)
+        parser.add_argument('--milestones-per-project', type=int, default=3)
+        parser.add_argument('--teams-per-project', type=int, default=3)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--notifications', type=int, default=2000000)
+        parser.add_argument('--password', default='synthetic', help='The password of every generated user')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def text(self, low=5, high=40):
+        return ' '.join(self.rng.choices(WORDS, k=self.rng.randint(low, high)))
+
+    def uuid(self):
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def scaled(self, options, name, minimum=0):
+        return max(minimum, int(options[name] * options['scale']))
+
+    def stage(self, name, load):
+        started = time.monotonic()
+        before = sum(self.loader.counts.values())
+        with transaction.atomic(using=self.loader.using):
+            load()
+        rows = sum(self.loader.counts.values()) - before
+        self.stdout.write(f"{name}: {rows} rows in {time.monotonic() - started:.1f}s")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(email__endswith=f"@{EMAIL_DOMAIN}").exists():
+            raise CommandError('The database has a synthetic dataset already')
+
+        self.rng = random.Random(options['seed'])
+        self.loader = Loader(batch_size=options['batch_size'])
+        self.options = options
+        self.coach_count = self.scaled(options, 'coaches', 1)
+        self.subscriber_count = self.scaled(options, 'subscribers', 1)
+        # a few coaches get most of the subscribers
+        weights = [1 / (rank + 1) ** 0.8 for rank in range(self.coach_count)]
+        total = 0
+        self.coach_weights = []
+        for weight in weights:
+            total += weight
+            self.coach_weights.append(total)
+
+        self.stage('users', self.load_users)
+        self.stage('coaches', self.load_coaches)
+        self.stage('subscriptions', self.load_subscriptions)
+        self.stage('posts', self.load_posts)
+        self.stage('comments', self.load_comments)
+        self.stage('reacts', self.load_reacts)
+        self.stage('projects', self.load_projects)
+        self.stage('messages', self.load_messages)
+        self.stage('notifications', self.load_notifications)
+        self.loader.reset_sequences(list(self.loader.counts))
+
+        for model, count in self.loader.counts.items():
+            self.stdout.write(f"{model._meta.label}: {count}")
+
+    def at(self, fraction):
+        return START + timedelta(seconds=int(SPAN_SECONDS * fraction))
+
+    # users: the coaches come first, then the subscribers, each with their subscriber profile
+
+    def load_users(self):
+        users = self.coach_count + self.subscriber_count
+        self.first_user = self.loader.allocate(User, users)
+        self.first_subscriber = self.loader.allocate(Subscriber, users)
+        # hashing is slow on purpose, every user gets the same hash
+        password = make_password(self.options['password'], salt='synthetic')
+
+        def users_rows():
+            for index in range(users):
+                is_coach = index < self.coach_count
+                name = f"coach{index}" if is_coach else f"sub{index - self.coach_count}"
+                yield {
+                    'id': self.first_user + index, 'password': password, 'last_login': None, 'is_superuser': False,
+                    'first_name': '', 'last_name': '', 'is_staff': False, 'is_active': True,
+                    'date_joined': self.at(index / users), 'username': name, 'email': f"{name}@{EMAIL_DOMAIN}",
+                    'is_coach': is_coach, 'is_subscriber': True, 'surrogate': self.uuid(),
+                }
+
+        def subscriber_rows():
+            for index in range(users):
+                yield {
+                    'id': self.first_subscriber + index, 'surrogate': self.uuid(), 'user_id': self.first_user + index,
+                    'name': f"Coach {index}" if index < self.coach_count else f"Subscriber {index - self.coach_count}",
+                    'customer_id': f"cus_synthetic{index}", 'avatar_id': None, 'last_seen_post_id': None,
+                }
+
+        self.loader.load(User, users_rows())
+        self.loader.load(Subscriber, subscriber_rows())
+
+    def subscriber_id(self, index):
+        return self.first_subscriber + self.coach_count + index
+
+    def subscriber_user_id(self, index):
+        return self.first_user + self.coach_count + index
+
+    # coaches with a free and a paid tier
+
+    def load_coaches(self):
+        self.first_coach = self.loader.allocate(Coach, self.coach_count)
+        self.first_tier = self.loader.allocate(Tier, 2 * self.coach_count)
+
+        def coach_rows():
+            for index in range(self.coach_count):
+                yield {
+                    'id': self.first_coach + index, 'name': f"Coach {index}", 'user_id': self.first_user + index,
+                    'surrogate': self.uuid(), 'avatar_id': None, 'expertise_field_id': None, 'bio': self.text(5, 20),
+                    'seen_welcome_page': True, 'submitted_expertise': True,
+                    'qa_session_credit': Decimal('15.00'), 'qa_session_credit_currency': 'EUR',
+                    'stripe_id': f"acct_synthetic{index}", 'stripe_account_link': None, 'charges_enabled': True,
+                    'stripe_created': None, 'stripe_expires_at': None,
+                }
+
+        def tier_rows():
+            for index in range(self.coach_count):
+                for offset, (tier, credit, label) in enumerate([(Tier.FREE, Decimal('0.00'), 'Free'),
+                                                                (Tier.TIER1, Decimal('9.00'), 'Basic')]):
+                    tier_id = self.first_tier + 2 * index + offset
+                    yield {
+                        'id': tier_id, 'tier': tier, 'surrogate': self.uuid(), 'credit': credit,
+                        'credit_currency': 'EUR', 'label': label,
+                        'subheading': 'Free for everyone' if tier == Tier.FREE else f"{credit}/month",
+                        'coach_id': self.first_coach + index, 'product_id': f"prod_synthetic{tier_id}",
+                        'price_id': f"price_synthetic{tier_id}",
+                    }
+
+        self.loader.load(Coach, coach_rows())
+        self.loader.load(Tier, tier_rows())
+
+    def tier_id(self, coach_index, paid):
+        return self.first_tier + 2 * coach_index + (1 if paid else 0)
+
+    def load_subscriptions(self):
+        # which subscribers follow which coach, the projects and notifications are made of these
+        self.coach_subscribers = [[] for _ in range(self.coach_count)]
+        self.subscriber_coaches = []
+
+        def rows():
+            for index in range(self.subscriber_count):
+                coaches = sorted(set(self.rng.choices(range(self.coach_count), cum_weights=self.coach_weights,
+                                                      k=self.options['subscriptions_per_subscriber'])))
+                self.subscriber_coaches.append(coaches)
+                for coach_index in coaches:
+                    self.coach_subscribers[coach_index].append(index)
+                    tier_id = self.tier_id(coach_index, self.rng.random() < PAID_SHARE)
+                    subscription_id = self.loader.allocate(Subscription)
+                    yield {
+                        'id': subscription_id, 'subscriber_id': self.subscriber_id(index), 'tier_id': tier_id,
+                        'subscription_id': f"sub_synthetic{subscription_id}", 'customer_id': f"cus_synthetic{index}",
+                        'price_id': f"price_synthetic{tier_id}", 'json_data': None,
+                    }
+
+        self.loader.load(Subscription, rows())
+
+    # posts, spread evenly over the coaches and the year
+
+    def load_posts(self):
+        self.post_count = self.scaled(self.options, 'posts', self.coach_count)
+        self.first_post = self.loader.allocate(Post, self.post_count)
+        per_coach, extra = divmod(self.post_count, self.coach_count)
+        self.post_starts = []
+        self.post_counts = []
+        start = self.first_post
+        for index in range(self.coach_count):
+            count = per_coach + (1 if index < extra else 0)
+            self.post_starts.append(start)
+            self.post_counts.append(count)
+            start += count
+
+        def rows(through):
+            for coach_index in range(self.coach_count):
+                for local in range(self.post_counts[coach_index]):
+                    post_id = self.post_starts[coach_index] + local
+                    tier_id = self.tier_id(coach_index, self.rng.random() < PAID_SHARE)
+                    if through:
+                        yield through_row(Post.tiers.field, post_id, tier_id)
+                        continue
+                    created = self.post_created(post_id)
+                    yield {
+                        'id': post_id, 'surrogate': self.uuid(), 'created': created, 'updated': created,
+                        'text': self.text(), 'text_html': None, 'coach_id': self.first_coach + coach_index,
+                        'linked_project_id': None, 'tier_id': tier_id, 'status': Post.DONE,
+                    }
+
+        self.loader.load(Post, rows(through=False))
+        self.loader.load(Post.tiers.through, rows(through=True))
+
+    def post_coach(self, post_id):
+        return bisect_right(self.post_starts, post_id) - 1
+
+    def post_created(self, post_id):
+        coach_index = self.post_coach(post_id)
+        local = post_id - self.post_starts[coach_index]
+        return self.at(local / self.post_counts[coach_index])
+
+    def random_post(self, coach_index=None):
+        if coach_index is None:
+            return self.rng.randrange(self.first_post, self.first_post + self.post_count)
+        return self.post_starts[coach_index] + self.rng.randrange(self.post_counts[coach_index])
+
+    # comment threads: a comment with a few replies, laid out as an mptt tree of its own
+
+    def load_comments(self):
+        total = self.scaled(self.options, 'comments')
+        first_tree = (Comment.objects.aggregate(last=Max('tree_id'))['last'] or 0) + 1
+        self.first_comment = self.loader.allocate(Comment, total)
+        self.comment_count = total
+
+        def rows():
+            comment_id = self.first_comment
+            tree_id = first_tree
+            while comment_id < self.first_comment + total:
+                post_id = self.random_post()
+                replies = min(self.rng.choice((0, 0, 1, 2, 3)), self.first_comment + total - comment_id - 1)
+                created = self.post_created(post_id) + timedelta(minutes=self.rng.randint(1, 600))
+                author = self.subscriber_id(self.rng.randrange(self.subscriber_count))
+                root_id = comment_id
+                yield {
+                    'id': root_id, 'surrogate': self.uuid(), 'created': created, 'updated': created,
+                    'user_id': author, 'text': self.text(3, 30), 'post_id': post_id, 'parent_id': None,
+                    'reply_to_id': None, 'lft': 1, 'rght': 2 * replies + 2, 'tree_id': tree_id, 'level': 0,
+                }
+                for reply in range(replies):
+                    created += timedelta(minutes=self.rng.randint(1, 120))
+                    yield {
+                        'id': root_id + 1 + reply, 'surrogate': self.uuid(), 'created': created, 'updated': created,
+                        'user_id': self.subscriber_id(self.rng.randrange(self.subscriber_count)),
+                        'text': self.text(3, 30), 'post_id': post_id, 'parent_id': root_id, 'reply_to_id': author,
+                        'lft': 2 * reply + 2, 'rght': 2 * reply + 3, 'tree_id': tree_id, 'level': 1,
+                    }
+                comment_id += replies + 1
+                tree_id += 1
+
+        self.loader.load(Comment, rows())
+
+    def load_reacts(self):
+        total = self.scaled(self.options, 'reacts')
+        post_type = ContentType.objects.get_for_model(Post)
+        comment_type = ContentType.objects.get_for_model(Comment)
+        users = self.coach_count + self.subscriber_count
+
+        def rows():
+            for _ in range(total):
+                # most reacts are on posts, the rest on comments
+                if self.comment_count and self.rng.random() < 0.2:
+                    content_type, object_id = comment_type.id, self.first_comment + self.rng.randrange(
+                        self.comment_count)
+                else:
+                    content_type, object_id = post_type.id, self.random_post()
+                yield {
+                    'type': React.LIKE if self.rng.random() < 0.9 else React.DISLIKE,
+                    'content_type_id': content_type, 'object_id': object_id,
+                    'user_id': self.first_user + self.rng.randrange(users),
+                }
+
+        self.loader.load(React, rows())
+
+    # projects with milestones and teams of the coach's subscribers, each team with its chat room and reports
+
+    def load_projects(self):
+        options = self.options
+        projects = []
+        prerequisites = []
+        milestones = []
+        teams = []
+        rooms = []
+        reports = []
+        project_members = []
+        team_members = []
+        room_members = []
+        report_members = []
+        # the chat rooms and their members, the messages are posted in these
+        self.rooms = []
+
+        for coach_index in range(self.coach_count):
+            for _ in range(options['projects_per_coach']):
+                project_id = self.loader.allocate(Project)
+                team_size = self.rng.randint(1, 4)
+                projects.append({
+                    'id': project_id, 'difficulty': self.rng.choice(Project.DIFFICULTIES)[0],
+                    'surrogate': self.uuid(), 'coach_id': self.first_coach + coach_index,
+                    'name': self.text(2, 5)[:200], 'description': self.text(10, 60), 'team_size': team_size,
+                    'credit': Decimal('10.00'), 'credit_currency': 'EUR',
+                    'product_id': f"prod_synthetic_project{project_id}",
+                    'price_id': f"price_synthetic_project{project_id}",
+                })
+                prerequisites.append({'id': self.loader.allocate(Prerequisite), 'surrogate': self.uuid(),
+                                      'description': self.text(3, 10), 'project_id': project_id})
+                milestone_ids = []
+                for _ in range(options['milestones_per_project']):
+                    milestone_id = self.loader.allocate(Milestone)
+                    milestone_ids.append(milestone_id)
+                    milestones.append({'id': milestone_id, 'surrogate': self.uuid(),
+                                       'description': self.text(3, 15), 'project_id': project_id})
+
+                candidates = self.coach_subscribers[coach_index]
+                joined = set()
+                for _ in range(options['teams_per_project']):
+                    members = self.rng.sample(candidates, min(team_size, len(candidates)))
+                    if not members:
+                        break
+                    team_id = self.loader.allocate(Team)
+                    teams.append({'id': team_id, 'surrogate': self.uuid(), 'name': self.text(1, 3)[:60],
+                                  'avatar_id': None, 'project_id': project_id})
+                    room_id = self.loader.allocate(ChatRoom)
+                    rooms.append({'id': room_id, 'surrogate': self.uuid(), 'name': None,
+                                  'team_type': ChatRoom.TEAM, 'project_id': project_id, 'team_id': team_id})
+                    member_ids = [self.subscriber_id(index) for index in members]
+                    self.rooms.append((room_id, member_ids))
+                    for member_id in member_ids:
+                        # a subscriber can be in several teams of a project
+                        if member_id not in joined:
+                            joined.add(member_id)
+                            project_members.append(through_row(Project.members.field, project_id, member_id))
+                        team_members.append(through_row(Team.members.field, team_id, member_id))
+                        room_members.append(through_row(ChatRoom.members.field, room_id, member_id))
+                    for milestone_id in milestone_ids[:self.rng.randint(0, len(milestone_ids))]:
+                        report_id = self.loader.allocate(MilestoneCompletionReport)
+                        reports.append({
+                            'id': report_id, 'surrogate': self.uuid(), 'milestone_id': milestone_id,
+                            'team_id': team_id, 'message': self.text(5, 40), 'coach_feedback': None,
+                            'status': self.rng.choice(MilestoneCompletionReport.STATUSES)[0],
+                            'video_status': MilestoneCompletionReport.DONE,
+                        })
+                        report_members.extend(through_row(MilestoneCompletionReport.members.field, report_id,
+                                                          member_id) for member_id in member_ids)
+
+        self.loader.load(Project, projects)
+        self.loader.load(Prerequisite, prerequisites)
+        self.loader.load(Milestone, milestones)
+        self.loader.load(Team, teams)
+        self.loader.load(ChatRoom, rooms)
+        self.loader.load(MilestoneCompletionReport, reports)
+        self.loader.load(Project.members.through, project_members)
+        self.loader.load(Team.members.through, team_members)
+        self.loader.load(ChatRoom.members.through, room_members)
+        self.loader.load(MilestoneCompletionReport.members.through, report_members)
+
+    def load_messages(self):
+        total = self.scaled(self.options, 'messages') if self.rooms else 0
+        first_message = self.loader.allocate(Message, total)
+
+        def rows():
+            for index in range(total):
+                room_id, member_ids = self.rng.choice(self.rooms)
+                created = self.at(index / total)
+                yield {
+                    'id': first_message + index, 'surrogate': self.uuid(), 'created': created, 'updated': created,
+                    'chat_room_id': room_id, 'user_id': self.rng.choice(member_ids), 'text': self.text(1, 25),
+                }
+
+        self.loader.load(Message, rows())
+
+    # the "just posted" notifications the subscribers got from the coaches they follow
+
+    def load_notifications(self):
+        total = self.scaled(self.options, 'notifications')
+        coach_type = ContentType.objects.get_for_model(Coach)
+        post_type = ContentType.objects.get_for_model(Post)
+        followers = [index for index, coaches in enumerate(self.subscriber_coaches) if coaches]
+
+        def rows():
+            for _ in range(total if followers else 0):
+                index = self.rng.choice(followers)
+                coach_index = self.rng.choice(self.subscriber_coaches[index])
+                post_id = self.random_post(coach_index)
+                yield {
+                    'level': Notification.LEVELS.info, 'recipient_id': self.subscriber_user_id(index),
+                    'unread': self.rng.random() < UNREAD_SHARE, 'actor_content_type_id': coach_type.id,
+                    'actor_object_id': str(self.first_coach + coach_index), 'verb': 'just posted',
+                    'description': None, 'target_content_type_id': None, 'target_object_id': None,
+                    'action_object_content_type_id': post_type.id, 'action_object_object_id': str(post_id),
+                    'timestamp': self.post_created(post_id), 'public': True, 'deleted': False, 'emailed': False,
+                    'data': None,
+                }
+
+        self.loader.load(Notification, rows())
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from common.derivatives import process_pending_jobs
+import threading
+import time
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized variants of the uploaded images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the due images and exit')
+        parser.add_argument('--workers', type=int, default=4, help='Images processed at the same time')
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--sleep', type=float, default=settings.IMAGE_VARIANT_POLL_INTERVAL,
+                            help='Seconds to wait when there is nothing to process')
+
+    def work(self, options):
+        try:
+            while True:
+                close_old_connections()
+                processed = process_pending_jobs(limit=options['batch_size'])
+                if processed:
+                    self.stdout.write(f"Generated the variants of {processed} images")
+                if options['once']:
+                    if processed < options['batch_size']:
+                        break
+                elif not processed:
+                    time.sleep(options['sleep'])
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        # pillow releases the GIL while resizing and encoding, so threads use several cores
+        workers = [threading.Thread(target=self.work, args=(options,), daemon=True)
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
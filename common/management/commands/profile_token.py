@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from coach.profiling import profile_token
+
+
+class Command(BaseCommand):
+    help = 'Prints an X-Profile header value, requests sent with it are profiled (see coach/profiling.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('label', nargs='?', default='', help='Who or what the profiles are for')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"X-Profile: {profile_token(options['label'])}")
+        self.stderr.write(f"Valid for {settings.PROFILE_TOKEN_MAX_AGE} seconds")
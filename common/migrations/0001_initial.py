@@ -0,0 +1,56 @@
+# Generated by Django 3.1 on 2026-10-19 14:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariantJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('DO', 'Done'), ('FA', 'Failed')], default='PD', max_length=2)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('cpu_time', models.FloatField(blank=True, null=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImageVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('avif', 'AVIF')], max_length=10)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('image', models.FileField(upload_to='images/variants')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='imagevariantjob',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='image_variant_job_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='imagevariant',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id', 'format', 'width'), name='unique_image_variant'),
+        ),
+    ]
@@ -1,5 +1,11 @@
 from django.db import models
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from accounts.models import User
+from . import hashing
 import uuid
 
 
@@ -11,6 +17,33 @@ class CommonImage(models.Model):
     width = models.IntegerField()
     image = models.ImageField(upload_to='images', null=True, blank=True, height_field='height',
                               width_field='width')
+    # the resized copies generated in the background, see common/derivatives.py
+    variants = GenericRelation('common.ImageVariant')
+
+
+class HashedImage(CommonImage):
+    """
+    An image stored under the hash of its content, see common/hashing.py.
+    """
+    class Meta:
+        abstract = True
+
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+
+    def get_content_hash(self):
+        """
+        The hash of the image, read from the stored file and recorded the first time for older rows.
+        """
+        if self.content_hash is None and self.image:
+            self.content_hash = hashing.read_hash(self.image)
+            if self.pk:
+                type(self).objects.filter(pk=self.pk).update(content_hash=self.content_hash)
+        return self.content_hash
+
+    def save(self, *args, **kwargs):
+        if self.image and not self.image._committed:
+            self.content_hash = hashing.store(self.image)
+        super().save(*args, **kwargs)
 
 
 class CommonUser(models.Model):
@@ -23,3 +56,76 @@ class CommonUser(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class ImageVariant(models.Model):
+    """
+    A resized copy of an image, in a format smaller than the original.
+    """
+    WEBP = 'webp'
+    AVIF = 'avif'
+    FORMATS = [
+        (WEBP, 'WebP'),
+        (AVIF, 'AVIF'),
+    ]
+
+    created = models.DateTimeField(auto_now_add=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    original = GenericForeignKey('content_type', 'object_id')
+    format = models.CharField(max_length=10, choices=FORMATS)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    size = models.PositiveIntegerField()
+    image = models.FileField(upload_to='images/variants')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'format', 'width'],
+                                    name='unique_image_variant'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_type.model} {self.object_id} {self.width}w {self.format}"
+
+
+class ImageVariantJob(models.Model):
+    """
+    An image whose variants have to be generated, picked up by the `generate_image_variants` worker.
+    """
+    PENDING = 'PD'
+    DONE = 'DO'
+    FAILED = 'FA'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    created = models.DateTimeField(auto_now_add=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    original = GenericForeignKey('content_type', 'object_id')
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    # seconds of cpu time spent rendering the variants
+    cpu_time = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='image_variant_job_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_type.model} {self.object_id} ({self.get_status_display()})"
+
+
+@receiver(post_save)
+def enqueue_image_variants(sender, instance, created, raw=False, **kwargs):
+    # every model based on CommonImage, whatever app it lives in
+    if created and not raw and isinstance(instance, CommonImage) and instance.image:
+        ImageVariantJob.objects.create(content_type=ContentType.objects.get_for_model(instance),
+                                       object_id=instance.pk)
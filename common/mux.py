@@ -0,0 +1,143 @@
+"""
+Video uploads to Mux.
+
+One `ApiClient` is shared by the process so the connections to the Mux API are pooled instead of set up per
+request. Mux calls the webhook when an asset is ready, possibly more than once. The video of an asset is only
+created once, together with its playback ids and the ready status of the object it was uploaded for, and the
+uploader is told over the notifications websocket.
+"""
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.db.models import CharField, Value
+from coach.metrics import outbound_call
+from posts.models import Post, PostVideoAssetMetaData, PostVideo, PlaybackId
+from projects.models import (MilestoneCompletionReport, MilestoneCompletionVideoAssetMetaData,
+                             MilestoneCompletionVideo, MilestoneCompletionPlaybackId)
+import channels.layers
+import mux_python
+import os
+import threading
+
+POST = 'post'
+MILESTONE_COMPLETION_REPORT = 'milestone_completion_report'
+
+
+class VideoTarget:
+    """
+    How the video of an asset is stored for the kind of object it was uploaded for.
+    """
+
+    def __init__(self, model, video_model, playback_id_model, status_field):
+        self.model = model
+        self.video_model = video_model
+        self.playback_id_model = playback_id_model
+        self.status_field = status_field
+
+
+TARGETS = {
+    POST: VideoTarget(Post, PostVideo, PlaybackId, 'status'),
+    MILESTONE_COMPLETION_REPORT: VideoTarget(MilestoneCompletionReport, MilestoneCompletionVideo,
+                                             MilestoneCompletionPlaybackId, 'video_status'),
+}
+
+_api_client = None
+_lock = threading.Lock()
+
+
+def get_api_client():
+    global _api_client
+    with _lock:
+        if _api_client is None:
+            configuration = mux_python.Configuration()
+            configuration.username = os.environ['MUX_TOKEN_ID']
+            configuration.password = os.environ['MUX_TOKEN_SECRET']
+            configuration.connection_pool_maxsize = settings.MUX_CONNECTION_POOL_SIZE
+            _api_client = mux_python.ApiClient(configuration)
+        return _api_client
+
+
+def create_direct_upload(passthrough):
+    """
+    The url the client uploads the video to. The asset Mux creates carries `passthrough`.
+    """
+    create_asset_request = mux_python.CreateAssetRequest(playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
+                                                         mp4_support="standard", passthrough=passthrough)
+    request = mux_python.CreateUploadRequest(
+        new_asset_settings=create_asset_request, test=True if settings.DEVELOPMENT_MODE else False)
+    with outbound_call('mux', 'create_direct_upload'):
+        response = mux_python.DirectUploadsApi(get_api_client()).create_direct_upload(request)
+    return response.data.url
+
+
+def resolve_passthrough(passthrough):
+    """
+    The (kind, id) of the objects the passthrough was created for, looked up in the metadata of both with one query.
+    """
+    posts = PostVideoAssetMetaData.objects.filter(passthrough=passthrough).annotate(
+        kind=Value(POST, output_field=CharField())).values_list('kind', 'post_id')
+    reports = MilestoneCompletionVideoAssetMetaData.objects.filter(passthrough=passthrough).annotate(
+        kind=Value(MILESTONE_COMPLETION_REPORT, output_field=CharField())).values_list(
+        'kind', 'milestone_completion_report_id')
+    return list(posts.union(reports, all=True))
+
+
+def store_video(kind, object_id, passthrough, asset_id, playback_ids):
+    """
+    Creates the video of the asset and marks the object as done. Returns the video, or None when the asset
+    was stored by an earlier delivery of the webhook.
+    """
+    target = TARGETS[kind]
+    with transaction.atomic():
+        # deliveries of the same asset wait for each other here
+        if not target.model.objects.select_for_update().filter(pk=object_id).exists():
+            return None
+        video, created = target.video_model.objects.get_or_create(asset_id=asset_id, defaults={
+            'passthrough': passthrough,
+            target.video_model._meta.get_field(kind).attname: object_id,
+        })
+        if not created:
+            return None
+        target.playback_id_model.objects.bulk_create([
+            target.playback_id_model(video=video, playback_id=playback_id['id'], policy=playback_id['policy'])
+            for playback_id in playback_ids
+        ])
+        target.model.objects.filter(pk=object_id).update(**{target.status_field: target.model.DONE})
+    return video
+
+
+def uploader_surrogates(kind, object_id):
+    """
+    The users whose notifications websocket hears about the video, the post's coach or the team that reported.
+    """
+    if kind == POST:
+        return Post.objects.filter(pk=object_id).values_list('coach__user__surrogate', flat=True)
+    return MilestoneCompletionReport.objects.filter(pk=object_id, members__isnull=False).values_list(
+        'members__user__surrogate', flat=True)
+
+
+def notify_video_ready(kind, object_id, playback_ids):
+    channel_layer = channels.layers.get_channel_layer()
+    surrogate = TARGETS[kind].model.objects.values_list('surrogate', flat=True).get(pk=object_id)
+    for user_surrogate in uploader_surrogates(kind, object_id):
+        async_to_sync(channel_layer.group_send)(
+            f"{str(user_surrogate)}.notifications.group",
+            {
+                'type': 'send.video_ready',
+                'object': kind,
+                'id': str(surrogate),
+                'playback_ids': [playback_id['id'] for playback_id in playback_ids],
+            }
+        )
+
+
+def ingest_asset_ready(data):
+    """
+    Handles a `video.asset.ready` event, a retried delivery is a no-op.
+    """
+    playback_ids = data.get('playback_ids', [])
+    for kind, object_id in resolve_passthrough(data['passthrough']):
+        video = store_video(kind, object_id, data['passthrough'], data['id'], playback_ids)
+        if video is not None:
+            transaction.on_commit(lambda kind=kind, object_id=object_id: notify_video_ready(
+                kind, object_id, playback_ids))
@@ -0,0 +1,19 @@
+from django.contrib import admin
+from django.utils import timezone
+from .models import OutgoingEmail
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    model = OutgoingEmail
+    list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt_at', 'created', 'sent')
+    list_filter = ('status',)
+    search_fields = ('subject', 'to')
+    readonly_fields = ('last_error',)
+    actions = ['retry_emails']
+
+    def retry_emails(self, request, queryset):
+        queryset.update(status=OutgoingEmail.PENDING, attempts=0, next_attempt_at=timezone.now())
+    retry_emails.short_description = 'Send the selected emails again'
+
+
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
@@ -0,0 +1,20 @@
+from django.core.mail.backends.base import BaseEmailBackend
+from .outbox import queue_messages
+
+
+class OutboxBackend(BaseEmailBackend):
+    """
+    Queues the messages in the email outbox, they are delivered by `python manage.py send_queued_emails`.
+    """
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        try:
+            return queue_messages(email_messages)
+        except Exception:
+            # mail_admins of the AdminEmailHandler reporting an error fails silently, it may be reporting that the
+            # database is down
+            if not self.fail_silently:
+                raise
+            return 0
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from emails.outbox import send_batch
+import time
+
+
+class Command(BaseCommand):
+    help = 'Delivers the queued emails in batches over one connection, retrying failed deliveries with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send the due emails and exit')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--sleep', type=float, default=settings.EMAIL_OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when there is nothing to send')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = send_batch(limit=options['batch_size'])
+            if sent:
+                self.stdout.write(f"Sent a batch of {sent} emails")
+            if options['once']:
+                if sent < options['batch_size']:
+                    break
+            elif not sent:
+                time.sleep(options['sleep'])
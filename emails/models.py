@@ -0,0 +1,52 @@
+from django.db import models
+from django.utils import timezone
+import uuid
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email queued by the outbox email backend, in the same transaction as the request or signal that sent it.
+    The emails are delivered by the `send_queued_emails` worker.
+    """
+    PENDING = 'PD'
+    SENT = 'SE'
+    FAILED = 'FA'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    surrogate = models.UUIDField(default=uuid.uuid4, unique=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+
+    subject = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+    # 'html' when the body itself is html
+    content_subtype = models.CharField(max_length=20, default='plain')
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list, blank=True)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    # [content, mimetype] pairs, e.g. the html version of the message
+    alternatives = models.JSONField(default=list, blank=True)
+    # [filename, base64 content, mimetype] triples
+    attachments = models.JSONField(default=list, blank=True)
+
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outgoing_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} ({self.get_status_display()})"
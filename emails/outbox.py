@@ -0,0 +1,139 @@
+"""
+Email outbox.
+
+`send_mail`, `mail_admins` and every other django mail helper go through `OutboxBackend` (see EMAIL_BACKEND),
+which stores the messages as `OutgoingEmail` rows in the current transaction instead of talking to the mail
+server. The `send_queued_emails` worker delivers them in batches over a single connection of
+EMAIL_DELIVERY_BACKEND, retrying failed deliveries with backoff.
+"""
+from datetime import timedelta
+from email.mime.base import MIMEBase
+from django.conf import settings
+from django.core.mail import get_connection, EmailMultiAlternatives
+from django.db import transaction
+from django.utils import timezone
+from coach.metrics import outbound_call
+from .models import OutgoingEmail
+import base64
+
+MAX_ATTEMPTS = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 6)
+RETRY_BACKOFF_SECONDS = getattr(settings, 'EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS', 30)
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+
+
+def _attachment(attachment):
+    if isinstance(attachment, MIMEBase):
+        filename, content, mimetype = attachment.get_filename(), attachment.get_payload(decode=True), \
+            attachment.get_content_type()
+    else:
+        filename, content, mimetype = attachment
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return [filename, base64.b64encode(content).decode('ascii'), mimetype]
+
+
+def to_outgoing_email(message):
+    return OutgoingEmail(
+        subject=message.subject,
+        body=message.body,
+        content_subtype=message.content_subtype,
+        from_email=message.from_email,
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=message.extra_headers,
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+        attachments=[_attachment(attachment) for attachment in message.attachments],
+    )
+
+
+def to_message(email, connection=None):
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.to,
+        cc=email.cc,
+        bcc=email.bcc,
+        reply_to=email.reply_to,
+        headers=email.headers,
+        alternatives=[tuple(alternative) for alternative in email.alternatives],
+        connection=connection,
+    )
+    message.content_subtype = email.content_subtype
+    for filename, content, mimetype in email.attachments:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+def queue_messages(messages):
+    emails = [to_outgoing_email(message) for message in messages if message.recipients()]
+    OutgoingEmail.objects.bulk_create(emails)
+    return len(emails)
+
+
+def _retry_later(email, error):
+    email.last_error = str(error)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = OutgoingEmail.FAILED
+        return
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** (email.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+    email.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
+def get_delivery_connection():
+    return get_connection(getattr(settings, 'EMAIL_DELIVERY_BACKEND',
+                                  'django.core.mail.backends.smtp.EmailBackend'))
+
+
+def send_batch(limit=100):
+    """
+    Claims up to `limit` due emails and delivers them over one connection, so a batch pays for a single
+    SMTP handshake. Returns the number of emails attempted, 0 when nothing is due.
+    """
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            status=OutgoingEmail.PENDING, next_attempt_at__lte=timezone.now()).order_by('id')[:limit])
+        if not emails:
+            return 0
+
+        connection = get_delivery_connection()
+        try:
+            with outbound_call('smtp', 'open'):
+                connection.open()
+        except Exception as e:
+            # the mail server is unreachable, the whole batch waits for the next attempt
+            for email in emails:
+                email.attempts += 1
+                _retry_later(email, e)
+        else:
+            for email in emails:
+                email.attempts += 1
+                try:
+                    with outbound_call('smtp', 'send'):
+                        connection.send_messages([to_message(email, connection)])
+                except Exception as e:
+                    _retry_later(email, e)
+                    # the server may have dropped the connection, the next email gets a fresh one
+                    connection.close()
+                    try:
+                        connection.open()
+                    except Exception:
+                        pass
+                else:
+                    email.status = OutgoingEmail.SENT
+                    email.sent = timezone.now()
+                    email.last_error = None
+            connection.close()
+        OutgoingEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent'])
+        return len(emails)
+
+
+def send_pending(batch_size=100):
+    sent = 0
+    while True:
+        attempted = send_batch(batch_size)
+        sent += attempted
+        if attempted < batch_size:
+            return sent
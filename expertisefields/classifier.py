@@ -0,0 +1,63 @@
+"""
+Offline question classifier built from the expertise field names.
+
+A question is matched against the names of the expertise fields coaches picked: the field sharing the most
+words with the question becomes the umbrella term. It is far less accurate than the watson model, but it
+answers in microseconds, so it is used as a fast path and when watson is slow or down.
+"""
+from django.core.cache import cache
+from .models import ExpertiseField, ExpertiseFieldMultiple
+import re
+
+VOCABULARY_CACHE_KEY = 'expertisefields:classifier:vocabulary'
+VOCABULARY_TIMEOUT = 10 * 60
+
+# a match covering less of the field's name than this is marked as weak, like the remote model's confidence
+WEAK_SCORE = 0.5
+
+
+def tokenize(text):
+    words = re.findall(r'[a-z0-9+#]+', (text or '').lower())
+    # a crude stemmer, enough for "databases" to match "database"
+    return {word[:-1] if len(word) > 3 and word.endswith('s') else word for word in words}
+
+
+def get_vocabulary():
+    """
+    The tokens of every expertise field name, cached for a few minutes since the names rarely change.
+    """
+    vocabulary = cache.get(VOCABULARY_CACHE_KEY)
+    if vocabulary is None:
+        names = set(ExpertiseFieldMultiple.objects.values_list('name', flat=True).distinct())
+        names |= set(ExpertiseField.objects.values_list('name', flat=True))
+        vocabulary = {name: sorted(tokenize(name)) for name in names if tokenize(name)}
+        cache.set(VOCABULARY_CACHE_KEY, vocabulary, VOCABULARY_TIMEOUT)
+    return vocabulary
+
+
+def classify(text):
+    """
+    Returns the same structure as `extract_tags_from_question`.
+    """
+    words = tokenize(text)
+    scores = []
+    for name, tokens in get_vocabulary().items():
+        matched = len(words.intersection(tokens))
+        if matched:
+            scores.append((matched / len(tokens), matched, name))
+    if not scores:
+        return {
+            'tags': [],
+            'umbrella_term': '',
+            'is_weak': True,
+            'status': 'error'
+        }
+
+    scores.sort(reverse=True)
+    best_score = scores[0][0]
+    return {
+        'tags': [name for score, matched, name in scores[1:]],
+        'umbrella_term': scores[0][2],
+        'is_weak': best_score < WEAK_SCORE,
+        'status': 'success'
+    }
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instructor', '0028_auto_20220225_0414'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coachavatar',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -6,7 +6,7 @@ from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.urls import reverse
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
 from taggit.managers import TaggableManager
@@ -14,7 +14,9 @@ from djmoney.models.fields import MoneyField
 from accounts.models import User
 from subscribers.models import Subscriber
 from expertisefields.models import ExpertiseField
-from common.models import CommonUser, CommonImage
+from common.models import CommonUser, HashedImage
+from common.cache import register_cache_tags
+from payments import outbox
 from babel.numbers import get_currency_precision
 from uuid import uuid4
 import os
@@ -41,8 +43,19 @@ def create_stripe_price(instance):
     return price
 
 
-class CoachAvatar(CommonImage):
-    pass
+class CoachAvatar(HashedImage):
+
+    @classmethod
+    def for_image(cls, image):
+        """
+        The coach avatar with the content of `image`, one row per content. The stored file is shared, not copied.
+        """
+        content_hash = image.get_content_hash()
+        avatar = cls.objects.filter(content_hash=content_hash).order_by('id').first()
+        if avatar is None:
+            avatar = cls.objects.create(image=image.image.name, height=image.height, width=image.width,
+                                        content_hash=content_hash)
+        return avatar
 
 
 class Coach(CommonUser):
@@ -69,15 +82,6 @@ class Coach(CommonUser):
     def __str__(self):
         return str(self.name)
 
-    def save(self, *args, **kwargs):
-        # price = create_stripe_price(self)
-        # self.price_id = price.id
-
-        # trigger a qa_session save to update qa_session prices and product ids
-        for qa_session in self.qa_sessions.all():
-            qa_session.save()
-        return super().save()
-
 
 class CoachApplication(models.Model):
     PENDING = 'PD'
@@ -112,7 +116,7 @@ class CoachApplication(models.Model):
                 self.subscriber.user.save()
                 avatar = None
                 if self.subscriber.avatar:
-                    avatar = CoachAvatar.objects.create(image=self.subscriber.avatar.image)
+                    avatar = CoachAvatar.for_image(self.subscriber.avatar)
                 Coach.objects.create(user=self.subscriber.user, name=self.subscriber.name, avatar=avatar)
 
         # TextField does not validate on db level so we validate here by getting only the first 5000 characters
@@ -120,34 +124,21 @@ class CoachApplication(models.Model):
         super(CoachApplication, self).save(*args, **kwargs)
 
 
-@receiver(pre_save, sender=Coach)
+@receiver(post_save, sender=Coach)
 def setup_stripe_account(sender, instance, *args, **kwargs):
     if not instance.stripe_id:
-        account = stripe.Account.create(
-            type="express",
-            country="GR",
-            email=instance.user.email,
-            capabilities={
-                "card_payments": {"requested": True},
-                "transfers": {"requested": True},
-            },
-        )
-
         redirect = 'https://troosh.app/users/oauth/callback'
         refresh_url = 'https://troosh.app/reauth'
 
-        account_link = stripe.AccountLink.create(
-            account=account.id,
+        # the express account and its onboarding link are created by the stripe outbox worker
+        outbox.enqueue_account(
+            instance,
+            country="GR",
+            email=instance.user.email,
             refresh_url=refresh_url,
             return_url=redirect,
-            type="account_onboarding",
         )
 
-        instance.stripe_id = account.id
-        instance.stripe_account_link = account_link.url
-        instance.stripe_created = account_link.created
-        instance.stripe_expires_at = account_link.expires_at
-
 
 @receiver(post_save, sender=CoachApplication)
 def send_mail_to_admins_about_new_application(sender, instance, created, **kwargs):
@@ -167,3 +158,6 @@ def send_mail_to_mentors_after_successful_verification(sender, instance, created
         from_email = None # Uses the default mail defined in settings
         to = instance.subscriber.user.email
         send_mail(subject, plain_message, from_email, [to], html_message=html_message)
+
+
+register_cache_tags(Coach)
@@ -0,0 +1,45 @@
+from django.contrib import admin
+from django.utils import timezone
+from .models import StripeOperation, PriceMigration, StripeEvent, FailedStripeEvent
+
+
+class StripeOperationAdmin(admin.ModelAdmin):
+    model = StripeOperation
+    list_display = ('kind', 'content_type', 'object_id', 'status', 'attempts', 'next_attempt_at', 'created')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('idempotency_key', 'result', 'last_error')
+
+
+class PriceMigrationAdmin(admin.ModelAdmin):
+    model = PriceMigration
+    list_display = ('tier', 'new_price_id', 'status', 'migrated', 'failed', 'total', 'created', 'finished')
+    list_filter = ('status',)
+    readonly_fields = ('cursor', 'last_error')
+
+
+class StripeEventAdmin(admin.ModelAdmin):
+    model = StripeEvent
+    list_display = ('type', 'event_id', 'object_key', 'status', 'attempts', 'event_created', 'processed')
+    list_filter = ('status', 'type')
+    search_fields = ('event_id', 'object_key')
+    readonly_fields = ('event_id', 'payload', 'last_error')
+    actions = ['retry_events']
+
+    def retry_events(self, request, queryset):
+        queryset.update(status=StripeEvent.PENDING, attempts=0, next_attempt_at=timezone.now(), processed=None)
+    retry_events.short_description = 'Process the selected events again'
+
+
+class FailedStripeEventAdmin(StripeEventAdmin):
+    model = FailedStripeEvent
+    list_display = ('type', 'event_id', 'object_key', 'attempts', 'last_error', 'event_created', 'processed')
+    list_filter = ('type',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(status=StripeEvent.FAILED)
+
+
+admin.site.register(StripeOperation, StripeOperationAdmin)
+admin.site.register(PriceMigration, PriceMigrationAdmin)
+admin.site.register(StripeEvent, StripeEventAdmin)
+admin.site.register(FailedStripeEvent, FailedStripeEventAdmin)
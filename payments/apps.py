@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.conf import settings
+import stripe
+
+
+class PaymentsConfig(AppConfig):
+    name = 'payments'
+
+    def ready(self):
+        from coach.metrics import StripeHTTPClient
+        # one client for all stripe calls, timed in the outbound metrics
+        stripe.default_http_client = StripeHTTPClient()
+        # e.g. the local stand-in started with `python manage.py run_stripe_standin`
+        if getattr(settings, 'STRIPE_API_BASE', None):
+            stripe.api_base = settings.STRIPE_API_BASE
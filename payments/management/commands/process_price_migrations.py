@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payments.price_migration import RateLimiter, process_next_chunk
+import time
+
+
+class Command(BaseCommand):
+    help = 'Moves the subscriptions of tiers whose credit changed to the new stripe price, chunk by chunk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due migrations to completion and exit')
+        parser.add_argument('--chunk-size', type=int, default=settings.STRIPE_PRICE_MIGRATION_CHUNK_SIZE)
+        parser.add_argument('--concurrency', type=int, default=settings.STRIPE_PRICE_MIGRATION_CONCURRENCY,
+                            help='Subscriptions of a chunk that are migrated at the same time')
+        parser.add_argument('--rate', type=float, default=settings.STRIPE_PRICE_MIGRATION_REQUESTS_PER_SECOND,
+                            help='Maximum stripe requests per second')
+        parser.add_argument('--sleep', type=float, default=settings.STRIPE_OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when there is nothing to process')
+
+    def handle(self, *args, **options):
+        # shared by all the chunks so the rate holds across chunk boundaries
+        limiter = RateLimiter(options['rate'])
+        while True:
+            migration = process_next_chunk(chunk_size=options['chunk_size'], concurrency=options['concurrency'],
+                                           limiter=limiter)
+            if migration:
+                self.stdout.write(f"{migration}: {migration.migrated}/{migration.total} migrated, "
+                                  f"{migration.failed} failed")
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
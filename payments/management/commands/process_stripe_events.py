@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from payments.webhooks import load_handlers, process_pending_events
+import threading
+import time
+
+
+class Command(BaseCommand):
+    help = 'Processes the events stored by the stripe webhook, retrying failed events with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the due events and exit')
+        parser.add_argument('--workers', type=int, default=4, help='Events processed at the same time')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--sleep', type=float, default=settings.STRIPE_OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when there is nothing to process')
+
+    def work(self, options):
+        try:
+            while True:
+                close_old_connections()
+                processed = process_pending_events(limit=options['batch_size'])
+                if processed:
+                    self.stdout.write(f"Processed {processed} stripe events")
+                if options['once']:
+                    if processed < options['batch_size']:
+                        break
+                elif not processed:
+                    time.sleep(options['sleep'])
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        load_handlers()
+        # every thread uses its own database connection and claims events with skip_locked
+        workers = [threading.Thread(target=self.work, args=(options,), daemon=True)
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
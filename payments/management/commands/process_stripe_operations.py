@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payments.outbox import process_pending
+import time
+
+
+class Command(BaseCommand):
+    help = 'Runs the stripe operations recorded in the outbox, retrying failed calls with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the due operations and exit')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--sleep', type=float, default=settings.STRIPE_OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when there is nothing to process')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending(limit=options['batch_size'])
+            if processed:
+                self.stdout.write(f"Processed {processed} stripe operations")
+            if options['once']:
+                if processed < options['batch_size']:
+                    break
+            elif not processed:
+                time.sleep(options['sleep'])
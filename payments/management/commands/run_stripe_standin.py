@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from payments.standin import StripeStandIn, make_server
+import os
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in of the stripe API for load tests and offline benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds every response is delayed by')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Random variation of the latency in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of the requests that fail with an api error')
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                            help='Fraction of the requests that fail with a rate limit error')
+        parser.add_argument('--webhook-url', default=None,
+                            help='Where events are delivered, e.g. http://localhost:8000/api/v1/webhooks/stripe/')
+        parser.add_argument('--webhook-secret', default=os.environ.get('STRIPE_ENDPOINT_SECRET'),
+                            help='Secret the events are signed with')
+        parser.add_argument('--webhook-delay', type=float, default=0.0,
+                            help='Seconds between a request and the delivery of the events it caused')
+
+    def handle(self, *args, **options):
+        standin = StripeStandIn(latency=options['latency'], jitter=options['jitter'],
+                                error_rate=options['error_rate'], rate_limit_rate=options['rate_limit_rate'],
+                                webhook_url=options['webhook_url'], webhook_secret=options['webhook_secret'],
+                                webhook_delay=options['webhook_delay'])
+        server = make_server(standin, options['host'], options['port'])
+        self.stdout.write(f"Stripe stand-in listening on http://{options['host']}:{options['port']}, "
+                          f"set STRIPE_API_BASE to use it")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,48 @@
+# Generated by Django 3.1 on 2026-10-19 14:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('surrogate', models.UUIDField(db_index=True, default=uuid.uuid4, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(choices=[('product', 'Create product'), ('price', 'Create price'), ('customer', 'Create customer'), ('account', 'Create connected account')], max_length=20)),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('DO', 'Done'), ('SK', 'Skipped'), ('FA', 'Failed')], default='PD', max_length=2)),
+                ('object_id', models.PositiveIntegerField()),
+                ('idempotency_key', models.UUIDField(default=uuid.uuid4, unique=True)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripeoperation',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='stripe_op_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stripeoperation',
+            index=models.Index(fields=['content_type', 'object_id', 'status'], name='stripe_op_target_idx'),
+        ),
+    ]
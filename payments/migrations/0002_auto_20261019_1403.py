@@ -0,0 +1,44 @@
+# Generated by Django 3.1 on 2026-10-19 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tiers', '0016_auto_20210813_2009'),
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceMigration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('surrogate', models.UUIDField(db_index=True, default=uuid.uuid4, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('new_price_id', models.CharField(max_length=30)),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('RU', 'Running'), ('DO', 'Done'), ('SU', 'Superseded'), ('FA', 'Failed')], default='PD', max_length=2)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('migrated', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('cursor', models.PositiveIntegerField(default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('tier', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_migrations', to='tiers.tier')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='pricemigration',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='price_migration_due_idx'),
+        ),
+    ]
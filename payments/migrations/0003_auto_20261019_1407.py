@@ -0,0 +1,55 @@
+# Generated by Django 3.1 on 2026-10-19 14:07
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_auto_20261019_1403'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=100)),
+                ('account', models.CharField(blank=True, max_length=255, null=True)),
+                ('object_key', models.CharField(blank=True, max_length=255, null=True)),
+                ('event_created', models.DateTimeField()),
+                ('payload', models.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('DO', 'Done'), ('IG', 'Ignored'), ('FA', 'Failed')], default='PD', max_length=2)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ('event_created', 'id'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='stripe_event_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['object_key', 'status'], name='stripe_event_object_idx'),
+        ),
+        migrations.CreateModel(
+            name='FailedStripeEvent',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('payments.stripeevent',),
+        ),
+    ]
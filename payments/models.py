@@ -0,0 +1,163 @@
+from django.db import models
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+import uuid
+
+
+class StripeOperation(models.Model):
+    """
+    A Stripe call recorded in the same transaction as the model save that needs it.
+    The operations are executed later by the `process_stripe_operations` worker.
+    """
+    CREATE_PRODUCT = 'product'
+    CREATE_PRICE = 'price'
+    CREATE_CUSTOMER = 'customer'
+    CREATE_ACCOUNT = 'account'
+    KINDS = [
+        (CREATE_PRODUCT, 'Create product'),
+        (CREATE_PRICE, 'Create price'),
+        (CREATE_CUSTOMER, 'Create customer'),
+        (CREATE_ACCOUNT, 'Create connected account'),
+    ]
+
+    PENDING = 'PD'
+    DONE = 'DO'
+    SKIPPED = 'SK'
+    FAILED = 'FA'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (SKIPPED, 'Skipped'),
+        (FAILED, 'Failed'),
+    ]
+
+    surrogate = models.UUIDField(default=uuid.uuid4, unique=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+
+    # the object whose stripe fields (product_id, price_id etc.) get populated by this operation
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    target = GenericForeignKey('content_type', 'object_id')
+
+    # sent to stripe so retries of the same operation never create duplicate objects
+    idempotency_key = models.UUIDField(default=uuid.uuid4, unique=True)
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='stripe_op_due_idx'),
+            models.Index(fields=['content_type', 'object_id', 'status'], name='stripe_op_target_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.content_type.model} {self.object_id} ({self.get_status_display()})"
+
+
+class PriceMigration(models.Model):
+    """
+    Moves the stripe subscriptions of a tier to its new price after the tier's credit changed.
+    The subscriptions are migrated in chunks by the `process_price_migrations` worker and the
+    progress is checkpointed after every chunk, so a migration can be resumed where it stopped.
+    """
+    PENDING = 'PD'
+    RUNNING = 'RU'
+    DONE = 'DO'
+    SUPERSEDED = 'SU'
+    FAILED = 'FA'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (SUPERSEDED, 'Superseded'),
+        (FAILED, 'Failed'),
+    ]
+
+    surrogate = models.UUIDField(default=uuid.uuid4, unique=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    tier = models.ForeignKey('tiers.Tier', on_delete=models.CASCADE, related_name="price_migrations")
+    new_price_id = models.CharField(max_length=30)
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+
+    total = models.PositiveIntegerField(default=0)
+    migrated = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # id of the last subscription that has been handled, the next chunk starts after it
+    cursor = models.PositiveIntegerField(default=0)
+
+    # consecutive chunks that stopped on a temporary error, reset by a chunk that completes
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='price_migration_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.tier} to {self.new_price_id} ({self.get_status_display()})"
+
+
+class StripeEvent(models.Model):
+    """
+    A webhook event received from stripe. The webhook only verifies and stores the event,
+    it is processed later by the `process_stripe_events` worker.
+    """
+    PENDING = 'PD'
+    DONE = 'DO'
+    IGNORED = 'IG'
+    FAILED = 'FA'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (IGNORED, 'Ignored'),
+        (FAILED, 'Failed'),
+    ]
+
+    # stripe retries deliveries, the unique event id makes sure an event is stored and processed once
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    # connected account the event belongs to, empty for events of the platform account
+    account = models.CharField(max_length=255, null=True, blank=True)
+    # events with the same key (e.g. all the events of a subscription) are processed in the order they occurred
+    object_key = models.CharField(max_length=255, null=True, blank=True)
+    event_created = models.DateTimeField()
+    payload = models.JSONField()
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    processed = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('event_created', 'id')
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='stripe_event_due_idx'),
+            models.Index(fields=['object_key', 'status'], name='stripe_event_object_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.event_id} ({self.get_status_display()})"
+
+
+class FailedStripeEvent(StripeEvent):
+    """
+    The events that still failed after all their retries, listed separately in the admin.
+    """
+    class Meta:
+        proxy = True
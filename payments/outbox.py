@@ -0,0 +1,257 @@
+"""
+Transactional outbox for the stripe calls triggered by model saves.
+
+Models record the stripe objects they need through the `enqueue_*` helpers while they are being saved,
+so the intent is committed in the same transaction as the change itself. The calls are then made by the
+`process_stripe_operations` worker with retries and idempotency keys, keeping saves free of network calls.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+from babel.numbers import get_currency_precision
+from .models import StripeOperation
+from .signals import price_created
+from . import stripe_cache
+import stripe
+import os
+
+stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+
+MAX_ATTEMPTS = getattr(settings, 'STRIPE_OUTBOX_MAX_ATTEMPTS', 8)
+RETRY_BACKOFF_SECONDS = getattr(settings, 'STRIPE_OUTBOX_RETRY_BACKOFF_SECONDS', 5)
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+
+# errors that will not go away by retrying the same request
+PERMANENT_ERRORS = (
+    stripe.error.InvalidRequestError,
+    stripe.error.AuthenticationError,
+    stripe.error.PermissionError,
+    stripe.error.IdempotencyError,
+    stripe.error.CardError,
+)
+
+
+class OperationDeferred(Exception):
+    """
+    Raised by a handler when the operation depends on another one that has not run yet,
+    for example a price whose product has not been created.
+    """
+
+
+def money_to_integer(money):
+    return int(
+        money.amount * (
+            10 ** get_currency_precision(money.currency.code)
+        )
+    )
+
+
+def enqueue(instance, kind, payload=None, once=False):
+    """
+    Records a stripe operation for `instance`. Call it while saving `instance` so both are committed together.
+    With `once=True` an identical operation that is still pending is reused instead.
+    """
+    content_type = ContentType.objects.get_for_model(instance)
+    payload = payload or {}
+    if once:
+        pending = StripeOperation.objects.filter(content_type=content_type, object_id=instance.pk,
+                                                 kind=kind, status=StripeOperation.PENDING)
+        for operation in pending:
+            if operation.payload == payload:
+                return operation
+    return StripeOperation.objects.create(content_type=content_type, object_id=instance.pk,
+                                          kind=kind, payload=payload)
+
+
+def enqueue_product(instance, name):
+    return enqueue(instance, StripeOperation.CREATE_PRODUCT, {'name': name}, once=True)
+
+
+def enqueue_price(instance, recurring=None, previous_price_id=None):
+    if instance.credit is None:
+        return None
+    payload = {
+        'unit_amount': money_to_integer(instance.credit),
+        'currency': instance.credit.currency.code.lower(),
+        'previous_price_id': previous_price_id,
+    }
+    if recurring:
+        payload['recurring'] = recurring
+    return enqueue(instance, StripeOperation.CREATE_PRICE, payload, once=True)
+
+
+def enqueue_customer(instance, email, name):
+    return enqueue(instance, StripeOperation.CREATE_CUSTOMER, {'email': email, 'name': name}, once=True)
+
+
+def enqueue_account(instance, **payload):
+    return enqueue(instance, StripeOperation.CREATE_ACCOUNT, payload, once=True)
+
+
+def _update_target(operation, **fields):
+    # update through the queryset so the target's save() and signals don't enqueue anything again
+    operation.content_type.model_class().objects.filter(pk=operation.object_id).update(**fields)
+
+
+def create_product(operation, target):
+    if target.product_id:
+        return None
+    product = stripe.Product.create(name=operation.payload['name'],
+                                    idempotency_key=str(operation.idempotency_key))
+    _update_target(operation, product_id=product.id)
+    return product
+
+
+def create_price(operation, target):
+    payload = operation.payload
+    # the credit changed again after this operation was recorded, the newer operation creates the price
+    if target.credit is None or money_to_integer(target.credit) != payload['unit_amount'] \
+            or target.credit.currency.code.lower() != payload['currency']:
+        return None
+    if not target.product_id:
+        raise OperationDeferred('The product of this price has not been created yet')
+
+    params = {
+        'unit_amount': payload['unit_amount'],
+        'currency': payload['currency'],
+        'product': target.product_id,
+    }
+    if payload.get('recurring'):
+        params['recurring'] = payload['recurring']
+    price = stripe.Price.create(idempotency_key=str(operation.idempotency_key), **params)
+    _update_target(operation, price_id=price.id)
+    stripe_cache.store_price(price)
+    target.price_id = price.id
+    price_created.send(sender=target.__class__, instance=target, price=price,
+                       previous_price_id=payload.get('previous_price_id'))
+    return price
+
+
+def create_customer(operation, target):
+    if target.customer_id:
+        return None
+    customer = stripe.Customer.create(email=operation.payload['email'], name=operation.payload['name'],
+                                      idempotency_key=str(operation.idempotency_key))
+    _update_target(operation, customer_id=customer.id)
+    return customer
+
+
+def create_account(operation, target):
+    if target.stripe_id:
+        return None
+    payload = operation.payload
+    account = stripe.Account.create(
+        type="express",
+        country=payload['country'],
+        email=payload['email'],
+        capabilities={
+            "card_payments": {"requested": True},
+            "transfers": {"requested": True},
+        },
+        idempotency_key=str(operation.idempotency_key),
+    )
+    account_link = stripe.AccountLink.create(
+        account=account.id,
+        refresh_url=payload['refresh_url'],
+        return_url=payload['return_url'],
+        type="account_onboarding",
+    )
+    _update_target(operation, stripe_id=account.id, stripe_account_link=account_link.url,
+                   stripe_created=account_link.created, stripe_expires_at=account_link.expires_at)
+    return account
+
+
+HANDLERS = {
+    StripeOperation.CREATE_PRODUCT: create_product,
+    StripeOperation.CREATE_PRICE: create_price,
+    StripeOperation.CREATE_CUSTOMER: create_customer,
+    StripeOperation.CREATE_ACCOUNT: create_account,
+}
+
+
+def _retry_later(operation, error):
+    operation.last_error = str(error)
+    if operation.attempts >= MAX_ATTEMPTS:
+        operation.status = StripeOperation.FAILED
+        return
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** (operation.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+    operation.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
+def run_operation(operation):
+    """
+    Runs an operation that the caller has locked and records the outcome on it.
+    """
+    operation.attempts += 1
+    try:
+        # a database error of the handler or a price_created receiver only rolls back the savepoint, so the
+        # outcome can still be recorded and the retry waits for its backoff
+        with transaction.atomic():
+            target = operation.target
+            # the object was deleted before the operation got a chance to run
+            if target is None:
+                result = None
+            else:
+                result = HANDLERS[operation.kind](operation, target)
+    except OperationDeferred as e:
+        _retry_later(operation, e)
+    except PERMANENT_ERRORS as e:
+        operation.last_error = str(e)
+        operation.status = StripeOperation.FAILED
+    except Exception as e:
+        _retry_later(operation, e)
+    else:
+        operation.status = StripeOperation.DONE if result is not None else StripeOperation.SKIPPED
+        operation.result = result.to_dict_recursive() if result is not None else None
+        operation.last_error = None
+    operation.save()
+    return operation
+
+
+def process_next():
+    """
+    Claims the oldest due operation and runs it. Returns None when nothing is due.
+    `skip_locked` lets several workers drain the outbox without picking the same operation.
+    """
+    with transaction.atomic():
+        operation = StripeOperation.objects.select_for_update(skip_locked=True).filter(
+            status=StripeOperation.PENDING, next_attempt_at__lte=timezone.now()).order_by('id').first()
+        if operation is None:
+            return None
+        return run_operation(operation)
+
+
+def process_pending(limit=None):
+    processed = 0
+    while limit is None or processed < limit:
+        if process_next() is None:
+            break
+        processed += 1
+    return processed
+
+
+def run_pending_operations(instance):
+    """
+    Runs the due operations of `instance` inline and refreshes it.
+    Used by requests that need a stripe id right away and can't wait for the worker,
+    e.g. an ephemeral key needs the customer right after sign up. Operations waiting for their retry are left
+    to the worker, so requests made while stripe is down don't use up their attempts.
+    """
+    content_type = ContentType.objects.get_for_model(instance)
+    pending = list(StripeOperation.objects.filter(content_type=content_type, object_id=instance.pk,
+                                                  status=StripeOperation.PENDING,
+                                                  next_attempt_at__lte=timezone.now()).values_list('id', flat=True))
+    if not pending:
+        return instance
+
+    for operation_id in pending:
+        with transaction.atomic():
+            operation = StripeOperation.objects.select_for_update().filter(
+                pk=operation_id, status=StripeOperation.PENDING, next_attempt_at__lte=timezone.now()).first()
+            # another worker already ran it, or it failed and waits for its retry
+            if operation:
+                run_operation(operation)
+    instance.refresh_from_db()
+    return instance
@@ -0,0 +1,177 @@
+"""
+Background migration of a tier's stripe subscriptions to its new price.
+
+When a tier's credit changes a new stripe price is created and a `PriceMigration` is scheduled for it.
+The `process_price_migrations` worker then moves the subscriptions in chunks, a few of them
+concurrently, while a shared rate limiter keeps the request rate below stripe's limit.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from subscribers.models import Subscription
+from .models import PriceMigration
+from .outbox import PERMANENT_ERRORS
+import threading
+import stripe
+import json
+import time
+
+CHUNK_SIZE = getattr(settings, 'STRIPE_PRICE_MIGRATION_CHUNK_SIZE', 100)
+CONCURRENCY = getattr(settings, 'STRIPE_PRICE_MIGRATION_CONCURRENCY', 4)
+REQUESTS_PER_SECOND = getattr(settings, 'STRIPE_PRICE_MIGRATION_REQUESTS_PER_SECOND', 20)
+MAX_ATTEMPTS = getattr(settings, 'STRIPE_OUTBOX_MAX_ATTEMPTS', 8)
+RETRY_BACKOFF_SECONDS = getattr(settings, 'STRIPE_OUTBOX_RETRY_BACKOFF_SECONDS', 5)
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+
+# a single request is retried a few times before the whole chunk backs off
+REQUEST_ATTEMPTS = 3
+RATE_LIMITED_ERRORS = (stripe.error.RateLimitError, stripe.error.APIConnectionError)
+
+
+class RateLimiter:
+    """
+    Spaces the requests made by the threads of a worker at least `1 / rate` seconds apart.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_request_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            request_at = max(now, self.next_request_at)
+            self.next_request_at = request_at + self.interval
+        if request_at > now:
+            time.sleep(request_at - now)
+
+
+def pending_subscriptions(migration):
+    # subscriptions on any older price of the tier, a previous migration may not have finished
+    return Subscription.objects.filter(tier_id=migration.tier_id, subscription_id__isnull=False) \
+        .exclude(price_id=migration.new_price_id)
+
+
+def schedule(tier, price_id):
+    """
+    Schedules the migration of the subscriptions of `tier` to `price_id`.
+    Unfinished migrations of the tier are superseded since their price is outdated now.
+    """
+    PriceMigration.objects.filter(tier=tier, status__in=[PriceMigration.PENDING, PriceMigration.RUNNING]) \
+        .update(status=PriceMigration.SUPERSEDED, finished=timezone.now())
+    migration = PriceMigration(tier=tier, new_price_id=price_id)
+    migration.total = pending_subscriptions(migration).count()
+    migration.save()
+    return migration
+
+
+def _subscription_item_id(subscription, limiter):
+    # the stored subscription already knows its item, saving a retrieve call
+    data = subscription.json_data
+    if isinstance(data, str):
+        data = json.loads(data)
+    try:
+        return data['items']['data'][0]['id']
+    except (TypeError, KeyError, IndexError):
+        limiter.wait()
+        return stripe.Subscription.retrieve(subscription.subscription_id)['items']['data'][0].id
+
+
+def migrate_subscription(migration, subscription, limiter):
+    for attempt in range(REQUEST_ATTEMPTS):
+        try:
+            item_id = _subscription_item_id(subscription, limiter)
+            limiter.wait()
+            # following these instructions https://stripe.com/docs/billing/subscriptions/products-and-prices
+            # to update the subscription pricing
+            return stripe.Subscription.modify(
+                subscription.subscription_id,
+                cancel_at_period_end=False,
+                proration_behavior='create_prorations',
+                items=[{
+                    'id': item_id,
+                    'price': migration.new_price_id,
+                }],
+                idempotency_key=f"{migration.surrogate}-{subscription.id}",
+            )
+        except RATE_LIMITED_ERRORS:
+            if attempt == REQUEST_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def run_chunk(migration, chunk_size=None, concurrency=None, limiter=None):
+    """
+    Migrates the next chunk of subscriptions of a migration that the caller has locked
+    and checkpoints the progress on it.
+    """
+    subscriptions = list(pending_subscriptions(migration).filter(id__gt=migration.cursor)
+                         .order_by('id')[:chunk_size or CHUNK_SIZE])
+    if not subscriptions:
+        migration.status = PriceMigration.DONE
+        migration.finished = timezone.now()
+        migration.save()
+        return migration
+
+    limiter = limiter or RateLimiter(REQUESTS_PER_SECOND)
+    with ThreadPoolExecutor(max_workers=concurrency or CONCURRENCY) as executor:
+        futures = [executor.submit(migrate_subscription, migration, subscription, limiter)
+                   for subscription in subscriptions]
+
+    migration.status = PriceMigration.RUNNING
+    error = None
+    for subscription, future in zip(subscriptions, futures):
+        try:
+            stripe_subscription = future.result()
+        except PERMANENT_ERRORS as e:
+            # e.g. the subscription was canceled on stripe, it stays on its price
+            if error is None:
+                migration.failed += 1
+                migration.last_error = f"Subscription {subscription.subscription_id}: {e}"
+                migration.cursor = subscription.id
+            continue
+        except Exception as e:
+            # the rest of the chunk is retried later, subscriptions migrated after this one are excluded
+            # by pending_subscriptions so the cursor can safely stop here
+            if error is None:
+                error = e
+            continue
+
+        Subscription.objects.filter(pk=subscription.pk).update(
+            json_data=json.dumps(stripe_subscription),
+            subscription_id=stripe_subscription.id,
+            price_id=migration.new_price_id,
+        )
+        migration.migrated += 1
+        if error is None:
+            migration.cursor = subscription.id
+
+    if error is None:
+        migration.attempts = 0
+    else:
+        migration.attempts += 1
+        migration.last_error = str(error)
+        if migration.attempts >= MAX_ATTEMPTS:
+            migration.status = PriceMigration.FAILED
+            migration.finished = timezone.now()
+        else:
+            delay = min(RETRY_BACKOFF_SECONDS * 2 ** (migration.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+            migration.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    migration.save()
+    return migration
+
+
+def process_next_chunk(chunk_size=None, concurrency=None, limiter=None):
+    """
+    Claims the oldest due migration and runs its next chunk. Returns None when nothing is due.
+    """
+    with transaction.atomic():
+        migration = PriceMigration.objects.select_for_update(skip_locked=True).filter(
+            status__in=[PriceMigration.PENDING, PriceMigration.RUNNING],
+            next_attempt_at__lte=timezone.now()).order_by('id').first()
+        if migration is None:
+            return None
+        return run_chunk(migration, chunk_size=chunk_size, concurrency=concurrency, limiter=limiter)
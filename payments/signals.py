@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# sent by the outbox worker once a new stripe Price has been created and stored on its target
+# receivers get `instance`, `price` and `previous_price_id` (None for the first price of the object)
+price_created = Signal()
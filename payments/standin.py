@@ -0,0 +1,465 @@
+"""
+Local stand-in for the subset of the stripe API the application uses.
+
+It keeps the objects in memory and answers like stripe does, so the payment flows can be load tested and
+benchmarked without network access. Start it with `python manage.py run_stripe_standin` and point the
+application to it with the STRIPE_API_BASE setting. Latency and errors can be injected, and when a webhook
+url is given the events our webhook handles are delivered to it, signed like stripe signs them.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+import threading
+import logging
+import secrets
+import random
+import hashlib
+import hmac
+import copy
+import json
+import time
+import re
+
+logger = logging.getLogger('payments.standin')
+
+# form encoded values are strings, these fields are numbers in stripe's responses
+NUMERIC_FIELDS = {'unit_amount', 'amount', 'percent_off', 'application_fee_amount', 'application_fee_percent',
+                  'quantity', 'trial_period_days', 'interval_count'}
+
+PREFIXES = {
+    'product': 'prod',
+    'price': 'price',
+    'customer': 'cus',
+    'payment_method': 'pm',
+    'subscription': 'sub',
+    'subscription_item': 'si',
+    'invoice': 'in',
+    'invoiceitem': 'ii',
+    'payment_intent': 'pi',
+    'setup_intent': 'seti',
+    'ephemeral_key': 'ephkey',
+    'account': 'acct',
+    'coupon': 'cpn',
+    'checkout.session': 'cs',
+    'event': 'evt',
+}
+
+
+class StripeError(Exception):
+    def __init__(self, status, error_type, message, code=None):
+        super().__init__(message)
+        self.status = status
+        self.error = {'type': error_type, 'message': message}
+        if code:
+            self.error['code'] = code
+
+
+def decode_params(pairs):
+    """
+    Turns stripe's form encoding (`items[0][price]=...`, `expand[]=...`) back into nested dicts and lists.
+    """
+    params = {}
+    for key, value in pairs:
+        path = [key.split('[', 1)[0]] + re.findall(r'\[([^\]]*)\]', key)
+        node = params
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        last = path[-1] or str(len(node))
+        if last in NUMERIC_FIELDS and re.fullmatch(r'-?\d+', value):
+            value = int(value)
+        node[last] = value
+    return _lists(params)
+
+
+def _lists(node):
+    if not isinstance(node, dict):
+        return node
+    if node and all(key.isdigit() for key in node):
+        return [_lists(node[key]) for key in sorted(node, key=int)]
+    return {key: _lists(value) for key, value in node.items()}
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """
+    The Stripe-Signature header for `payload`, see https://stripe.com/docs/webhooks/signatures
+    """
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+class StripeStandIn:
+    """
+    The in-memory state of the stand-in and the implementation of its endpoints.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 webhook_url=None, webhook_secret=None, webhook_delay=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_delay = webhook_delay
+        self.objects = {}
+        self.idempotent_responses = {}
+        self.requests = 0
+        self.lock = threading.RLock()
+        self.routes = [
+            ('POST', r'/v1/products', self.create_product),
+            ('GET', r'/v1/products/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/prices', self.create_price),
+            ('GET', r'/v1/prices/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/customers', self.create_customer),
+            ('GET', r'/v1/customers/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/customers/(?P<id>[^/]+)', self.modify),
+            ('GET', r'/v1/payment_methods/(?P<id>[^/]+)', self.retrieve_payment_method),
+            ('POST', r'/v1/payment_methods/(?P<id>[^/]+)/attach', self.attach_payment_method),
+            ('POST', r'/v1/subscriptions', self.create_subscription),
+            ('GET', r'/v1/subscriptions/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/subscriptions/(?P<id>[^/]+)', self.modify_subscription),
+            ('DELETE', r'/v1/subscriptions/(?P<id>[^/]+)', self.cancel_subscription),
+            ('GET', r'/v1/invoices/upcoming', self.upcoming_invoice),
+            ('POST', r'/v1/invoices', self.create_invoice),
+            ('GET', r'/v1/invoices/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/invoices/(?P<id>[^/]+)/pay', self.pay_invoice),
+            ('POST', r'/v1/invoiceitems', self.create_invoice_item),
+            ('POST', r'/v1/payment_intents', self.create_payment_intent),
+            ('GET', r'/v1/payment_intents/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)', self.modify),
+            ('POST', r'/v1/setup_intents', self.create_setup_intent),
+            ('POST', r'/v1/ephemeral_keys', self.create_ephemeral_key),
+            ('POST', r'/v1/accounts', self.create_account),
+            ('GET', r'/v1/accounts/(?P<id>[^/]+)', self.retrieve),
+            ('POST', r'/v1/accounts/(?P<id>[^/]+)/login_links', self.create_login_link),
+            ('POST', r'/v1/account_links', self.create_account_link),
+            ('GET', r'/v1/balance', self.retrieve_balance),
+            ('POST', r'/v1/coupons', self.create_coupon),
+            ('POST', r'/v1/checkout/sessions', self.create_checkout_session),
+            ('GET', r'/v1/checkout/sessions/(?P<id>[^/]+)', self.retrieve),
+        ]
+
+    # storage
+
+    def new_id(self, object_type):
+        return f"{PREFIXES[object_type]}_{secrets.token_hex(12)}"
+
+    def add(self, object_type, **fields):
+        obj = {'id': self.new_id(object_type), 'object': object_type, 'created': int(time.time()),
+               'livemode': False}
+        obj.update(fields)
+        self.objects[obj['id']] = obj
+        return obj
+
+    def get(self, object_id, object_type=None):
+        obj = self.objects.get(object_id)
+        if obj is None or (object_type and obj['object'] != object_type):
+            raise StripeError(404, 'invalid_request_error', f"No such {object_type or 'object'}: '{object_id}'",
+                              code='resource_missing')
+        return obj
+
+    def expand(self, obj, paths):
+        obj = copy.deepcopy(obj)
+        for path in paths or []:
+            node = obj
+            for field in path.split('.'):
+                value = node.get(field) if isinstance(node, dict) else None
+                if isinstance(value, str) and value in self.objects:
+                    value = node[field] = copy.deepcopy(self.objects[value])
+                node = value
+        return obj
+
+    @staticmethod
+    def merge(obj, params):
+        for key, value in params.items():
+            if key in ('expand', 'idempotency_key'):
+                continue
+            if key == 'metadata' and isinstance(value, dict):
+                obj.setdefault('metadata', {}).update(value)
+            else:
+                obj[key] = value
+        return obj
+
+    # webhooks
+
+    def send_event(self, event_type, obj, account=None):
+        if not self.webhook_url:
+            return
+        event = self.add('event', type=event_type, api_version='2020-08-27',
+                         data={'object': copy.deepcopy(obj)}, account=account, pending_webhooks=1)
+        payload = json.dumps(event)
+        headers = {'Content-Type': 'application/json'}
+        if self.webhook_secret:
+            headers['Stripe-Signature'] = sign_payload(payload, self.webhook_secret)
+
+        def deliver():
+            time.sleep(self.webhook_delay)
+            try:
+                urlopen(Request(self.webhook_url, data=payload.encode(), headers=headers), timeout=10).read()
+            except Exception:
+                logger.exception("Webhook delivery of %s failed", event['id'])
+        threading.Thread(target=deliver, daemon=True).start()
+
+    # endpoints
+
+    def retrieve(self, params, id):
+        return self.get(id)
+
+    def modify(self, params, id):
+        return self.merge(self.get(id), params)
+
+    def create_product(self, params):
+        return self.add('product', active=True, metadata={}, **params)
+
+    def create_price(self, params):
+        self.get(params.get('product'), 'product')
+        recurring = params.pop('recurring', None)
+        return self.add('price', active=True, metadata={}, recurring=recurring,
+                        type='recurring' if recurring else 'one_time', **params)
+
+    def create_customer(self, params):
+        customer = self.add('customer', metadata={}, invoice_settings={'default_payment_method': None}, **params)
+        self.send_event('customer.created', customer)
+        return customer
+
+    def _payment_method(self, id):
+        # payment methods are created by the apps with stripe.js, the stand-in makes them up on first use
+        if id not in self.objects:
+            self.objects[id] = {'id': id, 'object': 'payment_method', 'type': 'card', 'customer': None,
+                                'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030},
+                                'created': int(time.time()), 'livemode': False}
+        return self.objects[id]
+
+    def retrieve_payment_method(self, params, id):
+        return self._payment_method(id)
+
+    def attach_payment_method(self, params, id):
+        self.get(params.get('customer'), 'customer')
+        payment_method = self._payment_method(id)
+        payment_method['customer'] = params['customer']
+        self.send_event('payment_method.attached', payment_method)
+        return payment_method
+
+    def _payment_intent(self, amount, currency, **fields):
+        payment_intent = self.add('payment_intent', amount=amount, currency=currency, metadata={},
+                                  status='requires_payment_method', **fields)
+        payment_intent['client_secret'] = f"{payment_intent['id']}_secret_{secrets.token_hex(8)}"
+        return payment_intent
+
+    def _invoice(self, customer, subscription=None, billing_reason='manual', amount_due=0, **fields):
+        invoice = self.add('invoice', customer=customer, subscription=subscription, billing_reason=billing_reason,
+                           amount_due=amount_due, currency='eur', status='open', metadata={}, **fields)
+        invoice['payment_intent'] = self._payment_intent(amount_due, 'eur', customer=customer,
+                                                         invoice=invoice['id'])['id']
+        return invoice
+
+    def _pay(self, invoice):
+        invoice['status'] = 'paid'
+        payment_intent = self.objects[invoice['payment_intent']]
+        payment_intent['status'] = 'succeeded'
+        if invoice['subscription']:
+            self.objects[invoice['subscription']]['status'] = 'active'
+        self.send_event('invoice.payment_succeeded', invoice)
+
+    def _items(self, subscription_id, items):
+        data = []
+        for item in items:
+            price = self.get(item['price'], 'price')
+            data.append(self.add('subscription_item', subscription=subscription_id, price=copy.deepcopy(price),
+                                 quantity=item.get('quantity', 1)))
+        return {'object': 'list', 'data': data, 'has_more': False,
+                'url': f"/v1/subscription_items?subscription={subscription_id}"}
+
+    def create_subscription(self, params):
+        self.get(params.get('customer'), 'customer')
+        items = params.pop('items', [])
+        incomplete = params.get('payment_behavior') == 'default_incomplete'
+        subscription = self.add('subscription', metadata={}, cancel_at_period_end=False,
+                                status='incomplete' if incomplete else 'active')
+        self.merge(subscription, params)
+        subscription['items'] = self._items(subscription['id'], items)
+        amount = sum(item['price'].get('unit_amount') or 0 for item in subscription['items']['data'])
+        invoice = self._invoice(subscription['customer'], subscription['id'], 'subscription_create', amount)
+        subscription['latest_invoice'] = invoice['id']
+        # the apps confirm the payment with stripe.js, the stand-in considers it paid right away
+        self._pay(invoice)
+        return subscription
+
+    def modify_subscription(self, params, id):
+        subscription = self.get(id, 'subscription')
+        for item in params.pop('items', []):
+            existing = next((i for i in subscription['items']['data'] if i['id'] == item.get('id')), None)
+            if existing:
+                existing['price'] = copy.deepcopy(self.get(item['price'], 'price'))
+            else:
+                subscription['items']['data'] += self._items(id, [item])['data']
+        self.merge(subscription, params)
+        return subscription
+
+    def cancel_subscription(self, params, id):
+        subscription = self.get(id, 'subscription')
+        subscription['status'] = 'canceled'
+        subscription['canceled_at'] = int(time.time())
+        return subscription
+
+    def upcoming_invoice(self, params):
+        subscription = self.get(params.get('subscription'), 'subscription')
+        amount = sum(item['price'].get('unit_amount') or 0 for item in subscription['items']['data'])
+        invoice = self._invoice(params.get('customer'), subscription['id'], 'upcoming', amount)
+        # upcoming invoices aren't stored by stripe either
+        del self.objects[invoice['id']]
+        invoice['id'] = None
+        invoice['payment_intent'] = self.objects[invoice['payment_intent']]
+        return invoice
+
+    def create_invoice(self, params):
+        self.get(params.get('customer'), 'customer')
+        pending = [item for item in self.objects.values()
+                   if item['object'] == 'invoiceitem' and item['customer'] == params['customer'] and not item['invoice']]
+        amount = sum(item['amount'] for item in pending)
+        invoice = self._invoice(params.pop('customer'), amount_due=amount)
+        self.merge(invoice, params)
+        for item in pending:
+            item['invoice'] = invoice['id']
+        return invoice
+
+    def pay_invoice(self, params, id):
+        invoice = self.get(id, 'invoice')
+        self._pay(invoice)
+        return invoice
+
+    def create_invoice_item(self, params):
+        self.get(params.get('customer'), 'customer')
+        amount = params.pop('amount', None)
+        if params.get('price'):
+            price = self.get(params['price'], 'price')
+            amount = price['unit_amount']
+            # a 100% coupon makes the item free, the way our coupons are used
+            for discount in params.get('discounts') or []:
+                coupon = self.objects.get(discount.get('coupon'))
+                if coupon and coupon.get('percent_off'):
+                    amount = int(amount * (100 - coupon['percent_off']) / 100)
+        return self.add('invoiceitem', amount=amount or 0, invoice=None, metadata={}, **params)
+
+    def create_payment_intent(self, params):
+        payment_intent = self._payment_intent(params.pop('amount', 0), params.pop('currency', 'eur'))
+        self.merge(payment_intent, params)
+        # the apps confirm the payment with stripe.js, the stand-in considers it paid right away
+        payment_intent['status'] = 'succeeded'
+        self.send_event('payment_intent.succeeded', payment_intent)
+        return payment_intent
+
+    def create_setup_intent(self, params):
+        setup_intent = self.add('setup_intent', status='requires_payment_method', metadata={}, **params)
+        setup_intent['client_secret'] = f"{setup_intent['id']}_secret_{secrets.token_hex(8)}"
+        return setup_intent
+
+    def create_ephemeral_key(self, params):
+        return self.add('ephemeral_key', secret=f"ek_test_{secrets.token_hex(16)}",
+                        expires=int(time.time()) + 3600, associated_objects=[
+                            {'type': 'customer', 'id': params.get('customer')}])
+
+    def create_account(self, params):
+        account = self.add('account', charges_enabled=False, payouts_enabled=False, details_submitted=False,
+                           metadata={}, **params)
+        # onboarding is skipped, the account can take payments right away
+        account['charges_enabled'] = True
+        self.send_event('account.updated', account, account=account['id'])
+        return account
+
+    def create_login_link(self, params, id):
+        self.get(id, 'account')
+        return {'object': 'login_link', 'created': int(time.time()), 'url': f"https://connect.stripe.test/{id}"}
+
+    def create_account_link(self, params):
+        self.get(params.get('account'), 'account')
+        now = int(time.time())
+        return {'object': 'account_link', 'created': now, 'expires_at': now + 300,
+                'url': f"https://connect.stripe.test/setup/{params['account']}/{secrets.token_hex(8)}"}
+
+    def retrieve_balance(self, params):
+        return {'object': 'balance', 'livemode': False,
+                'available': [{'amount': 0, 'currency': 'eur', 'source_types': {'card': 0}}],
+                'pending': [{'amount': 0, 'currency': 'eur', 'source_types': {'card': 0}}]}
+
+    def create_coupon(self, params):
+        return self.add('coupon', valid=True, metadata={}, times_redeemed=0, **params)
+
+    def create_checkout_session(self, params):
+        session = self.add('checkout.session', payment_status='unpaid', status='open', metadata={},
+                           customer=None, customer_email=None)
+        self.merge(session, params)
+        session['url'] = f"https://checkout.stripe.test/pay/{session['id']}"
+        return session
+
+    # requests
+
+    def handle(self, method, path, params, idempotency_key=None):
+        """
+        Returns the status and the body of the response to a request.
+        """
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        with self.lock:
+            self.requests += 1
+            if idempotency_key and (method, idempotency_key) in self.idempotent_responses:
+                return self.idempotent_responses[(method, idempotency_key)]
+
+            try:
+                if random.random() < self.rate_limit_rate:
+                    raise StripeError(429, 'invalid_request_error', 'Too many requests', code='rate_limit')
+                if random.random() < self.error_rate:
+                    raise StripeError(500, 'api_error', 'Injected error')
+                expand = params.pop('expand', None)
+                for route_method, pattern, endpoint in self.routes:
+                    match = re.fullmatch(pattern, path)
+                    if route_method == method and match:
+                        body = self.expand(endpoint(params, **match.groupdict()), expand)
+                        response = (200, body)
+                        break
+                else:
+                    raise StripeError(404, 'invalid_request_error', f"Unrecognized request URL ({method}: {path})")
+            except StripeError as e:
+                response = (e.status, {'error': e.error})
+
+            # like stripe, failed requests are not saved and can be retried with the same key
+            if idempotency_key and response[0] < 500 and response[0] != 429:
+                self.idempotent_responses[(method, idempotency_key)] = response
+            return response
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    standin = None
+
+    def respond(self, method):
+        url = urlsplit(self.path)
+        pairs = parse_qsl(url.query, keep_blank_values=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            pairs += parse_qsl(self.rfile.read(length).decode(), keep_blank_values=True)
+        status, body = self.standin.handle(method, url.path, decode_params(pairs),
+                                           idempotency_key=self.headers.get('Idempotency-Key'))
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f"req_{secrets.token_hex(8)}")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_DELETE(self):
+        self.respond('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(standin, host='127.0.0.1', port=12111):
+    handler = type('StandInRequestHandler', (StandInRequestHandler,), {'standin': standin})
+    return ThreadingHTTPServer((host, port), handler)
@@ -0,0 +1,102 @@
+"""
+Cached reads of stripe objects.
+
+Prices can't be edited once created, so they are cached for good. Customers, payment methods and balances
+do change, they are cached for a short time and dropped earlier when a webhook event reports a change
+(see `invalidate_for_event`) or when we change them ourselves.
+"""
+from django.conf import settings
+from django.core.cache import cache
+import stripe
+
+CUSTOMER_TIMEOUT = getattr(settings, 'STRIPE_CACHE_CUSTOMER_TIMEOUT', 60)
+BALANCE_TIMEOUT = getattr(settings, 'STRIPE_CACHE_BALANCE_TIMEOUT', 30)
+
+
+def price_key(price_id):
+    return f"stripe:price:{price_id}"
+
+
+def customer_key(customer_id):
+    return f"stripe:customer:{customer_id}"
+
+
+def payment_method_key(payment_method_id):
+    return f"stripe:payment_method:{payment_method_id}"
+
+
+def balance_key(stripe_account):
+    return f"stripe:balance:{stripe_account}"
+
+
+def _cached(key, timeout, retrieve):
+    # objects are cached as plain dicts and turned back into stripe objects when read
+    data = cache.get(key)
+    if data is None:
+        data = retrieve().to_dict_recursive()
+        cache.set(key, data, timeout)
+    return stripe.util.convert_to_stripe_object(data, stripe.api_key)
+
+
+def retrieve_price(price_id):
+    return _cached(price_key(price_id), None, lambda: stripe.Price.retrieve(price_id))
+
+
+def store_price(price):
+    # a price we just created is cached right away, its first read needs no request
+    cache.set(price_key(price.id), price.to_dict_recursive(), None)
+
+
+def retrieve_customer(customer_id):
+    return _cached(customer_key(customer_id), CUSTOMER_TIMEOUT, lambda: stripe.Customer.retrieve(customer_id))
+
+
+def retrieve_payment_method(payment_method_id):
+    return _cached(payment_method_key(payment_method_id), CUSTOMER_TIMEOUT,
+                   lambda: stripe.PaymentMethod.retrieve(payment_method_id))
+
+
+def retrieve_balance(stripe_account):
+    return _cached(balance_key(stripe_account), BALANCE_TIMEOUT,
+                   lambda: stripe.Balance.retrieve(stripe_account=stripe_account))
+
+
+def invalidate_customer(customer_id):
+    cache.delete(customer_key(customer_id))
+
+
+def invalidate_payment_method(payment_method_id):
+    cache.delete(payment_method_key(payment_method_id))
+
+
+def invalidate_balance(stripe_account):
+    cache.delete(balance_key(stripe_account))
+
+
+def invalidate_for_event(event):
+    """
+    Drops the cached objects a webhook event reports a change of.
+    """
+    data_object = event.data.object
+    if event.type.startswith('customer.'):
+        # customer.updated, customer.deleted and the events of its sources and subscriptions
+        customer_id = data_object['id'] if data_object.get('object') == 'customer' else data_object.get('customer')
+        if customer_id:
+            invalidate_customer(customer_id)
+    elif event.type.startswith('payment_method.'):
+        invalidate_payment_method(data_object['id'])
+        # a detached payment method no longer has its customer, it is in the previous attributes
+        previous_attributes = event.data.get('previous_attributes') or {}
+        for customer_id in (data_object.get('customer'), previous_attributes.get('customer')):
+            if customer_id:
+                invalidate_customer(customer_id)
+    elif event.type == 'balance.available':
+        invalidate_balance(event.get('account'))
+    elif event.type.startswith('transfer.'):
+        # transfers are made by the platform, the balance that changes is the destination's
+        if data_object.get('destination'):
+            invalidate_balance(data_object['destination'])
+    elif event.type.startswith('payout.') or event.type.startswith('charge.'):
+        # money moving on a connected account changes its balance
+        if event.get('account'):
+            invalidate_balance(event.get('account'))
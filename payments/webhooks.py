@@ -0,0 +1,143 @@
+"""
+Queue for the events stripe delivers to the webhook.
+
+The webhook verifies the signature and stores the event with `record_event`, acknowledging the delivery
+right away. The `process_stripe_events` workers run the handlers registered with `@handles` afterwards,
+retrying failed events with backoff. Events of the same object are processed in the order they occurred.
+"""
+from datetime import datetime, timedelta
+from importlib import import_module
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .models import StripeEvent
+import stripe
+import os
+
+MAX_ATTEMPTS = getattr(settings, 'STRIPE_OUTBOX_MAX_ATTEMPTS', 8)
+RETRY_BACKOFF_SECONDS = getattr(settings, 'STRIPE_OUTBOX_RETRY_BACKOFF_SECONDS', 5)
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+
+HANDLERS = {}
+
+
+def handles(*event_types):
+    """
+    Registers the decorated function as the handler of `event_types`. It is called with the stripe event.
+    """
+    def decorator(func):
+        for event_type in event_types:
+            HANDLERS[event_type] = func
+        return func
+    return decorator
+
+
+def load_handlers():
+    for module in getattr(settings, 'STRIPE_WEBHOOK_HANDLERS', []):
+        import_module(module)
+
+
+def construct_event(payload, sig_header):
+    """
+    Verifies the signature of a delivery. Raises ValueError for an invalid payload and
+    stripe.error.SignatureVerificationError for an invalid signature.
+    """
+    # endpoints received from "account" and "connect applications" both land here
+    # so we have to check both signatures
+    # if one fails try the other
+    try:
+        return stripe.Webhook.construct_event(payload, sig_header, os.environ.get('STRIPE_ENDPOINT_SECRET'))
+    except stripe.error.SignatureVerificationError:
+        return stripe.Webhook.construct_event(payload, sig_header, os.environ.get('STRIPE_ENDPOINT_REGULAR_SECRET'))
+
+
+def get_object_key(event):
+    data_object = event.data.object
+    # invoices are ordered together with the rest of the events of their subscription
+    subscription = data_object.get('subscription')
+    if isinstance(subscription, str):
+        return subscription
+    return data_object.get('id')
+
+
+def record_event(event):
+    """
+    Stores a verified event, a redelivery of an event that has been stored already is a no-op.
+    """
+    stripe_event, created = StripeEvent.objects.get_or_create(event_id=event.id, defaults={
+        'type': event.type,
+        'account': event.get('account'),
+        'object_key': get_object_key(event),
+        'event_created': datetime.fromtimestamp(event.created, tz=timezone.utc),
+        'payload': event.to_dict_recursive(),
+    })
+    return stripe_event
+
+
+def _retry_later(stripe_event, error):
+    stripe_event.last_error = str(error)
+    if stripe_event.attempts >= MAX_ATTEMPTS:
+        stripe_event.status = StripeEvent.FAILED
+        stripe_event.processed = timezone.now()
+        return
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** (stripe_event.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+    stripe_event.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
+def run_event(stripe_event):
+    """
+    Runs the handler of an event that the caller has locked and records the outcome on it.
+    """
+    handler = HANDLERS.get(stripe_event.type)
+    if handler is None:
+        stripe_event.status = StripeEvent.IGNORED
+        stripe_event.processed = timezone.now()
+        stripe_event.save()
+        return stripe_event
+
+    stripe_event.attempts += 1
+    try:
+        # a failing handler doesn't leave half of its changes behind when the event is retried
+        with transaction.atomic():
+            handler(stripe.Event.construct_from(stripe_event.payload, stripe.api_key))
+    except Exception as e:
+        _retry_later(stripe_event, e)
+    else:
+        stripe_event.status = StripeEvent.DONE
+        stripe_event.processed = timezone.now()
+        stripe_event.last_error = None
+    stripe_event.save()
+    return stripe_event
+
+
+def due_events():
+    # an event waits while an earlier event of the same object is still pending,
+    # including one that is being processed by another worker or waiting for a retry
+    earlier_pending = StripeEvent.objects.filter(
+        Q(event_created__lt=OuterRef('event_created')) | Q(event_created=OuterRef('event_created'), id__lt=OuterRef('id')),
+        object_key=OuterRef('object_key'), status=StripeEvent.PENDING,
+    )
+    return StripeEvent.objects.filter(~Exists(earlier_pending), status=StripeEvent.PENDING,
+                                      next_attempt_at__lte=timezone.now())
+
+
+def process_next_event():
+    """
+    Claims the oldest due event and runs it. Returns None when nothing is due.
+    `skip_locked` lets a pool of workers process events without picking the same one.
+    """
+    with transaction.atomic():
+        stripe_event = due_events().select_for_update(skip_locked=True).order_by('event_created', 'id').first()
+        if stripe_event is None:
+            return None
+        return run_event(stripe_event)
+
+
+def process_pending_events(limit=None):
+    processed = 0
+    while limit is None or processed < limit:
+        if process_next_event() is None:
+            break
+        processed += 1
+    return processed
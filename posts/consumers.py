@@ -1,10 +1,11 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from notifications.models import Notification
+from coach.metrics import ConnectionMetricsMixin
 import json
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(ConnectionMetricsMixin, AsyncWebsocketConsumer):
     async def connect(self):
         user = self.scope['user']
 
@@ -33,6 +34,15 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'id': notification_id
         }))
 
+    async def send_video_ready(self, event):
+        # the video of a post or milestone report the user uploaded can be played
+        await self.send(text_data=json.dumps({
+            'type': 'video.ready',
+            'object': event['object'],
+            'id': event['id'],
+            'playback_ids': event['playback_ids'],
+        }))
+
     @database_sync_to_async
     def get_notification(self, notification_id):
         notification = Notification.objects.get(pk=notification_id)
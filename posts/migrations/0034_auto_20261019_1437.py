@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-19 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0033_auto_20210616_0118'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='postvideo',
+            name='asset_id',
+            field=models.CharField(db_index=True, max_length=120),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.contrib.contenttypes.fields import GenericRelation
@@ -8,6 +8,7 @@ from notifications.models import Notification
 from asgiref.sync import async_to_sync
 import channels.layers
 from common.models import CommonImage
+from common.cache import register_cache_tags, tag
 from instructor.models import Coach
 from tiers.models import Tier
 from projects.models import Project
@@ -79,7 +80,8 @@ class PostVideoAssetMetaData(models.Model):
 class PostVideo(models.Model):
     passthrough = models.UUIDField(default=uuid.uuid1)
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="videos")
-    asset_id = models.CharField(max_length=120)
+    # the webhook finds the video of a redelivered asset by its id
+    asset_id = models.CharField(max_length=120, db_index=True)
 
 
 class PlaybackId(models.Model):
@@ -100,10 +102,10 @@ def post_created(sender, instance, created, **kwargs):
             # I don't honestly know why I am able to get the created the notification like this
             # but I cannot find an alternative so I will use it throughout this app
             notification = notification_data[0][1][0]
-            async_to_sync(channel_layer.group_send)(
-                f"{str(sub.surrogate)}.notifications.group",
-                {
-                    'type': 'send.notification',
-                    'id': notification.id
-                }
-            )
+            group = f"{str(sub.surrogate)}.notifications.group"
+            # the consumer loads the notification, which it only sees once the post is committed
+            transaction.on_commit(lambda group=group, id=notification.id: async_to_sync(channel_layer.group_send)(
+                group, {'type': 'send.notification', 'id': id}))
+
+
+register_cache_tags(Post, related=lambda post: [tag(Coach, post.coach_id)])
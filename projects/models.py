@@ -1,5 +1,5 @@
-from django.db import models
-from django.db.models.signals import m2m_changed, post_save, pre_save
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 from notifications.signals import notify
 from notifications.models import Notification
@@ -7,31 +7,12 @@ from asgiref.sync import async_to_sync
 import channels.layers
 from subscribers.models import Subscriber
 from common.models import CommonImage
+from common.cache import register_cache_tags, tag
 from instructor.models import Coach
 from accounts.models import User
 from djmoney.models.fields import MoneyField
-from babel.numbers import get_currency_precision
+from payments import outbox
 import uuid
-import stripe
-import os
-
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-
-def money_to_integer(money):
-    return int(
-        money.amount * (
-            10 ** get_currency_precision(money.currency.code)
-        )
-    )
-
-def create_stripe_price(instance):
-    price = stripe.Price.create(
-        unit_amount=money_to_integer(instance.credit),
-        currency=instance.credit.currency.code.lower(),
-        product=instance.product_id,
-    )
-
-    return price
 
 
 class Project(models.Model):
@@ -64,14 +45,12 @@ class Project(models.Model):
         return self.name
 
     def save(self, *args, **kwargs):
-        if not self.product_id:
-            product = stripe.Product.create(name="%s - %s" % (self.coach.name, self.name))
-            self.product_id = product.id
-        else:
-            pass
-        price = create_stripe_price(self)
-        self.price_id = price.id
-        return super().save()
+        old_project = Project.objects.filter(pk=self.pk).first() if self.pk else None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # stripe prices can't be edited, record a new one only when the credit actually changes
+            if old_project and old_project.credit != self.credit and self.price_id:
+                outbox.enqueue_price(self)
 
 
 class TeamImage(CommonImage):
@@ -153,7 +132,8 @@ class MilestoneCompletionVideoAssetMetaData(models.Model):
 class MilestoneCompletionVideo(models.Model):
     passthrough = models.UUIDField(default=uuid.uuid1)
     milestone_completion_report = models.ForeignKey(MilestoneCompletionReport, on_delete=models.CASCADE, related_name="videos")
-    asset_id = models.CharField(max_length=120)
+    # the webhook finds the video of a redelivered asset by its id
+    asset_id = models.CharField(max_length=120, db_index=True)
 
 
 class MilestoneCompletionPlaybackId(models.Model):
@@ -171,18 +151,14 @@ class Coupon(models.Model):
     json_data = models.JSONField(null=True, blank=True)
 
 
-@receiver(pre_save, sender=Project)
+@receiver(post_save, sender=Project)
 def project_updated(sender, instance, *args, **kwargs):
-    # create stripe Product
+    # record the stripe Product
     if not instance.product_id:
-        product = stripe.Product.create(name="%s - %s" % (instance.coach.name, instance.name))
-        instance.product_id = product.id
-    else:
-        pass
+        outbox.enqueue_product(instance, "%s - %s" % (instance.coach.name, instance.name))
 
     if not instance.price_id:
-        price = create_stripe_price(instance)
-        instance.price_id = price.id
+        outbox.enqueue_price(instance)
 
 
 @receiver(m2m_changed, sender=Team.members.through)
@@ -213,13 +189,10 @@ def milestone_completion_report_notification_to_coach(sender, instance, **kwargs
         notification_data = notify.send(instance.members.first().user, recipient=instance.milestone.project.coach.user, verb='completed a milestone', action_object=instance)
 
         notification = notification_data[0][1][0]
-        async_to_sync(channel_layer.group_send)(
-            f"{str(instance.milestone.project.coach.user.surrogate)}.notifications.group",
-            {
-                'type': 'send.notification',
-                'id': notification.id
-            }
-        )
+        group = f"{str(instance.milestone.project.coach.user.surrogate)}.notifications.group"
+        # the consumer loads the notification, which it only sees once the report is committed
+        transaction.on_commit(lambda: async_to_sync(channel_layer.group_send)(
+            group, {'type': 'send.notification', 'id': notification.id}))
 
 
 @receiver(post_save, sender=MilestoneCompletionReport, dispatch_uid="send_notification")
@@ -250,3 +223,7 @@ def milestone_completion_report_notification(sender, instance, created, **kwargs
                         'id': notification.id
                     }
                 )
+
+
+register_cache_tags(Project, related=lambda project: [tag(Coach, project.coach_id)] if project.coach_id else [])
+register_cache_tags(Team, related=lambda team: [tag(Project, team.project_id)] if team.project_id else [])
@@ -0,0 +1,46 @@
+"""
+Finds the coaches that are free to answer a question at a given time.
+
+A coach is free at `start` for `duration` when one of their available time ranges of that weekday
+covers the whole call and none of the questions assigned to them overlaps it.
+Both checks are subqueries, so a whole expertise is answered with a single query.
+"""
+from datetime import time, timedelta
+from django.db.models import Exists, OuterRef
+from .models import AvailableTimeRange, Question
+
+DEFAULT_DURATION = timedelta(hours=1)
+
+
+def has_time_range(start, duration):
+    end = start + duration
+    # a call running past midnight would need the range of the next day as well, ranges end by midnight
+    end_time = end.time() if end.date() == start.date() else time.max
+    return Exists(AvailableTimeRange.objects.filter(
+        coach=OuterRef('pk'),
+        # AvailableTimeRange.weekday follows isoweekday, 1 is Monday
+        weekday=start.isoweekday(),
+        start_time__lte=start.time(),
+        end_time__gte=end_time,
+    ))
+
+
+def is_booked(start, duration):
+    # two intervals overlap when each one starts before the other one ends
+    return Exists(Question.objects.filter(
+        delivered_by=OuterRef('pk'),
+        initial_delivery_time__lt=start + duration,
+        delivery_time__gt=start,
+    ))
+
+
+def annotate_availability(coaches, start, duration=DEFAULT_DURATION):
+    """
+    Annotates `has_time_range` and `is_booked` on the coaches, a coach is available when
+    the first is true and the second false.
+    """
+    return coaches.annotate(has_time_range=has_time_range(start, duration), is_booked=is_booked(start, duration))
+
+
+def available_coaches(coaches, start, duration=DEFAULT_DURATION):
+    return coaches.filter(has_time_range(start, duration)).exclude(is_booked(start, duration))
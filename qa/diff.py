@@ -0,0 +1,84 @@
+"""
+Applies the full lists coaches send for their available time ranges and common questions as a diff:
+the rows that are still wanted are kept, the others removed with a single delete and the new ones
+added with a single `bulk_create`.
+"""
+from collections import Counter
+from django.db import transaction
+from .models import AvailableTimeRange, CommonQuestion
+
+
+def find_overlap(time_ranges):
+    """
+    Returns the first two ranges of the same weekday that overlap, or None.
+    `time_ranges` are dicts with `weekday`, `start_time` and `end_time`.
+    """
+    by_weekday = {}
+    for time_range in time_ranges:
+        by_weekday.setdefault(time_range['weekday'], []).append(time_range)
+    for ranges in by_weekday.values():
+        ranges = sorted(ranges, key=lambda r: (r['start_time'], r['end_time']))
+        for previous, current in zip(ranges, ranges[1:]):
+            # sorted by start, so a range overlaps the previous one when it starts before that one ends
+            if current['start_time'] < previous['end_time']:
+                return previous, current
+    return None
+
+
+def _apply(existing, wanted, key, model, make):
+    """
+    The `existing` rows and the `wanted` items are matched on `key`, duplicates included.
+    Returns True when anything changed.
+    """
+    remaining = Counter(key(item) for item in wanted)
+    with transaction.atomic():
+        removed = []
+        for row in existing:
+            if remaining[key(row)] > 0:
+                remaining[key(row)] -= 1
+            else:
+                removed.append(row.id)
+
+        added = []
+        for item in wanted:
+            if remaining[key(item)] > 0:
+                remaining[key(item)] -= 1
+                added.append(make(item))
+
+        if removed:
+            model.objects.filter(id__in=removed).delete()
+        if added:
+            model.objects.bulk_create(added)
+    return bool(removed or added)
+
+
+def _time_range_key(time_range):
+    if isinstance(time_range, AvailableTimeRange):
+        return time_range.weekday, time_range.start_time, time_range.end_time
+    return time_range['weekday'], time_range['start_time'], time_range['end_time']
+
+
+def update_time_ranges(coach, time_ranges):
+    """
+    Makes the validated `time_ranges` the coach's available time ranges. Returns True when anything changed.
+    """
+    return _apply(
+        coach.available_time_ranges.all(),
+        time_ranges,
+        _time_range_key,
+        AvailableTimeRange,
+        lambda time_range: AvailableTimeRange(coach=coach, **time_range),
+    )
+
+
+def update_common_questions(coach, bodies):
+    """
+    Makes `bodies` the coach's common questions. Returns True when anything changed.
+    """
+    return _apply(
+        coach.common_questions.all(),
+        bodies,
+        lambda question: question.body if isinstance(question, CommonQuestion) else question,
+        CommonQuestion,
+        lambda body: CommonQuestion(coach=coach, body=body),
+    )
@@ -0,0 +1,95 @@
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from accounts.models import User
+from instructor.models import Coach
+from expertisefields.models import ExpertiseFieldMultiple
+from qa.models import AvailableTimeRange, Question
+from qa.availability import annotate_availability
+import random
+import uuid
+
+EXPERTISE = 'Benchmark expertise'
+
+
+class Command(BaseCommand):
+    help = 'Measures how long finding the available coaches of an expertise takes, on generated coaches ' \
+           'that are rolled back afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coaches', type=int, default=5000)
+        parser.add_argument('--questions-per-coach', type=int, default=10)
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--compare', action='store_true',
+                            help='Also measure the previous per coach loop')
+
+    def generate(self, options):
+        User.objects.bulk_create([
+            User(username=f"benchmark-{i}", email=f"benchmark-{uuid.uuid4()}@example.com")
+            for i in range(options['coaches'])
+        ])
+        users = User.objects.filter(username__startswith='benchmark-')
+        Coach.objects.bulk_create([Coach(user=user, name=user.username) for user in users])
+        coaches = list(Coach.objects.filter(user__username__startswith='benchmark-'))
+        ExpertiseFieldMultiple.objects.bulk_create([
+            ExpertiseFieldMultiple(coach=coach, name=EXPERTISE) for coach in coaches
+        ])
+
+        time_ranges = []
+        questions = []
+        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        for coach in coaches:
+            for weekday in range(1, 8):
+                start_hour = random.randint(6, 14)
+                time_ranges.append(AvailableTimeRange(coach=coach, weekday=weekday, start_time=time(start_hour),
+                                                      end_time=time(start_hour + random.randint(2, 8))))
+            for _ in range(options['questions_per_coach']):
+                start = now + timedelta(hours=random.randint(0, 24 * 14))
+                questions.append(Question(delivered_by=coach, initial_delivery_time=start,
+                                          delivery_time=start + timedelta(minutes=random.choice([15, 30, 45, 60]))))
+        AvailableTimeRange.objects.bulk_create(time_ranges, batch_size=1000)
+        Question.objects.bulk_create(questions, batch_size=1000)
+        return now
+
+    def previous_loop(self, coaches, start, duration):
+        # the per coach checks check_available_coaches_for_question used to run
+        available = []
+        for coach in coaches:
+            has_time_range = coach.available_time_ranges.filter(
+                start_time__lte=start.time(), end_time__gte=start.time()).exists()
+            is_booked = coach.assigned_questions.filter(delivery_time__range=[start, start + duration]).exists()
+            if has_time_range and not is_booked:
+                available.append(coach)
+        return available
+
+    def measure(self, label, runs, starts, find):
+        durations = []
+        with CaptureQueriesContext(connection) as queries:
+            for start in starts[:runs]:
+                began = datetime.now()
+                found = len(find(start))
+                durations.append((datetime.now() - began).total_seconds() * 1000)
+        durations.sort()
+        self.stdout.write(f"{label}: median {durations[len(durations) // 2]:.1f}ms, max {durations[-1]:.1f}ms, "
+                          f"{len(queries) / runs:.0f} queries per lookup, {found} coaches available in the last one")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            now = self.generate(options)
+            coaches = Coach.objects.filter(expertise_fields__name__iexact=EXPERTISE)
+            duration = timedelta(hours=1)
+            starts = [now + timedelta(hours=random.randint(0, 24 * 14), minutes=random.choice([0, 15, 30, 45]))
+                      for _ in range(options['runs'])]
+            self.stdout.write(f"{options['coaches']} coaches, {options['questions_per_coach']} questions each")
+
+            self.measure('availability query', options['runs'], starts, lambda start: [
+                coach for coach in annotate_availability(coaches, start, duration)
+                if coach.has_time_range and not coach.is_booked
+            ])
+            if options['compare']:
+                # the loop is slow, a few runs are enough
+                self.measure('previous per coach loop', min(options['runs'], 3), starts,
+                             lambda start: self.previous_loop(coaches, start, duration))
+            transaction.set_rollback(True)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from instructor.models import Coach
+from qa.slots import regenerate_coach_slots
+
+
+class Command(BaseCommand):
+    help = 'Extends the slot calendar of every coach with time ranges to the coming weeks, run it daily'
+
+    def handle(self, *args, **options):
+        created = 0
+        coaches = Coach.objects.filter(available_time_ranges__isnull=False).distinct()
+        for coach in coaches.iterator():
+            created += len(regenerate_coach_slots(coach))
+        self.stdout.write(f"Created {created} slots")
@@ -0,0 +1,21 @@
+# Generated by Django 3.1 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0010_auto_20220210_0711'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='availabletimerange',
+            index=models.Index(fields=['coach', 'weekday', 'start_time', 'end_time'], name='time_range_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['delivered_by', 'initial_delivery_time', 'delivery_time'], name='question_booked_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1 on 2026-10-19 14:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instructor', '0028_auto_20220225_0414'),
+        ('qa', '0011_auto_20261019_1412'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvailabilitySlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('is_booked', models.BooleanField(default=False)),
+                ('coach', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability_slots', to='instructor.coach')),
+                ('question', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='availability_slots', to='qa.question')),
+            ],
+            options={
+                'ordering': ('start',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='availabilityslot',
+            index=models.Index(fields=['is_booked', 'start'], name='slot_next_free_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='availabilityslot',
+            constraint=models.UniqueConstraint(fields=('coach', 'start'), name='unique_coach_slot'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-19 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0012_auto_20261019_1414'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='classification',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
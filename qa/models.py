@@ -1,34 +1,11 @@
 from django.dispatch import receiver
-from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db import models, transaction
+from django.db.models.signals import post_save, pre_delete
 from django.core.mail import send_mail
 from djmoney.models.fields import MoneyField
 from instructor.models import Coach
+from payments import outbox
 import uuid
-import os
-import stripe
-from babel.numbers import get_currency_precision
-
-
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-
-
-def money_to_integer(money):
-    return int(
-        money.amount * (
-            10 ** get_currency_precision(money.currency.code)
-        )
-    )
-
-
-def create_stripe_price(instance):
-    price = stripe.Price.create(
-        unit_amount=money_to_integer(instance.credit),
-        currency=instance.credit.currency.code.lower(),
-        product=instance.product_id,
-    )
-
-    return price
 
 
 class Question(models.Model):
@@ -44,6 +21,15 @@ class Question(models.Model):
 
     zoom_link = models.URLField(null=True, blank=True)
     zoom_password = models.CharField(max_length=50, null=True, blank=True)
+    # the tags and expertise found in the body, see api.v1.utils.classify_question
+    classification = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the booked calls of a coach, see qa/availability.py
+            models.Index(fields=['delivered_by', 'initial_delivery_time', 'delivery_time'],
+                         name='question_booked_idx'),
+        ]
 
     def __str__(self):
         return self.body or ''
@@ -92,16 +78,12 @@ class QaSession(models.Model):
         return f"{self.coach.name} - {self.minutes} minute session"
 
     def save(self, *args, **kwargs):
-        if not self.product_id:
-            product = stripe.Product.create(
-                name=f"{self.coach.name} - {self.minutes} minute session")
-            self.product_id = product.id
-        else:
-            pass
-
-        price = create_stripe_price(self)
-        self.price_id = price.id
-        return super().save()
+        old_qa_session = QaSession.objects.filter(pk=self.pk).first() if self.pk else None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # stripe prices can't be edited, record a new one only when the credit actually changes
+            if old_qa_session and old_qa_session.credit != self.credit and self.price_id:
+                outbox.enqueue_price(self)
 
 
 class AvailableTimeRange(models.Model):
@@ -121,6 +103,37 @@ class AvailableTimeRange(models.Model):
     start_time = models.TimeField()
     end_time = models.TimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['coach', 'weekday', 'start_time', 'end_time'], name='time_range_lookup_idx'),
+        ]
+
+
+class AvailabilitySlot(models.Model):
+    """
+    A bookable slot of a coach, generated for the next weeks from the coach's available time ranges
+    (see qa/slots.py). Slots overlapping a booked question are marked as booked.
+    """
+    coach = models.ForeignKey(Coach, on_delete=models.CASCADE, related_name="availability_slots")
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    is_booked = models.BooleanField(default=False)
+    question = models.ForeignKey(Question, on_delete=models.SET_NULL, null=True, blank=True,
+                                 related_name="availability_slots")
+
+    class Meta:
+        ordering = ('start',)
+        constraints = [
+            models.UniqueConstraint(fields=['coach', 'start'], name='unique_coach_slot'),
+        ]
+        indexes = [
+            # the next free slots across coaches
+            models.Index(fields=['is_booked', 'start'], name='slot_next_free_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.coach.name} - {self.start}"
+
 
 class CommonQuestion(models.Model):
     surrogate = models.UUIDField(default=uuid.uuid4, db_index=True)
@@ -149,20 +162,41 @@ def question_invitation_created(sender, instance, created, *args, **kwargs):
         )
 
 
-@receiver(pre_save, sender=QaSession)
+@receiver(post_save, sender=Question)
+def question_rescheduled(sender, instance, created, **kwargs):
+    # a question moved to another coach or time releases the slots it no longer overlaps and books the new ones,
+    # the slots of a question are first booked when its call is paid, see qa/slots.py
+    if created:
+        return
+    scheduled = instance.delivered_by_id and instance.initial_delivery_time and instance.delivery_time
+    slots = AvailabilitySlot.objects.filter(question=instance)
+    if scheduled:
+        slots = slots.exclude(coach_id=instance.delivered_by_id, start__lt=instance.delivery_time,
+                              end__gt=instance.initial_delivery_time)
+    if slots.update(is_booked=False, question=None) and scheduled:
+        AvailabilitySlot.objects.filter(
+            coach_id=instance.delivered_by_id,
+            start__lt=instance.delivery_time,
+            end__gt=instance.initial_delivery_time,
+        ).update(is_booked=True, question=instance)
+
+
+@receiver(pre_delete, sender=Question)
+def question_deleted(sender, instance, **kwargs):
+    # deleting the question only clears `question` of its slots
+    AvailabilitySlot.objects.filter(question=instance).update(is_booked=False, question=None)
+
+
+@receiver(post_save, sender=QaSession)
 def qa_session_updated(sender, instance, *args, **kwargs):
-    # create stripe Product
+    # record the stripe Product
     if not instance.product_id:
-        product = stripe.Product.create(
-            name=f"{instance.coach.name} - {instance.minutes} minute session")
-        instance.product_id = product.id
-    else:
-        pass
+        outbox.enqueue_product(
+            instance, f"{instance.coach.name} - {instance.minutes} minute session")
 
-    # create stripe Price
+    # record the stripe Price
     if not instance.price_id:
-        price = create_stripe_price(instance)
-        instance.price_id = price.id
+        outbox.enqueue_price(instance)
 
 
 def get_credits_for_x_minutes(credit_15_min, minutes):
@@ -188,6 +222,3 @@ def create_sessions(sender, instance, created, **kwargs):
             qa_session.credit = get_credits_for_x_minutes(
                 credit_15_minutes, qa_session.minutes)
             qa_session.save()
-
-            price = create_stripe_price(qa_session)
-            qa_session.price_id = price.id
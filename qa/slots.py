@@ -0,0 +1,107 @@
+"""
+Calendar of bookable slots per coach.
+
+The slots of the next `QA_SLOT_WEEKS` weeks are generated from the coaches' available time ranges, so the
+next free slots can be read straight from the `AvailabilitySlot` table instead of being computed from the
+time ranges and the booked questions on every request.
+"""
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import AvailabilitySlot, Question
+
+SLOT_MINUTES = getattr(settings, 'QA_SLOT_MINUTES', 15)
+WEEKS = getattr(settings, 'QA_SLOT_WEEKS', 4)
+
+
+def slot_starts(time_ranges, start, end):
+    """
+    The starts of the slots between `start` and `end` the time ranges make available.
+    """
+    length = timedelta(minutes=SLOT_MINUTES)
+    ranges_by_weekday = {}
+    for time_range in time_ranges:
+        ranges_by_weekday.setdefault(time_range.weekday, []).append(time_range)
+
+    starts = set()
+    day = start.date()
+    while day <= end.date():
+        for time_range in ranges_by_weekday.get(day.isoweekday(), []):
+            slot_start = datetime.combine(day, time_range.start_time, tzinfo=timezone.utc)
+            range_end = datetime.combine(day, time_range.end_time, tzinfo=timezone.utc)
+            while slot_start + length <= range_end:
+                if start <= slot_start and slot_start + length <= end:
+                    starts.add(slot_start)
+                slot_start += length
+        day += timedelta(days=1)
+    return starts
+
+
+def _overlaps(slot_start, slot_end, questions):
+    for question in questions:
+        if question.initial_delivery_time < slot_end and question.delivery_time > slot_start:
+            return question
+    return None
+
+
+def regenerate_coach_slots(coach, now=None):
+    """
+    Brings the slots of the coach in line with their time ranges and booked questions. Only the difference
+    is written: slots of removed time ranges are deleted, slots of new ones created and the rest kept.
+    """
+    now = now or timezone.now()
+    until = now + timedelta(weeks=WEEKS)
+    length = timedelta(minutes=SLOT_MINUTES)
+    wanted = slot_starts(coach.available_time_ranges.all(), now, until)
+    questions = list(Question.objects.filter(delivered_by=coach, initial_delivery_time__lt=until,
+                                             delivery_time__gt=now))
+
+    with transaction.atomic():
+        existing = {slot.start: slot for slot in AvailabilitySlot.objects.filter(coach=coach, start__gte=now)}
+        removed = []
+        changed = []
+        for start, slot in existing.items():
+            question = _overlaps(start, slot.end, questions)
+            # slots of a removed time range go away, unless somebody booked them already
+            if start not in wanted and question is None:
+                removed.append(slot.id)
+            elif slot.is_booked != (question is not None) or slot.question_id != (question and question.id):
+                slot.is_booked = question is not None
+                slot.question = question
+                changed.append(slot)
+        AvailabilitySlot.objects.filter(id__in=removed).delete()
+        AvailabilitySlot.objects.bulk_update(changed, ['is_booked', 'question'])
+
+        new_slots = []
+        for start in sorted(wanted - existing.keys()):
+            question = _overlaps(start, start + length, questions)
+            new_slots.append(AvailabilitySlot(coach=coach, start=start, end=start + length,
+                                              is_booked=question is not None, question=question))
+        AvailabilitySlot.objects.bulk_create(new_slots)
+        # the slots that are past don't matter anymore
+        AvailabilitySlot.objects.filter(coach=coach, end__lte=now).delete()
+    return new_slots
+
+
+def book_slots(question):
+    """
+    Marks the slots of the coach the question was assigned to that overlap it as booked.
+    """
+    if not question.delivered_by_id or not question.initial_delivery_time or not question.delivery_time:
+        return 0
+    return AvailabilitySlot.objects.filter(
+        coach_id=question.delivered_by_id,
+        start__lt=question.delivery_time,
+        end__gt=question.initial_delivery_time,
+    ).update(is_booked=True, question=question)
+
+
+def next_free_slots(count, coaches=None, after=None):
+    """
+    The `count` earliest free slots, across all coaches or the given ones.
+    """
+    slots = AvailabilitySlot.objects.filter(is_booked=False, start__gte=after or timezone.now())
+    if coaches is not None:
+        slots = slots.filter(coach__in=coaches)
+    return slots.select_related('coach').order_by('start')[:count]
@@ -0,0 +1,82 @@
+"""
+What a user is entitled to see: the tiers they subscribed to, the coaches of those tiers and the tiers of
+their own coach account.
+
+The entitlements of a user are built with one query and cached until one of their subscriptions or
+their coach's tiers change, so tier-gated permission checks are set lookups.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+ENTITLEMENT_CACHE_TIMEOUT = getattr(settings, 'ENTITLEMENT_CACHE_TIMEOUT', 60 * 60)
+
+
+def cache_key(user_id):
+    return f"entitlements:{user_id}"
+
+
+def build_entitlements(user_id):
+    """
+    A row per own tier and subscription, the user joined with both their coach's tiers and their subscriptions.
+    Coaches have a couple of tiers so the cross product stays small.
+    """
+    rows = get_user_model().objects.filter(pk=user_id).order_by('subscriber__subscriptions__id').values_list(
+        'coach__id',
+        'coach__tiers__id',
+        'subscriber__subscriptions__tier_id',
+        'subscriber__subscriptions__tier__coach_id',
+        'subscriber__subscriptions__tier__tier',
+    )
+    entitlements = {'coach': None, 'own_tiers': set(), 'tiers': set(), 'coaches': {}}
+    for coach_id, own_tier_id, tier_id, tier_coach_id, tier_level in rows:
+        entitlements['coach'] = coach_id
+        if own_tier_id is not None:
+            entitlements['own_tiers'].add(own_tier_id)
+        if tier_id is not None:
+            entitlements['tiers'].add(tier_id)
+            # the first subscription of a coach counts, like `.filter(tier__coach=coach).first()`
+            entitlements['coaches'].setdefault(tier_coach_id, (tier_id, tier_level))
+    return entitlements
+
+
+def get_entitlements(user):
+    user_id = getattr(user, 'pk', user)
+    key = cache_key(user_id)
+    entitlements = cache.get(key)
+    if entitlements is None:
+        entitlements = build_entitlements(user_id)
+        cache.set(key, entitlements, ENTITLEMENT_CACHE_TIMEOUT)
+    return entitlements
+
+
+def can_access_tier(user, tier_id):
+    """
+    Whether the user subscribed to the tier or it is one of their own.
+    """
+    entitlements = get_entitlements(user)
+    return tier_id in entitlements['tiers'] or tier_id in entitlements['own_tiers']
+
+
+def can_access_coach(user, coach_id):
+    """
+    Whether the user subscribed to any tier of the coach or is the coach.
+    """
+    entitlements = get_entitlements(user)
+    return coach_id in entitlements['coaches'] or coach_id == entitlements['coach']
+
+
+def subscribed_tier(user, coach_id):
+    """
+    The (tier id, tier level) the user subscribed to of the coach, or None.
+    """
+    return get_entitlements(user)['coaches'].get(coach_id)
+
+
+def invalidate_entitlements(user_id):
+    if user_id is None:
+        return
+    cache.delete(cache_key(user_id))
+    # a request could cache the old entitlements again before the change is committed
+    transaction.on_commit(lambda: cache.delete(cache_key(user_id)))
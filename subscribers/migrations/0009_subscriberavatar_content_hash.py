@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscribers', '0008_subscriber_last_seen_post'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriberavatar',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
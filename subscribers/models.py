@@ -1,17 +1,17 @@
 from django.apps import apps
-from django.db import models
-from django.db.models import JSONField, Q
-from django.db.models.signals import pre_save
+from django.db import models, transaction
+from django.db.models import JSONField, Sum
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from common.models import CommonUser, CommonImage
+from common.models import CommonUser, HashedImage
+from common.cache import register_cache_tags, tag
+from payments import outbox
+from .entitlements import invalidate_entitlements
+from collections import Counter
 from uuid import uuid4
-import stripe
-import os
 
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
-
-class SubscriberAvatar(CommonImage):
+class SubscriberAvatar(HashedImage):
     pass
 
 
@@ -24,32 +24,9 @@ class Subscriber(CommonUser):
 
     @property
     def xp(self):
-        points = 0
-        Team = apps.get_model('projects.Team')
-        Project = apps.get_model('projects.Project')
-        MilestoneCompletionReport = apps.get_model('projects.MilestoneCompletionReport')
-        teams = Team.objects.filter(members__in=[self.user.subscriber])
-        for team in teams:
-            tasks_completed = MilestoneCompletionReport.objects.filter(
-            milestone__project=team.project).filter(Q(status=MilestoneCompletionReport.PENDING) | Q(status=MilestoneCompletionReport.ACCEPTED)).distinct('milestone', 'team')
-            if team.project.milestones.count() == tasks_completed.filter(milestone__project=team.project):
-                if team.project.difficulty == Project.EASY:
-                    points += 25
-                elif team.project.difficulty == Project.INTERMEDIATE:
-                    points += 50
-                else:
-                    points += 100
-            for task in tasks_completed:
-                if task.milestone.project.difficulty == Project.EASY:
-                    points += 10
-                elif task.milestone.project.difficulty == Project.INTERMEDIATE:
-                    points += 25
-                else:
-                    points += 50
-        for award in self.user.subscriber.awards.all():
-            points += award.award.xp
-        return points
-
+        if '_xp' not in self.__dict__:
+            prefetch_xp([self])
+        return self._xp
 
     @property
     def level(self):
@@ -64,23 +41,55 @@ class Subscriber(CommonUser):
 
         # subscriber and coach operate on the same user so they should share avatars
         if self.user.is_coach:
-            self.user.coach.name = self.name
-            if self.avatar:
-                if not self.user.coach.avatar:
-                    coach_avatar = CoachAvatar.objects.create(image=self.avatar.image, height=self.avatar.height,
-                        width=self.avatar.width)
-                    self.user.coach.avatar = coach_avatar
-                else:
-                    # self.user.coach.avatar.delete()
-                    coach_avatar = CoachAvatar.objects.create(image=self.avatar.image, height=self.avatar.height,
-                        width=self.avatar.width)
-                    self.user.coach.avatar = coach_avatar
-
-                    # self.user.coach.avatar.image = self.avatar.image
-                    # self.user.coach.avatar.height = self.avatar.height
-                    # self.user.coach.avatar.width = self.avatar.width
-            self.user.coach.save()
-        super(Subscriber, self).save(*args, **kwargs)
+            coach = self.user.coach
+            changed = coach.name != self.name
+            coach.name = self.name
+            # the coach avatar with the same content is reused, so saving an unchanged profile writes nothing
+            avatar = self.avatar if self.avatar and self.avatar.image else None
+            if avatar and (coach.avatar is None or coach.avatar.get_content_hash() != avatar.get_content_hash()):
+                coach.avatar = CoachAvatar.for_image(self.avatar)
+                changed = True
+            if changed:
+                coach.save()
+        with transaction.atomic():
+            super(Subscriber, self).save(*args, **kwargs)
+
+
+# the points of each task completed in a project of the subscriber's teams by the project's difficulty,
+# Project.EASY and Project.INTERMEDIATE, harder projects are worth TASK_POINTS_DEFAULT
+TASK_POINTS = {'EA': 10, 'IM': 25}
+TASK_POINTS_DEFAULT = 50
+
+
+def prefetch_xp(subscribers):
+    """
+    Computes the xp of the subscribers with three queries however many there are, `xp` reads it from then on.
+    A task is a milestone a team reported, counted once per team, the awards of a subscriber add their xp.
+    """
+    Team = apps.get_model('projects.Team')
+    MilestoneCompletionReport = apps.get_model('projects.MilestoneCompletionReport')
+    Award = apps.get_model('awards.Award')
+    subscribers = [subscriber for subscriber in subscribers if '_xp' not in subscriber.__dict__]
+    if not subscribers:
+        return
+    ids = {subscriber.pk for subscriber in subscribers}
+
+    memberships = list(Team.members.through.objects.filter(subscriber__in=ids, team__project__isnull=False)
+                       .values_list('subscriber', 'team__project', 'team__project__difficulty'))
+    reports = MilestoneCompletionReport.objects.filter(
+        milestone__project__in={project for _, project, _ in memberships},
+        status__in=[MilestoneCompletionReport.PENDING, MilestoneCompletionReport.ACCEPTED],
+    ).order_by().values_list('milestone__project', 'milestone', 'team').distinct()
+    tasks = Counter(project for project, _, _ in reports)
+
+    points = Counter()
+    for subscriber, project, difficulty in memberships:
+        points[subscriber] += tasks[project] * TASK_POINTS.get(difficulty, TASK_POINTS_DEFAULT)
+    awards = Award.objects.filter(subscriber__in=ids).order_by().values('subscriber').annotate(xp=Sum('award__xp'))
+    for award in awards:
+        points[award['subscriber']] += award['xp'] or 0
+    for subscriber in subscribers:
+        subscriber._xp = points[subscriber.pk]
 
 
 class Subscription(models.Model):
@@ -95,9 +104,22 @@ class Subscription(models.Model):
     json_data = JSONField(null=True, blank=True)
 
 
-@receiver(pre_save, sender=Subscriber)
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def subscription_changed(sender, instance, **kwargs):
+    # query the user id, the subscriber may be the object being deleted
+    user_id = Subscriber.objects.filter(pk=instance.subscriber_id).values_list('user_id', flat=True).first()
+    invalidate_entitlements(user_id)
+
+
+@receiver(post_save, sender=Subscriber)
 def create_stripe_customer(sender, instance, *args, **kwargs):
+    # the customer is created by the stripe outbox worker
+    # views that need it right away run the operation inline with outbox.run_pending_operations
     if not instance.customer_id:
-        customer = stripe.Customer.create(email=instance.user.email,
-                               name=instance.name)
-        instance.customer_id = customer.id
+        outbox.enqueue_customer(instance, email=instance.user.email, name=instance.name)
+
+
+register_cache_tags(Subscription, related=lambda subscription: [
+    tag(model, pk) for model, pk in ((Subscriber, subscription.subscriber_id),
+                                     (apps.get_model('tiers', 'Tier'), subscription.tier_id)) if pk is not None])
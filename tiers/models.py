@@ -1,35 +1,20 @@
-import os
 from django.dispatch import receiver
-from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from djmoney.models.fields import MoneyField
-import stripe
-from babel.numbers import get_currency_precision
 from instructor.models import Coach
 from accounts.models import User
 from subscribers.models import Subscription
+from subscribers.entitlements import invalidate_entitlements
+from common.cache import register_cache_tags, tag
+from payments import outbox, price_migration
+from payments.signals import price_created
 from decimal import Decimal
 import uuid
-import json
-
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-def money_to_integer(money):
-    return int(
-        money.amount * (
-            10 ** get_currency_precision(money.currency.code)
-        )
-    )
-
 
-def create_stripe_price(instance):
-    price = stripe.Price.create(
-        unit_amount=money_to_integer(instance.credit),
-        currency=instance.credit.currency.code.lower(),
-        recurring={"interval": "month"},
-        product=instance.product_id,
-    )
 
-    return price
+def enqueue_stripe_price(instance, previous_price_id=None):
+    return outbox.enqueue_price(instance, recurring={"interval": "month"}, previous_price_id=previous_price_id)
 
 
 class Tier(models.Model):
@@ -71,38 +56,6 @@ class Tier(models.Model):
         return str(self.get_tier_display())
 
     def save(self, *args, **kwargs):
-        if self.pk:
-            # checking if price has changed
-            old_tier = Tier.objects.filter(pk=self.pk).first()
-            if old_tier.credit != self.credit:
-                price = create_stripe_price(self)
-
-                # following these instructions https://stripe.com/docs/billing/subscriptions/products-and-prices
-                # to update the subscription pricing
-                # finding all the subscriptions with the old price id
-                subscriptions = Subscription.objects.filter(price_id=self.price_id)
-                for sub_instance in subscriptions:
-                    subscription = stripe.Subscription.retrieve(sub_instance.subscription_id)
-                
-                    subscription = stripe.Subscription.modify(
-                        subscription.id,
-                        cancel_at_period_end=False,
-                        proration_behavior='create_prorations',
-                        items=[{
-                            'id': subscription['items']['data'][0].id,
-                            'price': price.id,
-                        }]
-                    )
-
-                    sub_instance.json_data = json.dumps(subscription)
-                    sub_instance.subscription_id = subscription.id
-                    # subscribe user to the new pricing
-                    sub_instance.price_id = price.id
-                    sub_instance.save()
-                
-                # update the price_id
-                self.price_id = price.id
-
         if self.tier == self.FREE:
             self.credit = Decimal("0.00")
         elif self.tier == self.TIER1:
@@ -124,7 +77,15 @@ class Tier(models.Model):
                 self.subheading = 'Free for everyone'
             else:
                 self.subheading = f"{self.credit}/month"
-        super(Tier, self).save(*args, **kwargs)
+
+        old_tier = Tier.objects.filter(pk=self.pk).first() if self.pk else None
+        with transaction.atomic():
+            super(Tier, self).save(*args, **kwargs)
+            # checking if price has changed
+            # stripe prices can't be edited so a new one is recorded and once it is created
+            # the subscriptions on the old price are moved to it (see migrate_subscriptions_to_new_price)
+            if old_tier and old_tier.credit != self.credit and self.price_id:
+                enqueue_stripe_price(self, previous_price_id=self.price_id)
 
 
 class Benefit(models.Model):
@@ -136,19 +97,29 @@ class Benefit(models.Model):
         return self.description
 
 
-@receiver(pre_save, sender=Tier)
+@receiver(post_save, sender=Tier)
 def tier_updated(sender, instance, *args, **kwargs):
-    # create stripe Product
+    # record the stripe Product
     if not instance.product_id:
-        product = stripe.Product.create(name="%s - %s" % (instance.coach.name, instance.label))
-        instance.product_id = product.id
-    else:
-        pass
-    
-    # create stripe Price
+        outbox.enqueue_product(instance, "%s - %s" % (instance.coach.name, instance.label))
+
+    # record the stripe Price
     if not instance.price_id:
-        price = create_stripe_price(instance)
-        instance.price_id = price.id
+        enqueue_stripe_price(instance)
+
+
+@receiver(post_save, sender=Tier)
+@receiver(post_delete, sender=Tier)
+def tier_changed(sender, instance, **kwargs):
+    # the coach's own tiers are part of their entitlements
+    invalidate_entitlements(Coach.objects.filter(pk=instance.coach_id).values_list('user_id', flat=True).first())
+
+
+@receiver(price_created, sender=Tier)
+def migrate_subscriptions_to_new_price(sender, instance, price, previous_price_id, **kwargs):
+    # the subscriptions on the old price are moved in the background by the process_price_migrations worker
+    if previous_price_id:
+        price_migration.schedule(instance, price.id)
 
 
 @receiver(post_save, sender=Coach)
@@ -157,3 +128,6 @@ def create_tiers(sender, instance, created, **kwargs):
         Tier.objects.create(coach=instance, tier=Tier.FREE)
         Tier.objects.create(coach=instance, tier=Tier.TIER1)
         #Tier.objects.create(coach=instance, tier=Tier.TIER2)
+
+
+register_cache_tags(Tier, related=lambda tier: [tag(Coach, tier.coach_id)])
@@ -0,0 +1,12 @@
+from django.contrib import admin
+from .models import Upload
+
+
+class UploadAdmin(admin.ModelAdmin):
+    model = Upload
+    list_display = ('name', 'kind', 'user', 'status', 'size', 'width', 'height', 'created')
+    list_filter = ('status', 'kind')
+    search_fields = ('name', 'user__email')
+
+
+admin.site.register(Upload, UploadAdmin)
@@ -0,0 +1,35 @@
+# Generated by Django 3.1 on 2026-10-19 14:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('surrogate', models.UUIDField(db_index=True, default=uuid.uuid4, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('kind', models.CharField(choices=[('post', 'Post image'), ('comment', 'Comment image'), ('message', 'Message image'), ('milestone', 'Milestone completion image'), ('avatar', 'Avatar')], max_length=20)),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('CO', 'Confirmed'), ('AT', 'Attached')], default='PD', max_length=2)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('content_type', models.CharField(max_length=100)),
+                ('size', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.IntegerField(blank=True, null=True)),
+                ('width', models.IntegerField(blank=True, null=True)),
+                ('confirmed', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import models
+from accounts.models import User
+import uuid
+
+
+class Upload(models.Model):
+    """
+    An image the client uploads straight to S3 with a presigned POST. Once the client confirms the upload its
+    size and dimensions are recorded, and it can be attached to a post, comment, message, milestone report
+    or avatar by its surrogate.
+    """
+    POST = 'post'
+    COMMENT = 'comment'
+    MESSAGE = 'message'
+    MILESTONE = 'milestone'
+    AVATAR = 'avatar'
+    KINDS = [
+        (POST, 'Post image'),
+        (COMMENT, 'Comment image'),
+        (MESSAGE, 'Message image'),
+        (MILESTONE, 'Milestone completion image'),
+        (AVATAR, 'Avatar'),
+    ]
+
+    PENDING = 'PD'
+    CONFIRMED = 'CO'
+    ATTACHED = 'AT'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (CONFIRMED, 'Confirmed'),
+        (ATTACHED, 'Attached'),
+    ]
+
+    surrogate = models.UUIDField(default=uuid.uuid4, unique=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="uploads")
+    kind = models.CharField(max_length=20, choices=KINDS)
+    status = models.CharField(max_length=2, choices=STATUSES, default=PENDING)
+    # the name of the file in the media storage, the object key is the storage's location followed by it
+    name = models.CharField(max_length=255, unique=True)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveIntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    width = models.IntegerField(null=True, blank=True)
+    confirmed = models.DateTimeField(null=True, blank=True)
+    # the sha256 of an avatar, recorded when it is confirmed, see common/hashing.py
+    content_hash = models.CharField(max_length=64, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
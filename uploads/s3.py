@@ -0,0 +1,165 @@
+"""
+Direct uploads to the media bucket.
+
+Instead of streaming images through the API, clients ask for a presigned POST, upload the file straight to
+S3 and confirm the upload. Confirming checks the object's size and reads its dimensions from the first
+bytes of the file, then the upload can be attached to the object it was made for. Avatars are read whole and
+copied to the name common/hashing.py stores them under, like the avatars uploaded through the API.
+AWS_S3_ENDPOINT_URL points the uploads, like the media storage, to a local S3 compatible server such as minio.
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from botocore.exceptions import ClientError
+from PIL import ImageFile
+from common import hashing
+from .models import Upload
+import hashlib
+import posixpath
+import uuid
+
+MAX_BYTES = getattr(settings, 'UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+EXPIRES_SECONDS = getattr(settings, 'UPLOAD_EXPIRES_SECONDS', 10 * 60)
+# enough for the headers of jpegs and pngs, the rest of the image is only read when they are larger
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+}
+
+
+class UploadError(Exception):
+    pass
+
+
+def get_client():
+    return default_storage.bucket.meta.client
+
+
+def object_key(name):
+    return posixpath.join(default_storage.location, name)
+
+
+def presign(upload):
+    """
+    The url and form fields the client posts the file with, valid for EXPIRES_SECONDS.
+    """
+    return get_client().generate_presigned_post(
+        Bucket=default_storage.bucket_name,
+        Key=object_key(upload.name),
+        Fields={'Content-Type': upload.content_type},
+        Conditions=[
+            {'Content-Type': upload.content_type},
+            ['content-length-range', 1, MAX_BYTES],
+        ],
+        ExpiresIn=EXPIRES_SECONDS,
+    )
+
+
+def create_upload(user, kind, content_type):
+    if kind not in dict(Upload.KINDS):
+        raise UploadError(f"Unknown upload kind {kind}")
+    if content_type not in CONTENT_TYPES:
+        raise UploadError(f"Unsupported content type {content_type}")
+    # uploaded under the same folder the image fields use
+    name = f"images/uploads/{uuid.uuid4().hex}.{CONTENT_TYPES[content_type]}"
+    return Upload.objects.create(user=user, kind=kind, content_type=content_type, name=name)
+
+
+def read_dimensions(key, digest=None):
+    """
+    Reads the object until pillow can tell the image's size, usually the first chunk is enough. With a `digest`
+    the whole object is read and fed to it.
+    """
+    body = get_client().get_object(Bucket=default_storage.bucket_name, Key=key)['Body']
+    parser = ImageFile.Parser()
+    size = None
+    try:
+        for chunk in body.iter_chunks(CHUNK_SIZE):
+            if digest is not None:
+                digest.update(chunk)
+            if size is None:
+                parser.feed(chunk)
+                size = parser.image and parser.image.size
+            if size and digest is None:
+                break
+    except Exception as e:
+        raise UploadError(f"The upload is not a valid image: {e}")
+    finally:
+        body.close()
+    if not size:
+        raise UploadError('The upload is not a valid image')
+    return size
+
+
+def store_hashed(key, name):
+    """
+    Copies the object to `name` unless an identical image is stored there already.
+    """
+    client = get_client()
+    try:
+        client.head_object(Bucket=default_storage.bucket_name, Key=object_key(name))
+    except ClientError:
+        client.copy_object(Bucket=default_storage.bucket_name, Key=object_key(name),
+                           CopySource={'Bucket': default_storage.bucket_name, 'Key': key})
+
+
+def confirm(upload):
+    """
+    Records the size and dimensions of an uploaded object. Confirming twice is harmless.
+    """
+    if upload.status != Upload.PENDING:
+        return upload
+    key = object_key(upload.name)
+    try:
+        head = get_client().head_object(Bucket=default_storage.bucket_name, Key=key)
+    except ClientError:
+        raise UploadError('The file has not been uploaded')
+    if head['ContentLength'] > MAX_BYTES:
+        raise UploadError('The file is too large')
+
+    # avatars are stored under the hash of their content, so an avatar uploaded twice is stored once
+    digest = hashlib.sha256() if upload.kind == Upload.AVATAR else None
+    upload.width, upload.height = read_dimensions(key, digest)
+    if digest is not None:
+        upload.content_hash = digest.hexdigest()
+        store_hashed(key, hashing.hashed_name(upload.content_hash, upload.name))
+    upload.size = head['ContentLength']
+    upload.status = Upload.CONFIRMED
+    upload.confirmed = timezone.now()
+    upload.save()
+    if digest is not None:
+        # only the copy is attached
+        get_client().delete_object(Bucket=default_storage.bucket_name, Key=key)
+    return upload
+
+
+def claim(user, surrogates, kind):
+    """
+    Marks the user's confirmed uploads as attached and returns them in the given order,
+    so an upload can't be attached twice. Call it inside the transaction that creates what they are attached to,
+    the claim is rolled back with it when that fails.
+    """
+    surrogates = [str(surrogate) for surrogate in surrogates]
+    with transaction.atomic():
+        uploads = {str(upload.surrogate): upload for upload in Upload.objects.select_for_update().filter(
+            user=user, kind=kind, status=Upload.CONFIRMED, surrogate__in=surrogates)}
+        if len(uploads) != len(set(surrogates)):
+            raise UploadError('Unknown or unconfirmed upload')
+        Upload.objects.filter(id__in=[upload.id for upload in uploads.values()]).update(status=Upload.ATTACHED)
+    return [uploads[surrogate] for surrogate in dict.fromkeys(surrogates)]
+
+
+def image_fields(upload):
+    """
+    The fields of a `CommonImage` for the upload, the dimensions are known so the file isn't read again. A hashed
+    upload is the fields of a `HashedImage`, stored under its hash.
+    """
+    if upload.content_hash:
+        return {'image': hashing.hashed_name(upload.content_hash, upload.name), 'height': upload.height,
+                'width': upload.width, 'content_hash': upload.content_hash}
+    return {'image': upload.name, 'height': upload.height, 'width': upload.width}